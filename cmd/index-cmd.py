@@ -7,11 +7,13 @@ exec "$bup_python" "$0" ${1+"$@"}
 
 import sys, stat, time, os, errno, re
 
-from bup import metadata, options, git, index, drecurse, hlinkdb
+from bup import metadata, options, git, index, drecurse, hlinkdb, journal
+from bup import xstat
 from bup.drecurse import recursive_dirlist
 from bup.hashsplit import GIT_MODE_TREE, GIT_MODE_FILE
-from bup.helpers import (add_error, handle_ctrl_c, log, parse_excludes, parse_rx_excludes,
-                         progress, qprogress, saved_errors)
+from bup.helpers import (ExcludeMatcher, add_error, handle_ctrl_c, log,
+                         parse_excludes, parse_rx_excludes, progress,
+                         qprogress, saved_errors, slashappend)
 
 
 class IterHelper:
@@ -48,10 +50,18 @@ def check_index(reader):
         assert(not e or e.name == '/')  # last entry is *always* /
         log('check: checking normal iteration...\n')
         last = None
+        pending = {}  # name -> totals of the children seen so far
         for e in reader:
             if last:
                 assert(last > e.name)
             last = e.name
+            # Children come before their parents.
+            assert(pending.pop(e.name, (0, 0))
+                   == (e.pending_n, e.pending_size))
+            if e.parent:
+                n, size = pending.get(e.parent.name, (0, 0))
+                e_n, e_size = e.pending_totals()
+                pending[e.parent.name] = (n + e_n, size + e_size)
     except:
         log('index error! at %r\n' % e)
         raise
@@ -59,7 +69,9 @@ def check_index(reader):
 
 
 def clear_index(indexfile):
-    indexfiles = [indexfile, indexfile + '.meta', indexfile + '.hlink']
+    indexfiles = [indexfile, indexfile + '.meta', indexfile + '.meta.idx',
+                  indexfile + '.hlink', indexfile + '.journal',
+                  indexfile + '.journal.pending', indexfile + '.splits']
     for indexfile in indexfiles:
         path = git.repo(indexfile)
         try:
@@ -71,140 +83,345 @@ def clear_index(indexfile):
                 raise
 
 
-def update_index(top, excluded_paths, exclude_rxs, xdev_exceptions):
-    # tmax and start must be epoch nanoseconds.
-    tmax = (time.time() - 1) * 10**9
-    ri = index.Reader(indexfile)
-    msw = index.MetaStoreWriter(indexfile + '.meta')
-    wi = index.Writer(indexfile, msw, tmax)
-    rig = IterHelper(ri.iter(name=top))
-    tstart = int(time.time()) * 10**9
-
-    hlinks = hlinkdb.HLinkDB(indexfile + '.hlink')
-
-    fake_hash = None
-    if opt.fake_valid:
-        def fake_hash(name):
-            return (GIT_MODE_FILE, index.FAKE_SHA)
-
-    total = 0
-    bup_dir = os.path.abspath(git.repo())
-    index_start = time.time()
-    for path, pst in recursive_dirlist([top],
-                                       xdev=opt.xdev,
-                                       bup_dir=bup_dir,
-                                       excluded_paths=excluded_paths,
-                                       exclude_rxs=exclude_rxs,
-                                       xdev_exceptions=xdev_exceptions):
+class IndexUpdate:
+    """Update the entries in the index, and then merge in any new ones
+    via finish().  New entries must be added in index order."""
+    def __init__(self):
+        # tmax and start must be epoch nanoseconds.
+        self.tmax = (time.time() - 1) * 10**9
+        self.ri = index.Reader(indexfile)
+        self.msw = index.MetaStoreWriter(indexfile + '.meta')
+        self.wi = index.Writer(indexfile, self.msw, self.tmax)
+        self.tstart = int(time.time()) * 10**9
+        self.hlinks = hlinkdb.HLinkDB(indexfile + '.hlink')
+        self.fake_hash = None
+        if opt.fake_valid:
+            def fake_hash(name):
+                return (GIT_MODE_FILE, index.FAKE_SHA)
+            self.fake_hash = fake_hash
+        self.total = 0
+        self.bup_dir = os.path.abspath(git.repo())
+        self.index_start = time.time()
+
+    def _progress(self, path, pst):
+        total = self.total
         if opt.verbose>=2 or (opt.verbose==1 and stat.S_ISDIR(pst.st_mode)):
             sys.stdout.write('%s\n' % path)
             sys.stdout.flush()
-            elapsed = time.time() - index_start
+            elapsed = time.time() - self.index_start
             paths_per_sec = total / elapsed if elapsed else 0
             qprogress('Indexing: %d (%d paths/s)\r' % (total, paths_per_sec))
         elif not (total % 128):
-            elapsed = time.time() - index_start
+            elapsed = time.time() - self.index_start
             paths_per_sec = total / elapsed if elapsed else 0
             qprogress('Indexing: %d (%d paths/s)\r' % (total, paths_per_sec))
-        total += 1
-
-        while rig.cur and rig.cur.name > path:  # deleted paths
-            if rig.cur.exists():
-                rig.cur.set_deleted()
-                rig.cur.repack()
-                if rig.cur.nlink > 1 and not stat.S_ISDIR(rig.cur.mode):
-                    hlinks.del_path(rig.cur.name)
-            rig.next()
-
-        if rig.cur and rig.cur.name == path:    # paths that already existed
-            need_repack = False
-            if(rig.cur.stale(pst, tstart, check_device=opt.check_device)):
-                try:
-                    meta = metadata.from_path(path, statinfo=pst)
-                except (OSError, IOError) as e:
-                    add_error(e)
-                    rig.next()
-                    continue
-                if not stat.S_ISDIR(rig.cur.mode) and rig.cur.nlink > 1:
-                    hlinks.del_path(rig.cur.name)
-                if not stat.S_ISDIR(pst.st_mode) and pst.st_nlink > 1:
-                    hlinks.add_path(path, pst.st_dev, pst.st_ino)
-                # Clear these so they don't bloat the store -- they're
-                # already in the index (since they vary a lot and they're
-                # fixed length).  If you've noticed "tmax", you might
-                # wonder why it's OK to do this, since that code may
-                # adjust (mangle) the index mtime and ctime -- producing
-                # fake values which must not end up in a .bupm.  However,
-                # it looks like that shouldn't be possible:  (1) When
-                # "save" validates the index entry, it always reads the
-                # metadata from the filesytem. (2) Metadata is only
-                # read/used from the index if hashvalid is true. (3)
-                # "faked" entries will be stale(), and so we'll invalidate
-                # them below.
-                meta.ctime = meta.mtime = meta.atime = 0
-                meta_ofs = msw.store(meta)
-                rig.cur.update_from_stat(pst, meta_ofs)
-                rig.cur.invalidate()
-                need_repack = True
-            if not (rig.cur.flags & index.IX_HASHVALID):
-                if fake_hash:
-                    rig.cur.gitmode, rig.cur.sha = fake_hash(path)
-                    rig.cur.flags |= index.IX_HASHVALID
-                    need_repack = True
-            if opt.fake_invalid:
-                rig.cur.invalidate()
-                need_repack = True
-            if need_repack:
-                rig.cur.repack()
-            rig.next()
-        else:  # new paths
+        self.total += 1
+
+    def delete(self, ent):
+        if ent.exists():
+            ent.set_deleted()
+            ent.repack()
+            if ent.nlink > 1 and not stat.S_ISDIR(ent.mode):
+                self.hlinks.del_path(ent.name)
+
+    def update(self, ent, path, pst):
+        """Update ent, the existing entry for path."""
+        need_repack = False
+        if(ent.stale(pst, self.tstart, check_device=opt.check_device)):
             try:
                 meta = metadata.from_path(path, statinfo=pst)
             except (OSError, IOError) as e:
                 add_error(e)
-                continue
-            # See same assignment to 0, above, for rationale.
-            meta.atime = meta.mtime = meta.ctime = 0
-            meta_ofs = msw.store(meta)
-            wi.add(path, pst, meta_ofs, hashgen=fake_hash)
+                return
+            if not stat.S_ISDIR(ent.mode) and ent.nlink > 1:
+                self.hlinks.del_path(ent.name)
             if not stat.S_ISDIR(pst.st_mode) and pst.st_nlink > 1:
-                hlinks.add_path(path, pst.st_dev, pst.st_ino)
-
-    elapsed = time.time() - index_start
-    paths_per_sec = total / elapsed if elapsed else 0
-    progress('Indexing: %d, done (%d paths/s).\n' % (total, paths_per_sec))
-
-    hlinks.prepare_save()
-
-    if ri.exists():
-        ri.save()
-        wi.flush()
-        if wi.count:
-            wr = wi.new_reader()
-            if opt.check:
-                log('check: before merging: oldfile\n')
-                check_index(ri)
-                log('check: before merging: newfile\n')
-                check_index(wr)
-            mi = index.Writer(indexfile, msw, tmax)
-
-            for e in index.merge(ri, wr):
-                # FIXME: shouldn't we remove deleted entries eventually?  When?
-                mi.add_ixentry(e)
-
-            ri.close()
-            mi.close()
-            wr.close()
-        wi.abort()
-    else:
-        wi.close()
+                self.hlinks.add_path(path, pst.st_dev, pst.st_ino)
+            # Clear these so they don't bloat the store -- they're
+            # already in the index (since they vary a lot and they're
+            # fixed length).  If you've noticed "tmax", you might
+            # wonder why it's OK to do this, since that code may
+            # adjust (mangle) the index mtime and ctime -- producing
+            # fake values which must not end up in a .bupm.  However,
+            # it looks like that shouldn't be possible:  (1) When
+            # "save" validates the index entry, it always reads the
+            # metadata from the filesytem. (2) Metadata is only
+            # read/used from the index if hashvalid is true. (3)
+            # "faked" entries will be stale(), and so we'll invalidate
+            # them below.
+            meta.ctime = meta.mtime = meta.atime = 0
+            meta_ofs = self.msw.store(meta)
+            ent.update_from_stat(pst, meta_ofs)
+            ent.invalidate()
+            need_repack = True
+        if not (ent.flags & index.IX_HASHVALID):
+            if self.fake_hash:
+                ent.gitmode, ent.sha = self.fake_hash(path)
+                ent.flags |= index.IX_HASHVALID
+                need_repack = True
+        if opt.fake_invalid:
+            ent.invalidate()
+            need_repack = True
+        if need_repack:
+            ent.repack()
 
-    msw.close()
-    hlinks.commit_save()
+    def add(self, path, pst):
+        try:
+            meta = metadata.from_path(path, statinfo=pst)
+        except (OSError, IOError) as e:
+            add_error(e)
+            return
+        # See same assignment to 0, above, for rationale.
+        meta.atime = meta.mtime = meta.ctime = 0
+        meta_ofs = self.msw.store(meta)
+        self.wi.add(path, pst, meta_ofs, hashgen=self.fake_hash)
+        if not stat.S_ISDIR(pst.st_mode) and pst.st_nlink > 1:
+            self.hlinks.add_path(path, pst.st_dev, pst.st_ino)
+
+    def walk(self, top, excluded_paths, exclude_rxs, xdev_exceptions):
+        """Update everything at or below top from the filesystem."""
+        rig = IterHelper(self.ri.iter(name=top))
+        for path, pst in recursive_dirlist([top],
+                                           xdev=opt.xdev,
+                                           bup_dir=self.bup_dir,
+                                           excluded_paths=excluded_paths,
+                                           exclude_rxs=exclude_rxs,
+                                           xdev_exceptions=xdev_exceptions):
+            self._progress(path, pst)
+            while rig.cur and rig.cur.name > path:  # deleted paths
+                self.delete(rig.cur)
+                rig.next()
+            if rig.cur and rig.cur.name == path:    # paths that already existed
+                self.update(rig.cur, path, pst)
+                rig.next()
+            else:  # new paths
+                self.add(path, pst)
+
+    def restat(self, path, pst):
+        """Update path (and nothing below it) from pst."""
+        self._progress(path, pst)
+        ent = self.ri.find(path)
+        if ent:
+            self.update(ent, path, pst)
+        else:
+            self.add(path, pst)
+
+    def delete_tree(self, path):
+        """Mark everything at or below path deleted."""
+        for ent in self.ri.iter(name=path):
+            self.delete(ent)
+
+    def finish(self):
+        elapsed = time.time() - self.index_start
+        paths_per_sec = self.total / elapsed if elapsed else 0
+        progress('Indexing: %d, done (%d paths/s).\n'
+                 % (self.total, paths_per_sec))
+
+        self.hlinks.prepare_save()
+
+        ri, wi, msw = self.ri, self.wi, self.msw
+        if ri.exists():
+            ri.save()
+            wi.flush()
+            if wi.count:
+                wr = wi.new_reader()
+                if opt.check:
+                    log('check: before merging: oldfile\n')
+                    check_index(ri)
+                    log('check: before merging: newfile\n')
+                    check_index(wr)
+                mi = index.Writer(indexfile, msw, self.tmax)
+
+                for e in index.merge(ri, wr):
+                    # FIXME: shouldn't we remove deleted entries eventually?  When?
+                    mi.add_ixentry(e)
+
+                ri.close()
+                mi.close()
+                wr.close()
+            wi.abort()
+        else:
+            wi.close()
+
+        msw.close()
+        self.hlinks.commit_save()
+
+
+def update_index(top, excluded_paths, exclude_rxs, xdev_exceptions):
+    u = IndexUpdate()
+    u.walk(top, excluded_paths, exclude_rxs, xdev_exceptions)
+    u.finish()
+
+
+def journal_excluded(excludes, top, name):
+    # The walk never looks below excluded directories, so check each
+    # directory between top and name too.
+    if not excludes:
+        return False
+    path = top
+    for part in index.pathsplit(name[len(top):]):
+        path += part
+        if excludes.excluded(path):
+            return True
+    return False
+
+
+def update_index_from_journal(tops, excluded_paths, exclude_rxs,
+                              xdev_exceptions):
+    jname = indexfile + '.journal'
+    roots = journal.watched_roots(indexfile + '.watch')
+    synced = roots is not None and journal.sync(indexfile)
+    records = journal.take(jname)
+    reset = (journal.RESET, '') in records
+    ri = index.Reader(indexfile)
+    have_index = bool(ri.exists())
+    ri.close()
+    if roots is None:
+        log('index: no watcher running; walking the whole tree\n')
+        roots = []
+    elif not synced:
+        log('index: watcher not responding; walking the whole tree\n')
+        reset = True
+    elif reset:
+        log('index: journal incomplete; walking the whole tree\n')
+    elif not have_index:
+        reset = True
+    full = []
+    partial = []
+    for top in tops:
+        if reset or not journal.covering(roots, top):
+            full.append(top)
+        else:
+            partial.append(top)
+
+    # Keep the records nobody has handled yet.
+    remainder = [(kind, path) for kind, path in records
+                 if kind != journal.RESET and not journal.covering(tops, path)]
+    if reset and [root for root in roots if not journal.covering(tops, root)]:
+        remainder.insert(0, (journal.RESET, ''))
+
+    for top in full:
+        update_index(top, excluded_paths, exclude_rxs, xdev_exceptions)
+    if partial:
+        u = IndexUpdate()
+        apply_journal(u, partial, records, excluded_paths, exclude_rxs,
+                      xdev_exceptions)
+        u.finish()
+    journal.finish(jname, remainder)
+
+
+def apply_journal(u, tops, records, excluded_paths, exclude_rxs,
+                  xdev_exceptions):
+    excludes = ExcludeMatcher(excluded_paths, exclude_rxs)
+    devs = {}
+    def dev_of(path):
+        dev = devs.get(path)
+        if dev is None:
+            dev = devs[path] = os.lstat(path).st_dev
+        return dev
+
+    def on_top_dev(top, name):
+        # Like the walk, don't look inside directories on other devices.
+        dir = top
+        for part in index.pathsplit(name[len(top):])[:-1]:
+            if dev_of(dir) != dev_of(top) and dir not in xdev_exceptions:
+                return False
+            dir += part
+        return dev_of(dir) == dev_of(top) or dir in xdev_exceptions
+
+    items = {}  # name -> (pst, recursive)
+    gone = set()  # names, where 'x' means the non-directory x only
+    for kind, path in records:
+        top = journal.covering(tops, path)
+        if not top:
+            continue
+        path = path.rstrip('/') or '/'
+        try:
+            pst = xstat.lstat(path)
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                add_error(e)
+                continue
+            gone.add(path)
+            gone.add(slashappend(path))
+            continue
+        isdir = stat.S_ISDIR(pst.st_mode)
+        if isdir:
+            name = slashappend(path)
+            gone.add(path)
+        else:
+            name = path
+            gone.add(path + '/')
+        if not name.startswith(top):
+            continue
+        normname = os.path.normpath(name)
+        if journal_excluded(excludes, top, name) \
+           or normname == u.bup_dir or normname.startswith(u.bup_dir + '/'):
+            gone.add(name)
+            continue
+        recursive = kind == journal.TREE or (isdir and not u.ri.find(name))
+        if opt.xdev and name != top:
+            if not on_top_dev(top, name):
+                gone.add(name)
+                continue
+            if isdir and pst.st_dev != dev_of(top) \
+               and name not in xdev_exceptions:
+                recursive = False  # i.e. a mount point
+        prev = items.get(name)
+        items[name] = (pst, recursive or (prev and prev[1]))
+
+    # Drop anything that will be handled by a recursive walk.
+    trees = set(name for name, (pst, recursive) in items.iteritems()
+                if recursive)
+    def in_tree(name):
+        prefix = ''
+        for part in index.pathsplit(name)[:-1]:
+            prefix += part
+            if prefix in trees:
+                return True
+        return False
+
+    for name in sorted(gone, reverse=True):
+        if name in items or in_tree(name):
+            continue
+        if name.endswith('/'):
+            u.delete_tree(name)
+        else:
+            ent = u.ri.find(name)
+            if ent:
+                u.delete(ent)
+    for name in sorted(items, key=index.pathsplit, reverse=True):
+        if in_tree(name):
+            continue
+        pst, recursive = items[name]
+        if recursive:
+            u.walk(name, excluded_paths, exclude_rxs, xdev_exceptions)
+        else:
+            u.restat(name, pst)
+
+
+def watch(tops, excluded_paths, exclude_rxs):
+    bup_dir = os.path.abspath(git.repo())
+    for top in tops:
+        if not top.endswith('/'):
+            o.fatal('--watch requires directories, not %r' % top)
+    try:
+        w = journal.Watcher(indexfile, tops, xdev=opt.xdev, skip=[bup_dir],
+                            excludes=ExcludeMatcher(excluded_paths,
+                                                    exclude_rxs))
+    except journal.Error as e:
+        log('error: %s\n' % e)
+        sys.exit(1)
+    w.start()
+    log('watch: watching %d directories\n' % len(w.wds))
+    try:
+        w.run()
+    finally:
+        w.close()
 
 
 optspec = """
-bup index <-p|-m|-s|-u|--clear|--check> [options...] <filenames...>
+bup index <-p|-m|-s|-u|--clear|--check|--watch> [options...] <filenames...>
 --
  Modes:
 p,print    print the index entries for the given names (also works with -u)
@@ -213,7 +430,9 @@ s,status   print each filename with a status char (A/M/D) (implies -p)
 u,update   recursively update the index entries for the given file/dir names (default if no mode is specified)
 check      carefully check index file integrity
 clear      clear the default index
+watch      record changes to the given dirs in the index journal until interrupted
  Options:
+from-journal  with -u, only restat the paths recorded by --watch (when possible)
 H,hash     print the hash for each object next to its name
 l,long     print more information about each file
 no-check-device don't invalidate an entry if the containing device changes
@@ -235,8 +454,14 @@ if not (opt.modified or \
         opt.status or \
         opt.update or \
         opt.check or \
-        opt.clear):
+        opt.clear or \
+        opt.watch):
     opt.update = 1
+if opt.watch and (opt.modified or opt['print'] or opt.status or opt.update
+                  or opt.check or opt.clear):
+    o.fatal('--watch is incompatible with the other modes')
+if opt.from_journal and not opt.update:
+    o.fatal('--from-journal is meaningless without -u')
 if (opt.fake_valid or opt.fake_invalid) and not opt.update:
     o.fatal('--fake-{in,}valid are meaningless without -u')
 if opt.fake_valid and opt.fake_invalid:
@@ -270,11 +495,27 @@ if opt.update:
     excluded_paths = parse_excludes(flags, o.fatal)
     exclude_rxs = parse_rx_excludes(flags, o.fatal)
     xexcept = index.unique_resolved_paths(extra)
-    for rp, path in index.reduce_paths(extra):
-        update_index(rp, excluded_paths, exclude_rxs, xdev_exceptions=xexcept)
+    if opt.from_journal:
+        tops = [rp for rp, path in index.reduce_paths(extra)]
+        update_index_from_journal(tops, excluded_paths, exclude_rxs,
+                                  xdev_exceptions=xexcept)
+    else:
+        for rp, path in index.reduce_paths(extra):
+            update_index(rp, excluded_paths, exclude_rxs,
+                         xdev_exceptions=xexcept)
+
+if opt.watch:
+    if not extra:
+        o.fatal('watch mode requested but no paths given')
+    watch([rp for rp, path in index.reduce_paths(extra)],
+          parse_excludes(flags, o.fatal), parse_rx_excludes(flags, o.fatal))
 
 if opt['print'] or opt.status or opt.modified:
-    for (name, ent) in index.Reader(indexfile).filter(extra or ['']):
+    select = None
+    if opt.modified:
+        select = index.select_flags(on=index.IX_EXISTS, off=index.IX_HASHVALID)
+    for (name, ent) in index.Reader(indexfile).filter(extra or [''],
+                                                      select=select):
         if (opt.modified 
             and (ent.is_valid() or ent.is_deleted() or not ent.mode)):
             continue
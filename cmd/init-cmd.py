@@ -7,24 +7,30 @@ exec "$bup_python" "$0" ${1+"$@"}
 
 import sys
 
-from bup import git, options, client
+from bup import git, hashsplit, options, client
 from bup.helpers import log, saved_errors
 
 
 optspec = """
-[BUP_DIR=...] bup init [-r host:path]
+[BUP_DIR=...] bup init [-r host:path] [--chunker=name]
 --
 r,remote=  remote repository path
+chunker=   split data with the given chunker (rollsum or fastcdc)
 """
 o = options.Options(optspec)
 (opt, flags, extra) = o.parse(sys.argv[1:])
 
 if extra:
     o.fatal("no arguments expected")
+if opt.chunker:
+    if opt.remote:
+        o.fatal("--chunker can't be used with -r")
+    if opt.chunker not in hashsplit.CHUNKERS:
+        o.fatal('unsupported chunker %r' % opt.chunker)
 
 
 try:
-    git.init_repo()  # local repo
+    git.init_repo(chunker=opt.chunker)  # local repo
 except git.GitError as e:
     log("bup: error: could not init repository: %s" % e)
     sys.exit(1)
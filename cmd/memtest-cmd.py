@@ -5,7 +5,7 @@ exec "$bup_python" "$0" ${1+"$@"}
 """
 # end of bup preamble
 
-import sys, re, struct, time, resource
+import os, sys, re, shutil, struct, tempfile, time, resource
 
 from bup import git, bloom, midx, options, _helpers
 from bup.helpers import handle_ctrl_c
@@ -74,6 +74,7 @@ n,number=  number of objects per cycle [10000]
 c,cycles=  number of cycles to run [100]
 ignore-midx  ignore .midx files, use only .idx files
 existing   test with existing objects instead of fake ones
+compare-blooms  compare the bloom filter formats for the repository's objects
 """
 o = options.Options(optspec)
 (opt, flags, extra) = o.parse(sys.argv[1:])
@@ -83,7 +84,54 @@ if extra:
 
 git.ignore_midx = opt.ignore_midx
 
+
+def compare_blooms(packdir, lookups):
+    """Build a bloom filter in each format for the objects in packdir,
+    and report the false positive rate and the major page faults of
+    looking up random (nonexistent) objects in it, starting with the
+    filter out of the page cache."""
+    counts = git.idx_counts(packdir)
+    idxs = counts.keys()
+    count = sum(counts.itervalues())
+    if not count:
+        o.fatal('no objects to build bloom filters for')
+    print '%-8s %5s %3s %10s %10s %10s %10s' \
+        % ('format', 'bits', 'k', 'expected%', 'pfalse%', 'MajFlt', 'steps')
+    tmpdir = tempfile.mkdtemp(dir=packdir, prefix='bup-memtest-')
+    try:
+        for blocked in (False, True):
+            name = os.path.join(tmpdir, 'test.bloom')
+            b = bloom.create(name, expected=count, blocked=blocked)
+            for idx in idxs:
+                b.add_idx(git.open_idx(idx))
+            b.close()
+            with open(name, 'rb') as f:
+                os.fsync(f.fileno())
+                _helpers.fadvise_done(f.fileno(), 0, os.fstat(f.fileno()).st_size)
+            b = bloom.ShaBloom(name)
+            steps = bloom._total_steps
+            faults = resource.getrusage(resource.RUSAGE_SELF).ru_majflt
+            positives = 0
+            for i in xrange(lookups):
+                if b.exists(_helpers.random_sha()):
+                    positives += 1
+            faults = resource.getrusage(resource.RUSAGE_SELF).ru_majflt - faults
+            steps = bloom._total_steps - steps
+            print '%-8s %5d %3d %10.4f %10.4f %10d %10.3f' \
+                % (blocked and 'blocked' or 'classic', b.bits, b.k,
+                   b.pfalse_positive(), positives*100.0/lookups,
+                   faults, steps*1.0/lookups)
+            b.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
 git.check_repo_or_die()
+
+if opt.compare_blooms:
+    compare_blooms(git.repo('objects/pack'), opt.number * opt.cycles)
+    sys.exit(0)
+
 m = git.PackIdxList(git.repo('objects/pack'))
 
 report(-1)
@@ -0,0 +1,2 @@
+#!/bin/sh
+exec /root/.pyenv/shims/python2.7 "$@"
\ No newline at end of file
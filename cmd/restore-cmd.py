@@ -5,13 +5,14 @@ exec "$bup_python" "$0" ${1+"$@"}
 """
 # end of bup preamble
 
-import copy, errno, os, sys, stat, re
+import copy, errno, os, select, sys, stat, re, struct
 
 from bup import options, git, metadata, vfs
 from bup._helpers import write_sparsely
-from bup.helpers import (add_error, chunkyreader, handle_ctrl_c, log, mkdirp,
+from bup.helpers import (ExcludeMatcher, add_error, chunkyreader,
+                         handle_ctrl_c, log, mkdirp, parse_num,
                          parse_rx_excludes, progress, qprogress, saved_errors,
-                         should_rx_exclude_path, unlink)
+                         unlink)
 
 
 optspec = """
@@ -28,6 +29,7 @@ map-group=  given OLD=NEW, restore OLD group as NEW group
 map-uid=    given OLD=NEW, restore OLD uid as NEW uid
 map-gid=    given OLD=NEW, restore OLD gid as NEW gid
 q,quiet     don't show progress meter
+j,jobs=     number of processes to write file content with [1]
 """
 
 total_restored = 0
@@ -188,6 +190,176 @@ def write_file_content_sparsely(fullname, n):
         os.close(outfd)
 
 
+class MetadataTask:
+    """Apply meta (if any) to fullname once the task is done(), and
+    so are all of its subtasks, i.e. the paths below it, and any
+    content that's still being written for it."""
+    def __init__(self, parent, meta, fullname):
+        self.parent = parent
+        self.meta = meta
+        self.fullname = fullname
+        self.pending = 1
+        if parent:
+            parent.pending += 1
+
+    def done(self):
+        self.pending -= 1
+        if not self.pending:
+            if self.meta:
+                apply_metadata(self.meta, self.fullname, opt.numeric_ids,
+                               owner_map)
+            if self.parent:
+                self.parent.done()
+
+
+# With --jobs, the content of regular files is written by a pool of
+# worker processes, each with its own connection to the repository,
+# while the main process walks the tree, creating directories (and
+# everything else), and applying the metadata as each task is done.
+
+_job_hdr = '!IIHI20s'  # id, path length, bupmode, mode, hash
+_job_hdrlen = struct.calcsize(_job_hdr)
+_result_hdr = '!II'  # id, errors length
+_result_hdrlen = struct.calcsize(_result_hdr)
+# The number of jobs queued for each worker.  This also keeps the
+# results from filling the pipes while the main process is busy.
+_queue_len = 8
+_max_errors_len = 4096
+
+
+def write_worker(jobs, results, write_content):
+    """Write the content for each job read from the jobs file until
+    it's closed, and report each job done (with its errors) to the
+    results file."""
+    while True:
+        hdr = jobs.read(_job_hdrlen)
+        if not hdr:
+            return
+        id, path_len, bupmode, mode, hash = struct.unpack(_job_hdr, hdr)
+        path = jobs.read(path_len)
+        errors = len(saved_errors)
+        try:
+            write_content(path, vfs.File(None, path, mode, hash, bupmode))
+        except (IOError, OSError) as e:
+            add_error(e)
+        msg = '\0'.join(str(e) for e in saved_errors[errors:])
+        msg = msg[:_max_errors_len]
+        results.write(struct.pack(_result_hdr, id, len(msg)) + msg)
+        results.flush()
+
+
+class Writer:
+    def __init__(self, number, job_file, results_fd, pid):
+        self.number = number
+        self.job_file = job_file
+        self.results_fd = results_fd
+        self.pid = pid
+        self.queued = {}  # id -> (task, fullname)
+        self.buf = ''
+
+
+class WriterPool:
+    """Write the content of regular files with n worker processes."""
+    def __init__(self, n, sparse):
+        self.writers = []
+        self.next_id = 0
+        self.write_content = sparse and write_file_content_sparsely \
+            or write_file_content
+        for i in xrange(n):
+            job_r, job_w = os.pipe()
+            results_r, results_w = os.pipe()
+            pid = os.fork()
+            if not pid:  # child
+                status = 99
+                try:
+                    try:
+                        # Don't keep the other workers' job pipes open.
+                        for w in self.writers:
+                            w.job_file.close()
+                            os.close(w.results_fd)
+                        os.close(job_w)
+                        os.close(results_r)
+                        write_worker(os.fdopen(job_r, 'rb'),
+                                     os.fdopen(results_w, 'wb'),
+                                     self.write_content)
+                        status = 0
+                    except Exception as e:
+                        log('exception: %r\n' % e)
+                finally:
+                    os._exit(status)
+            os.close(job_r)
+            os.close(results_w)
+            self.writers.append(Writer(i, os.fdopen(job_w, 'wb'),
+                                       results_r, pid))
+
+    def write(self, fullname, n, task):
+        """Write the content of n, a regular file, to fullname, and
+        keep task pending until that's done."""
+        while self.writers:
+            w = min(self.writers, key=lambda w: len(w.queued))
+            if len(w.queued) < _queue_len:
+                break
+            self._wait()
+        else:
+            # All of the workers died, so carry on without them.
+            self.write_content(fullname, n)
+            return
+        path = os.path.abspath(fullname)
+        id = self.next_id
+        self.next_id += 1
+        task.pending += 1
+        w.queued[id] = (task, fullname)
+        w.job_file.write(struct.pack(_job_hdr, id, len(path), n.bupmode,
+                                     n.mode, n.hash) + path)
+        w.job_file.flush()
+
+    def _wait(self):
+        """Wait for results, and finish the tasks they're for."""
+        busy = [w for w in self.writers if w.queued]
+        ready = select.select([w.results_fd for w in busy], [], [])[0]
+        for w in busy:
+            if w.results_fd not in ready:
+                continue
+            data = os.read(w.results_fd, 65536)
+            if not data:
+                add_error('restore worker %d died' % w.number)
+                for task, fullname in w.queued.itervalues():
+                    add_error('%s: content may be incomplete' % fullname)
+                    task.done()
+                w.queued = {}
+                self._close(w)
+                continue
+            w.buf += data
+            while len(w.buf) >= _result_hdrlen:
+                id, msg_len = struct.unpack_from(_result_hdr, w.buf)
+                end = _result_hdrlen + msg_len
+                if len(w.buf) < end:
+                    break
+                if msg_len:
+                    # The worker has already logged them.
+                    saved_errors.extend(w.buf[_result_hdrlen:end]
+                                        .split('\0'))
+                w.buf = w.buf[end:]
+                task, fullname = w.queued.pop(id)
+                task.done()
+
+    def drain(self):
+        """Wait until all of the content has been written."""
+        while any(w.queued for w in self.writers):
+            self._wait()
+
+    def _close(self, w):
+        self.writers.remove(w)
+        w.job_file.close()
+        os.close(w.results_fd)
+        os.waitpid(w.pid, 0)
+
+    def close(self):
+        self.drain()
+        for w in list(self.writers):
+            self._close(w)
+
+
 def find_dir_item_metadata_by_name(dir, name):
     """Find metadata in dir (a node) for an item with the given name,
     or for the directory itself if the name is ''."""
@@ -212,7 +384,7 @@ def find_dir_item_metadata_by_name(dir, name):
             meta_stream.close()
 
 
-def do_root(n, sparse, owner_map, restore_root_meta = True):
+def do_root(n, sparse, owner_map, restore_root_meta = True, writers = None):
     # Very similar to do_node(), except that this function doesn't
     # create a path for n's destination directory (and so ignores
     # n.fullname).  It assumes the destination is '.', and restores
@@ -230,23 +402,27 @@ def do_root(n, sparse, owner_map, restore_root_meta = True):
         print_info(n, '.')
         total_restored += 1
         plog('Restoring: %d\r' % total_restored)
+        task = MetadataTask(None, restore_root_meta and root_meta, '.')
         for sub in n:
             m = None
             # Don't get metadata if this is a dir -- handled in sub do_node().
             if meta_stream and not stat.S_ISDIR(sub.mode):
                 m = metadata.Metadata.read(meta_stream)
-            do_node(n, sub, sparse, owner_map, meta = m)
-        if root_meta and restore_root_meta:
-            apply_metadata(root_meta, '.', opt.numeric_ids, owner_map)
+            do_node(n, sub, sparse, owner_map, meta = m,
+                    writers = writers, parent_task = task)
+        task.done()
     finally:
         if meta_stream:
             meta_stream.close()
 
-def do_node(top, n, sparse, owner_map, meta = None):
+def do_node(top, n, sparse, owner_map, meta = None,
+            writers = None, parent_task = None):
     # Create n.fullname(), relative to the current directory, and
     # restore all of its metadata, when available.  The meta argument
     # will be None for dirs, or when there is no .bupm (i.e. no
-    # metadata).
+    # metadata).  With writers, regular files' content (and so their
+    # metadata, and that of their directories) may not have been
+    # written yet when this returns; see MetadataTask.
     global total_restored, opt
     meta_stream = None
     write_content = sparse and write_file_content_sparsely or write_file_content
@@ -256,7 +432,7 @@ def do_node(top, n, sparse, owner_map, meta = None):
         exclude_candidate = '/' + fullname
         if(stat.S_ISDIR(n.mode)):
             exclude_candidate += '/'
-        if should_rx_exclude_path(exclude_candidate, exclude_rxs):
+        if excludes.excluded(exclude_candidate):
             return
         # If this is a directory, its metadata is the first entry in
         # any .bupm file inside the directory.  Get it.
@@ -271,13 +447,19 @@ def do_node(top, n, sparse, owner_map, meta = None):
         if meta and meta.hardlink_target:
             created_hardlink = hardlink_if_possible(fullname, n, meta)
 
+        task = MetadataTask(parent_task, not created_hardlink and meta,
+                            fullname)
         if not created_hardlink:
             create_path(n, fullname, meta)
             if meta:
-                if stat.S_ISREG(meta.mode):
+                regular = stat.S_ISREG(meta.mode)
+            else:
+                regular = stat.S_ISREG(n.mode)
+            if regular:
+                if writers:
+                    writers.write(fullname, n, task)
+                else:
                     write_content(fullname, n)
-            elif stat.S_ISREG(n.mode):
-                write_content(fullname, n)
 
         total_restored += 1
         plog('Restoring: %d\r' % total_restored)
@@ -286,9 +468,9 @@ def do_node(top, n, sparse, owner_map, meta = None):
             # Don't get metadata if this is a dir -- handled in sub do_node().
             if meta_stream and not stat.S_ISDIR(sub.mode):
                 m = metadata.Metadata.read(meta_stream)
-            do_node(top, sub, sparse, owner_map, meta = m)
-        if meta and not created_hardlink:
-            apply_metadata(meta, fullname, opt.numeric_ids, owner_map)
+            do_node(top, sub, sparse, owner_map, meta = m,
+                    writers = writers, parent_task = task)
+        task.done()
     finally:
         if meta_stream:
             meta_stream.close()
@@ -305,8 +487,15 @@ top = vfs.RefList(None)
 
 if not extra:
     o.fatal('must specify at least one filename to restore')
-    
-exclude_rxs = parse_rx_excludes(flags, o.fatal)
+
+try:
+    opt.jobs = parse_num(opt.jobs)
+except ValueError as e:
+    o.fatal('invalid --jobs value: %s' % e)
+if opt.jobs < 1:
+    o.fatal('--jobs must be at least 1')
+
+excludes = ExcludeMatcher(exclude_rxs=parse_rx_excludes(flags, o.fatal))
 
 owner_map = {}
 for map_type in ('user', 'group', 'uid', 'gid'):
@@ -316,6 +505,12 @@ if opt.outdir:
     mkdirp(opt.outdir)
     os.chdir(opt.outdir)
 
+# Start the workers before anything is read from the repository, so
+# that each one makes its own connection.
+writers = None
+if opt.jobs > 1:
+    writers = WriterPool(opt.jobs, opt.sparse)
+
 ret = 0
 for d in extra:
     if not valid_restore_path(d):
@@ -336,7 +531,8 @@ for d in extra:
         if not isdir:
             add_error('%r: not a directory' % d)
         else:
-            do_root(n, opt.sparse, owner_map, restore_root_meta = (name == '.'))
+            do_root(n, opt.sparse, owner_map, restore_root_meta = (name == '.'),
+                    writers = writers)
     else:
         # Source is /foo/what/ever -- extract ./ever to cwd.
         if isinstance(n, vfs.FakeSymlink):
@@ -347,10 +543,18 @@ for d in extra:
             target = n.dereference()
             mkdirp(n.name)
             os.chdir(n.name)
-            do_root(target, opt.sparse, owner_map)
+            do_root(target, opt.sparse, owner_map, writers = writers)
         else: # Not a directory or fake symlink.
             meta = find_dir_item_metadata_by_name(n.parent, n.name)
-            do_node(n.parent, n, opt.sparse, owner_map, meta = meta)
+            do_node(n.parent, n, opt.sparse, owner_map, meta = meta,
+                    writers = writers)
+    # The metadata is applied relative to the current directory, which
+    # may change for the next path.
+    if writers:
+        writers.drain()
+
+if writers:
+    writers.close()
 
 if not opt.quiet:
     progress('Restoring: %d, done.\n' % total_restored)
@@ -7,12 +7,15 @@ exec "$bup_python" "$0" ${1+"$@"}
 
 from errno import EACCES
 from io import BytesIO
-import os, sys, stat, time, math
+from itertools import chain
+import os, sys, stat, struct, time, math
 
-from bup import hashsplit, git, options, index, client, metadata, hlinkdb
+from bup import (hashsplit, git, options, index, client, metadata, hlinkdb,
+                 splitdb)
 from bup.hashsplit import GIT_MODE_TREE, GIT_MODE_FILE, GIT_MODE_SYMLINK
-from bup.helpers import (add_error, grafted_path_components, handle_ctrl_c,
-                         hostname, istty2, log, parse_date_or_fatal, parse_num,
+from bup.helpers import (add_error, debug1, grafted_path_components,
+                         handle_ctrl_c, hostname, istty2, log,
+                         parse_date_or_fatal, parse_num,
                          path_components, progress, qprogress, resolve_parent,
                          saved_errors, stripped_path_components,
                          userfullname, username, valid_save_name)
@@ -30,10 +33,15 @@ v,verbose  increase log output (can be used more than once)
 q,quiet    don't show progress meter
 smaller=   only back up files smaller than n bytes
 bwlimit=   maximum bytes/sec to transmit to server
+mmap=      read regular files of at least n bytes via mmap
+readahead= have the kernel read up to n bytes of the next files to save ahead of time [16M]
+trust-generation  don't recheck that unchanged files are in the repository if they were seen there since its last gc
+assume-appends  when a large file has grown, only split the new data if a sample of the old data is unchanged
 f,indexfile=  the name of the index file (normally BUP_DIR/bupindex)
 strip      strips the path to every filename given
 strip-path= path-prefix to be stripped when saving
 graft=     a graft point *old_path*=*new_path* (can be used more than once)
+skip-incompressible  store blobs that don't seem to compress without compressing them
 #,compress=  set compression level to # (0-9, 9 is highest) [1]
 """
 o = options.Options(optspec)
@@ -47,6 +55,9 @@ if not extra:
 
 opt.progress = (istty2 and not opt.quiet)
 opt.smaller = parse_num(opt.smaller or 0)
+if opt.mmap:
+    hashsplit.mmap_min_size = parse_num(opt.mmap)
+opt.readahead = parse_num(opt.readahead or 0)
 if opt.bwlimit:
     client.bwlimit = parse_num(opt.bwlimit)
 
@@ -91,11 +102,29 @@ if opt.remote or is_reverse:
         log('error: %s' % e)
         sys.exit(1)
     oldref = refname and cli.read_ref(refname) or None
-    w = cli.new_packwriter(compression_level=opt.compress)
+    w = cli.new_packwriter(compression_level=opt.compress,
+                           skip_incompressible=opt.skip_incompressible)
 else:
     cli = None
     oldref = refname and git.read_ref(refname) or None
-    w = git.PackWriter(compression_level=opt.compress)
+    w = git.PackWriter(compression_level=opt.compress,
+                       skip_incompressible=opt.skip_incompressible)
+
+if cli:
+    chunker = cli.config_get(hashsplit.CHUNKER_CONFIG)
+else:
+    chunker = git.git_config_get(hashsplit.CHUNKER_CONFIG)
+repo_gen = None
+if opt.trust_generation:
+    if cli:
+        repo_gen = cli.repo_generation()
+    else:
+        repo_gen = git.repo_generation() or git.new_repo_generation()
+try:
+    hashsplit.set_chunker(chunker)
+except ValueError as e:
+    log('error: %s\n' % e)
+    sys.exit(1)
 
 handle_ctrl_c()
 
@@ -114,26 +143,48 @@ def eatslash(dir):
 #
 # Since the git tree elements are sorted according to
 # git.shalist_item_sort_key, the metalist items are accumulated as
-# (sort_key, metadata) tuples, and then sorted when the .bupm file is
-# created.  The sort_key must be computed using the element's real
-# name and mode rather than the git mode and (possibly mangled) name.
+# (sort_key, encoded metadata) tuples, and then sorted when the .bupm
+# file is created.  The sort_key must be computed using the element's
+# real name and mode rather than the git mode and (possibly mangled)
+# name.  Each item's metadata is encoded as soon as it's added, so
+# closing a directory only has to sort and hash what's accumulated.
+# The index lists the elements in reverse order, so both lists are
+# reversed first, which leaves them (nearly) sorted, i.e. cheap to
+# sort, even for huge directories.
 
 # Maintain a stack of information representing the current location in
 # the archive being constructed.  The current path is recorded in
 # parts, which will be something like ['', 'home', 'someuser'], and
 # the accumulated content and metadata for of the dirs in parts is
-# stored in parallel stacks in shalists and metalists.
+# stored in parallel stacks in shalists and metalists.  The git names
+# already in each shalist are tracked in names, so that duplicates
+# (possible given --strip, etc.) can be dropped as they're added.
 
 parts = [] # Current archive position (stack of dir names).
 shalists = [] # Hashes for each dir in paths.
 metalists = [] # Metadata for each dir in paths.
+names = [] # Git names in each of shalists.
 
 
 def _push(part, metadata):
     # Enter a new archive directory -- make it the current directory.
     parts.append(part)
     shalists.append([])
-    metalists.append([('', metadata)]) # This dir's metadata (no name).
+    metalists.append([('', metadata.encode())]) # This dir's metadata (no name).
+    names.append(set())
+
+
+def _add(git_info, sort_key=None, meta=None):
+    # Add an element (and its metadata, if any) to the current directory.
+    name = git_info[1]
+    if name in names[-1]:
+        add_error('error: ignoring duplicate path %r in %r'
+                  % (name, '/'.join(parts) + '/'))
+        return
+    names[-1].add(name)
+    shalists[-1].append(git_info)
+    if meta is not None:
+        metalists[-1].append((sort_key, meta.encode()))
 
 
 def _pop(force_tree, dir_metadata=None):
@@ -142,37 +193,25 @@ def _pop(force_tree, dir_metadata=None):
     part = parts.pop()
     shalist = shalists.pop()
     metalist = metalists.pop()
-    if metalist and not force_tree:
+    names.pop()
+    if force_tree:
+        tree = force_tree
+    else:
         if dir_metadata: # Override the original metadata pushed for this dir.
-            metalist = [('', dir_metadata)] + metalist[1:]
-        sorted_metalist = sorted(metalist, key = lambda x : x[0])
-        metadata = ''.join([m[1].encode() for m in sorted_metalist])
-        metadata_f = BytesIO(metadata)
+            metalist[0] = ('', dir_metadata.encode())
+        metalist.reverse()
+        metalist.sort(key = lambda x : x[0])
+        metadata_f = hashsplit.StringsFile(m[1] for m in metalist)
         mode, id = hashsplit.split_to_blob_or_tree(w.new_blob, w.new_tree,
                                                    [metadata_f],
                                                    keep_boundaries=False)
         shalist.append((mode, '.bupm', id))
-    # FIXME: only test if collision is possible (i.e. given --strip, etc.)?
-    if force_tree:
-        tree = force_tree
-    else:
-        names_seen = set()
-        clean_list = []
-        for x in shalist:
-            name = x[1]
-            if name in names_seen:
-                parent_path = '/'.join(parts) + '/'
-                add_error('error: ignoring duplicate path %r in %r'
-                          % (name, parent_path))
-            else:
-                names_seen.add(name)
-                clean_list.append(x)
-        tree = w.new_tree(clean_list)
+        shalist.reverse()
+        tree = w.new_tree(shalist)
     if shalists:
-        shalists[-1].append((GIT_MODE_TREE,
-                             git.mangle_name(part,
-                                             GIT_MODE_TREE, GIT_MODE_TREE),
-                             tree))
+        _add((GIT_MODE_TREE,
+              git.mangle_name(part, GIT_MODE_TREE, GIT_MODE_TREE),
+              tree))
     return tree
 
 
@@ -225,12 +264,34 @@ except IOError as ex:
     log('error: cannot access %r; have you run bup index?' % indexfile)
     sys.exit(1)
 hlink_db = hlinkdb.HLinkDB(indexfile + '.hlink')
+split_db = None
+if opt.assume_appends:
+    split_db = splitdb.SplitDB(indexfile + '.splits',
+                               hashsplit.chunker, hashsplit.fanout)
+
+# The generation the index entries are marked with once their sha has
+# been found in the repository.  Unless we can trust the marks left by
+# earlier runs, use one that only means "during this run".
+if opt.trust_generation and repo_gen:
+    verified_gen = repo_gen
+else:
+    verified_gen = struct.unpack('!Q', os.urandom(8))[0] or 1
 
 def already_saved(ent):
-    return ent.is_valid() and w.exists(ent.sha) and ent.sha
-
-def wantrecurse_pre(ent):
-    return not already_saved(ent)
+    if ent.verified_in(verified_gen):
+        return ent.sha
+    if not ent.is_valid():
+        return None
+    source = w.exists(ent.sha, want_source=True)
+    if not source:
+        return None
+    # Only trust objects that are in a finished pack, i.e. that were
+    # there before we started writing.
+    if source is not True:
+        ent.verified_gen = verified_gen
+        if verified_gen == repo_gen:
+            ent.repack()
+    return ent.sha
 
 def wantrecurse_during(ent):
     return not already_saved(ent) or ent.sha_missing()
@@ -241,19 +302,39 @@ def find_hardlink_target(hlink_db, ent):
         if link_paths:
             return link_paths[0]
 
+def split_file(ent, f):
+    if not split_db:
+        return hashsplit.split_to_blob_or_tree(w.new_blob, w.new_tree, [f],
+                                               keep_boundaries=False)
+    old = split_db.get(ent.name)
+    prefix = None
+    if old and old[0] == ent.sha:
+        prefix = splitdb.grown_prefix(f, old[1], w.exists)
+    if prefix:
+        debug1('save: %s grew; splitting from %d\n' % (ent.name, prefix[0]))
+        old_blobs = splitdb.blobs(prefix[1])
+    else:
+        f.seek(0)
+        old_blobs = []
+    blobs = chain(old_blobs,
+                  hashsplit.split_to_blobs(w.new_blob, [f],
+                                           keep_boundaries=False,
+                                           progress=None))
+    packed = bytearray()
+    mode, id = hashsplit.blobs_to_blob_or_tree(w.new_blob, w.new_tree,
+                                               splitdb.pack_blobs(blobs,
+                                                                  packed))
+    if os.fstat(f.fileno()).st_size >= splitdb.MIN_SIZE:
+        split_db.set(ent.name, id, packed)
+    else:
+        split_db.remove(ent.name)
+    return mode, id
+
+# The index keeps track of how much there is to save below each
+# directory.
 total = ftotal = 0
 if opt.progress:
-    for (transname,ent) in r.filter(extra, wantrecurse=wantrecurse_pre):
-        if not (ftotal % 10024):
-            qprogress('Reading index: %d\r' % ftotal)
-        exists = ent.exists()
-        hashvalid = already_saved(ent)
-        ent.set_sha_missing(not hashvalid)
-        if not opt.smaller or ent.size < opt.smaller:
-            if exists and not hashvalid:
-                total += ent.size
-        ftotal += 1
-    progress('Reading index: %d, done.\n' % ftotal)
+    ftotal, total = r.pending_totals(extra)
     hashsplit.progress_callback = progress_report
 
 # Root collisions occur when strip or graft options map more than one
@@ -273,12 +354,30 @@ tstart = time.time()
 count = subcount = fcount = 0
 lastskip_name = None
 lastdir = ''
-for (transname,ent) in r.filter(extra, wantrecurse=wantrecurse_during):
+
+def file_to_read(item):
+    transname, ent = item
+    if not ent.flags & index.IX_EXISTS or not stat.S_ISREG(ent.mode):
+        return None
+    if opt.smaller and ent.size >= opt.smaller:
+        return None
+    if already_saved(ent):
+        return None
+    return ent.name, ent.size
+
+entries = hashsplit.ReadAhead(r.filter(extra, wantrecurse=wantrecurse_during),
+                              file_to_read, opt.readahead)
+for (transname,ent) in entries:
     (dir, file) = os.path.split(ent.name)
     exists = (ent.flags & index.IX_EXISTS)
     hashvalid = already_saved(ent)
-    wasmissing = ent.sha_missing()
+    # Whether the entry counts towards the index's pending totals.
+    pending = exists and not ent.flags & index.IX_HASHVALID
     oldsize = ent.size
+    # Flag the entries whose objects are missing, so that the next
+    # save descends into them again if this one doesn't save them
+    # (e.g. --smaller); validate() clears the flag once they're saved.
+    ent.set_sha_missing(not hashvalid)
     if opt.verbose:
         if not exists:
             status = 'D'
@@ -296,10 +395,11 @@ for (transname,ent) in r.filter(extra, wantrecurse=wantrecurse_during):
                 log('%s %-70s\n' % (status, os.path.join(dir, '')))
             lastdir = dir
 
+    if pending:
+        fcount += 1
     if opt.progress:
         progress_report(0)
-    fcount += 1
-    
+
     if not exists:
         continue
     if opt.smaller and ent.size >= opt.smaller:
@@ -307,6 +407,8 @@ for (transname,ent) in r.filter(extra, wantrecurse=wantrecurse_during):
             if opt.verbose:
                 log('skipping large file "%s"\n' % ent.name)
             lastskip_name = ent.name
+        if pending:
+            count += oldsize
         continue
 
     assert(dir.startswith('/'))
@@ -366,7 +468,7 @@ for (transname,ent) in r.filter(extra, wantrecurse=wantrecurse_during):
             else:
                 ent.validate(GIT_MODE_TREE, newtree)
             ent.repack()
-        if exists and wasmissing:
+        if pending:
             count += oldsize
         continue
 
@@ -376,25 +478,22 @@ for (transname,ent) in r.filter(extra, wantrecurse=wantrecurse_during):
         id = ent.sha
         git_name = git.mangle_name(file, ent.mode, ent.gitmode)
         git_info = (ent.gitmode, git_name, id)
-        shalists[-1].append(git_info)
         sort_key = git.shalist_item_sort_key((ent.mode, file, id))
         meta = msr.metadata_at(ent.meta_ofs)
         meta.hardlink_target = find_hardlink_target(hlink_db, ent)
         # Restore the times that were cleared to 0 in the metastore.
         (meta.atime, meta.mtime, meta.ctime) = (ent.atime, ent.mtime, ent.ctime)
-        metalists[-1].append((sort_key, meta))
+        _add(git_info, sort_key, meta)
     else:
         if stat.S_ISREG(ent.mode):
             try:
-                f = hashsplit.open_noatime(ent.name)
+                f = entries.open(ent.name)
             except (IOError, OSError) as e:
                 add_error(e)
                 lastskip_name = ent.name
             else:
                 try:
-                    (mode, id) = hashsplit.split_to_blob_or_tree(
-                                            w.new_blob, w.new_tree, [f],
-                                            keep_boundaries=False)
+                    (mode, id) = split_file(ent, f)
                 except (IOError, OSError) as e:
                     add_error('%s: %s' % (ent.name, e))
                     lastskip_name = ent.name
@@ -420,7 +519,6 @@ for (transname,ent) in r.filter(extra, wantrecurse=wantrecurse_during):
             ent.repack()
             git_name = git.mangle_name(file, ent.mode, ent.gitmode)
             git_info = (mode, git_name, id)
-            shalists[-1].append(git_info)
             sort_key = git.shalist_item_sort_key((ent.mode, file, id))
             hlink = find_hardlink_target(hlink_db, ent)
             try:
@@ -428,12 +526,12 @@ for (transname,ent) in r.filter(extra, wantrecurse=wantrecurse_during):
             except (OSError, IOError) as e:
                 add_error(e)
                 lastskip_name = ent.name
-            else:
-                metalists[-1].append((sort_key, meta))
+                meta = None
+            _add(git_info, sort_key, meta)
 
-    if exists and wasmissing:
+    if pending:
         count += oldsize
-        subcount = 0
+    subcount = 0
 
 
 if opt.progress:
@@ -463,6 +561,14 @@ if opt.commit or opt.name:
 
 msr.close()
 w.close()  # must close before we can update the ref
+summary = w.incompressible_summary()
+if summary and not opt.quiet:
+    log('%s\n' % summary)
+if split_db:
+    def still_indexed(path):
+        ent = r.find(path)
+        return ent is not None and ent.exists()
+    split_db.commit(keep=still_indexed)
         
 if opt.name:
     if cli:
@@ -151,6 +151,15 @@ def update_ref(conn, refname):
     conn.ok()
 
 
+def config_get(conn, name):
+    _init_session()
+    if not name.startswith('bup.'):
+        raise Exception('server: config %r is not available' % name)
+    value = git.git_config_get(name)
+    conn.write('%s\n' % (value or '').encode('hex'))
+    conn.ok()
+
+
 cat_pipe = None
 def cat(conn, id):
     global cat_pipe
@@ -191,6 +200,7 @@ commands = {
     'receive-objects-v2': receive_objects_v2,
     'read-ref': read_ref,
     'update-ref': update_ref,
+    'config-get': config_get,
     'cat': cat,
 }
 
@@ -37,6 +37,8 @@ max-pack-size=  maximum bytes in a single pack
 max-pack-objects=  maximum number of objects in a single pack
 fanout=    average number of blobs in a single tree
 bwlimit=   maximum bytes/sec to transmit to server
+mmap=      read regular files of at least n bytes via mmap
+skip-incompressible  store blobs that don't seem to compress without compressing them
 #,compress=  set compression level to # (0-9, 9 is highest) [1]
 """
 o = options.Options(optspec)
@@ -66,6 +68,8 @@ if opt.fanout:
     hashsplit.fanout = parse_num(opt.fanout)
 if opt.blobs:
     hashsplit.fanout = 0
+if opt.mmap:
+    hashsplit.mmap_min_size = parse_num(opt.mmap)
 if opt.bwlimit:
     client.bwlimit = parse_num(opt.bwlimit)
 if opt.date:
@@ -97,11 +101,23 @@ if opt.noop or opt.copy:
 elif opt.remote or is_reverse:
     cli = client.Client(opt.remote)
     oldref = refname and cli.read_ref(refname) or None
-    pack_writer = cli.new_packwriter(compression_level=opt.compress)
+    pack_writer = cli.new_packwriter(compression_level=opt.compress,
+                                     skip_incompressible=opt.skip_incompressible)
 else:
     cli = None
     oldref = refname and git.read_ref(refname) or None
-    pack_writer = git.PackWriter(compression_level=opt.compress)
+    pack_writer = git.PackWriter(compression_level=opt.compress,
+                                 skip_incompressible=opt.skip_incompressible)
+
+if cli:
+    chunker = cli.config_get(hashsplit.CHUNKER_CONFIG)
+else:
+    chunker = git.git_config_get(hashsplit.CHUNKER_CONFIG)
+try:
+    hashsplit.set_chunker(chunker)
+except ValueError as e:
+    log('error: %s\n' % e)
+    sys.exit(1)
 
 if opt.git_ids:
     # the input is actually a series of git object ids that we should retrieve
@@ -188,6 +204,9 @@ if opt.commit or opt.name:
 
 if pack_writer:
     pack_writer.close()  # must close before we can update the ref
+    summary = pack_writer.incompressible_summary()
+    if summary and not opt.quiet:
+        log('%s\n' % summary)
 
 if opt.name:
     if cli:
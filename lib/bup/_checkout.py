@@ -0,0 +1,3 @@
+COMMIT='86a5198403562e7c7fc9db511f32370bf4ef9369'
+NAMES='(tag: 86a5198)'
+DATE='2026-10-19 10:40:58 +0000'
@@ -40,6 +40,10 @@
 #include <time.h>
 #endif
 
+#ifdef HAVE_SYS_INOTIFY_H
+#include <sys/inotify.h>
+#endif
+
 #include "bupsplit.h"
 
 #if defined(FS_IOC_GETFLAGS) && defined(FS_IOC_SETFLAGS)
@@ -498,6 +502,21 @@ static PyObject *splitbuf(PyObject *self, PyObject *args)
 }
 
 
+static PyObject *fastcdc_splitbuf(PyObject *self, PyObject *args)
+{
+    unsigned char *buf = NULL;
+    Py_ssize_t len = 0;
+    int out = 0, bits = -1;
+
+    if (!PyArg_ParseTuple(args, "t#", &buf, &len))
+	return NULL;
+    assert(len <= INT_MAX);
+    out = bupsplit_fastcdc_find_ofs(buf, len, &bits);
+    if (out) assert(bits >= BUP_BLOBBITS);
+    return Py_BuildValue("ii", out, bits);
+}
+
+
 static PyObject *bitmatch(PyObject *self, PyObject *args)
 {
     unsigned char *buf1 = NULL, *buf2 = NULL;
@@ -670,6 +689,140 @@ static PyObject *bloom_contains(PyObject *self, PyObject *args)
 }
 
 
+/*
+ * A blocked bloom filter (version 3) keeps all of the k bits for an
+ * object within one 64-byte block (i.e. one cache line, and so one
+ * page), chosen by the first nbits-6 bits of the sha.  Each of the k
+ * bits in the block is then addressed by 9 bits of the next k 16-bit
+ * words of the sha.
+ */
+#define BLOOM_BLOCK_BITS 6
+
+static unsigned char *blocked_bloom_block(unsigned char *bloom,
+	const unsigned char *buf, const int nbits)
+{
+    uint32_t high;
+    uint64_t block = 0;
+    int block_bits = nbits - BLOOM_BLOCK_BITS;
+
+    if (block_bits > 0)
+    {
+	memcpy(&high, buf, 4);
+	block = ntohl(high) >> (32 - block_bits);
+    }
+    return bloom + BLOOM2_HEADERLEN + (block << BLOOM_BLOCK_BITS);
+}
+
+static int blocked_bloom_args_ok(Py_ssize_t blen, int nbits, int k)
+{
+    return k >= 1 && k <= 8
+	&& nbits >= BLOOM_BLOCK_BITS && nbits <= 32 + BLOOM_BLOCK_BITS
+	&& blen >= BLOOM2_HEADERLEN + ((Py_ssize_t)1 << nbits);
+}
+
+static PyObject *blocked_bloom_add(PyObject *self, PyObject *args)
+{
+    unsigned char *sha = NULL, *bloom = NULL, *block;
+    unsigned char *end;
+    Py_ssize_t len = 0, blen = 0;
+    int nbits = 0, k = 0, i, v;
+
+    if (!PyArg_ParseTuple(args, "w#s#ii", &bloom, &blen, &sha, &len, &nbits, &k))
+	return NULL;
+
+    if (!blocked_bloom_args_ok(blen, nbits, k) || len % 20 != 0)
+	return NULL;
+
+    for (end = sha + len; sha < end; sha += 20)
+    {
+	block = blocked_bloom_block(bloom, sha, nbits);
+	for (i = 0; i < k; i++)
+	{
+	    v = ((sha[4 + 2*i] << 8) | sha[5 + 2*i]) & 0x1ff;
+	    block[v >> 3] |= 1 << (v & 0x7);
+	}
+    }
+
+    return Py_BuildValue("n", len/20);
+}
+
+static PyObject *blocked_bloom_contains(PyObject *self, PyObject *args)
+{
+    unsigned char *sha = NULL, *bloom = NULL, *block;
+    Py_ssize_t len = 0, blen = 0;
+    int nbits = 0, k = 0, i, v;
+
+    if (!PyArg_ParseTuple(args, "t#s#ii", &bloom, &blen, &sha, &len, &nbits, &k))
+	return NULL;
+
+    if (!blocked_bloom_args_ok(blen, nbits, k) || len != 20)
+	return NULL;
+
+    block = blocked_bloom_block(bloom, sha, nbits);
+    for (i = 0; i < k; i++)
+    {
+	v = ((sha[4 + 2*i] << 8) | sha[5 + 2*i]) & 0x1ff;
+	if (!(block[v >> 3] & (1 << (v & 0x7))))
+	    return Py_BuildValue("Oi", Py_None, i + 1);
+    }
+
+    return Py_BuildValue("ii", 1, k);
+}
+
+
+static PyObject *bloom_exists_many(PyObject *self, PyObject *args)
+{
+    unsigned char *shas = NULL, *bloom = NULL, *sha, *block, *bitmap;
+    Py_ssize_t len = 0, blen = 0, n, i;
+    int nbits = 0, k = 0, blocked = 0, j, v, found;
+    PyObject *result;
+
+    if (!PyArg_ParseTuple(args, "t#t#iii", &bloom, &blen, &shas, &len,
+			  &nbits, &k, &blocked))
+	return NULL;
+
+    if (len % 20 != 0)
+	return PyErr_Format(PyExc_ValueError, "shas length is not a multiple of 20");
+    if (blocked ? !blocked_bloom_args_ok(blen, nbits, k)
+	: ((k != 4 && k != 5) || nbits > (k == 5 ? 29 : 37)
+	   || blen < BLOOM2_HEADERLEN + ((Py_ssize_t)1 << nbits)))
+	return PyErr_Format(PyExc_ValueError, "invalid bloom filter parameters");
+
+    n = len / 20;
+    result = PyString_FromStringAndSize(NULL, (n + 7) / 8);
+    if (!result)
+	return NULL;
+    bitmap = (unsigned char *)PyString_AS_STRING(result);
+    memset(bitmap, 0, (n + 7) / 8);
+    for (i = 0, sha = shas; i < n; i++, sha += 20)
+    {
+	found = 1;
+	if (blocked)
+	{
+	    block = blocked_bloom_block(bloom, sha, nbits);
+	    for (j = 0; found && j < k; j++)
+	    {
+		v = ((sha[4 + 2*j] << 8) | sha[5 + 2*j]) & 0x1ff;
+		found = block[v >> 3] & (1 << (v & 0x7));
+	    }
+	}
+	else if (k == 5)
+	{
+	    for (j = 0; found && j < 20; j += 20/k)
+		found = bloom_get_bit5(bloom, sha + j, nbits);
+	}
+	else
+	{
+	    for (j = 0; found && j < 20; j += 20/k)
+		found = bloom_get_bit4(bloom, sha + j, nbits);
+	}
+	if (found)
+	    bitmap[i >> 3] |= 1 << (i & 0x7);
+    }
+    return result;
+}
+
+
 static uint32_t _extract_bits(unsigned char *buf, int nbits)
 {
     uint32_t v, mask;
@@ -702,148 +855,470 @@ struct sha {
 };
 
 
-struct idx {
+struct midx_input {
     unsigned char *map;
-    struct sha *cur;
-    struct sha *end;
-    uint32_t *cur_name;
-    Py_ssize_t bytes;
-    int name_base;
+    size_t map_len;
+    const unsigned char *shas;
+    const unsigned char *names;
+    const unsigned char *crcs;
+    const unsigned char *ofs;
+    const unsigned char *ofs64;
+    uint32_t n;
+    uint32_t nofs64;
+    uint32_t name_base;
+    uint32_t cur;
+    uint32_t end;
+    int i;
 };
 
 
-static int _cmp_sha(const struct sha *sha1, const struct sha *sha2)
+// Order by the current SHA, and then by input, so that the output
+// doesn't depend on the heap's history.
+static int _midx_input_less(const struct midx_input *a,
+                            const struct midx_input *b)
 {
-    int i;
-    for (i = 0; i < sizeof(struct sha); i++)
-	if (sha1->bytes[i] != sha2->bytes[i])
-	    return sha1->bytes[i] - sha2->bytes[i];
-    return 0;
+    int c = memcmp(a->shas + 20 * a->cur, b->shas + 20 * b->cur, 20);
+    return c < 0 || (c == 0 && a->i < b->i);
 }
 
 
-static void _fix_idx_order(struct idx **idxs, int *last_i)
+static void _midx_heap_down(struct midx_input **heap, int len, int i)
 {
-    struct idx *idx;
-    int low, mid, high, c = 0;
-
-    idx = idxs[*last_i];
-    if (idxs[*last_i]->cur >= idxs[*last_i]->end)
+    while (1)
     {
-	idxs[*last_i] = NULL;
-	PyMem_Free(idx);
-	--*last_i;
-	return;
+	int child = 2 * i + 1, min = i;
+	if (child < len && _midx_input_less(heap[child], heap[min]))
+	    min = child;
+	if (child + 1 < len && _midx_input_less(heap[child + 1], heap[min]))
+	    min = child + 1;
+	if (min == i)
+	    return;
+	struct midx_input *tmp = heap[i];
+	heap[i] = heap[min];
+	heap[min] = tmp;
+	i = min;
     }
-    if (*last_i == 0)
-	return;
+}
+
 
-    low = *last_i-1;
-    mid = *last_i;
-    high = 0;
-    while (low >= high)
+static uint32_t _midx_prefix(const unsigned char *sha, int bits)
+{
+    return bits ? _extract_bits((unsigned char *)sha, bits) : 0;
+}
+
+
+// Return the index of the first SHA in in whose prefix is >= prefix.
+static uint32_t _midx_lower_bound(const struct midx_input *in,
+                                  uint32_t prefix, int bits)
+{
+    uint32_t lo = 0, hi = in->n;
+    while (lo < hi)
     {
-	mid = (low + high) / 2;
-	c = _cmp_sha(idx->cur, idxs[mid]->cur);
-	if (c < 0)
-	    high = mid + 1;
-	else if (c > 0)
-	    low = mid - 1;
+	uint32_t mid = lo + (hi - lo) / 2;
+	if (_midx_prefix(in->shas + 20 * mid, bits) < prefix)
+	    lo = mid + 1;
 	else
-	    break;
+	    hi = mid;
     }
-    if (c < 0)
-	++mid;
-    if (mid == *last_i)
-	return;
-    memmove(&idxs[mid+1], &idxs[mid], (*last_i-mid)*sizeof(struct idx *));
-    idxs[mid] = idx;
+    return lo;
 }
 
 
-static uint32_t _get_idx_i(struct idx *idx)
+#define MIDX5_HEADERLEN 16
+#define MIDX_OUTBUF_SIZE (64 * 1024)
+
+struct midx_outbuf {
+    off_t pos;
+    size_t len;
+    unsigned char buf[MIDX_OUTBUF_SIZE];
+};
+
+
+static int _midx_flush(int fd, struct midx_outbuf *out)
 {
-    if (idx->cur_name == NULL)
-	return idx->name_base;
-    return ntohl(*idx->cur_name) + idx->name_base;
+    size_t written = 0;
+    while (written < out->len)
+    {
+	ssize_t rc = pwrite(fd, out->buf + written, out->len - written,
+			    out->pos + written);
+	if (rc == -1)
+	{
+	    if (errno == EINTR)
+		continue;
+	    return -1;
+	}
+	written += rc;
+    }
+    out->pos += written;
+    out->len = 0;
+    return 0;
 }
 
-#define MIDX4_HEADERLEN 12
 
-static PyObject *merge_into(PyObject *self, PyObject *args)
+static int _midx_put(int fd, struct midx_outbuf *out,
+                     const void *data, size_t len)
 {
-    PyObject *py_total, *ilist = NULL;
-    unsigned char *fmap = NULL;
-    struct sha *sha_ptr, *sha_start = NULL;
-    uint32_t *table_ptr, *name_ptr, *name_start;
-    struct idx **idxs = NULL;
-    Py_ssize_t flen = 0;
-    int bits = 0, i;
-    unsigned int total;
-    uint32_t count, prefix;
-    int num_i;
-    int last_i;
-
-    if (!PyArg_ParseTuple(args, "w#iOO",
-                          &fmap, &flen, &bits, &py_total, &ilist))
-	return NULL;
+    if (out->len + len > MIDX_OUTBUF_SIZE && _midx_flush(fd, out) == -1)
+	return -1;
+    memcpy(out->buf + out->len, data, len);
+    out->len += len;
+    return 0;
+}
+
+
+static uint64_t _get_be64(const unsigned char *p)
+{
+    uint64_t v = 0;
+    int i;
+    for (i = 0; i < 8; i++)
+	v = (v << 8) | p[i];
+    return v;
+}
+
+static void _put_be64(unsigned char *p, uint64_t v)
+{
+    int i;
+    for (i = 7; i >= 0; i--, v >>= 8)
+	p[i] = v & 0xff;
+}
+
+
+static int _midx_map_input(struct midx_input *in, const char *filename,
+                           unsigned long long sha_ofs,
+                           unsigned long long name_ofs,
+                           unsigned long long crc_ofs,
+                           unsigned long long ofs_ofs,
+                           unsigned long long ofs64_ofs)
+{
+    struct stat st;
+    unsigned long long n = in->n;
+    int fd = open(filename, O_RDONLY);
+    if (fd == -1)
+    {
+	PyErr_SetFromErrnoWithFilename(PyExc_IOError, (char *)filename);
+	return 0;
+    }
+    if (fstat(fd, &st) == -1)
+    {
+	PyErr_SetFromErrnoWithFilename(PyExc_IOError, (char *)filename);
+	close(fd);
+	return 0;
+    }
+    if (sha_ofs + 20 * n > st.st_size
+	|| (name_ofs && name_ofs + 4 * n > st.st_size)
+	|| crc_ofs + 4 * n > st.st_size || ofs_ofs + 4 * n > st.st_size
+	|| ofs64_ofs + 8ULL * in->nofs64 > st.st_size)
+    {
+	PyErr_Format(PyExc_ValueError, "%s: index is truncated", filename);
+	close(fd);
+	return 0;
+    }
+    if (st.st_size)
+    {
+	// The mapping doesn't need the fd, so we only ever have one open.
+	in->map = mmap(NULL, st.st_size, PROT_READ, MAP_SHARED, fd, 0);
+	if (in->map == MAP_FAILED)
+	{
+	    in->map = NULL;
+	    PyErr_SetFromErrnoWithFilename(PyExc_IOError, (char *)filename);
+	    close(fd);
+	    return 0;
+	}
+	in->map_len = st.st_size;
+    }
+    close(fd);
+    in->shas = in->map + sha_ofs;
+    in->names = name_ofs ? in->map + name_ofs : NULL;
+    in->crcs = in->map + crc_ofs;
+    in->ofs = in->map + ofs_ofs;
+    in->ofs64 = in->map + ofs64_ofs;
+    return 1;
+}
 
-    if (!bup_uint_from_py(&total, py_total, "total"))
-        return NULL;
+
+static PyObject *write_midx_range(PyObject *self, PyObject *args)
+{
+    PyObject *ilist = NULL, *result = NULL;
+    struct midx_input *inputs = NULL, **heap = NULL;
+    struct midx_outbuf *outs = NULL;
+    uint32_t *fanout = NULL;
+    unsigned long long total = 0, ofs64_total = 0, row = 0, ofs64_row = 0;
+    unsigned long long count = 0, want = 0, ofs_base;
+    unsigned int lo = 0, hi = 0;
+    uint32_t prefix;
+    int fd = -1, bits = 0, num_i = 0, heap_len = 0, i;
+    enum { SHAS, NAMES, CRCS, OFS, OFS64, NUM_OUTS };
+
+    if (!PyArg_ParseTuple(args, "iiIIO!", &fd, &bits, &lo, &hi,
+			  &PyList_Type, &ilist))
+	return NULL;
+    if (bits < 0 || bits > 30 || lo > hi || hi > (1U << bits))
+	return PyErr_Format(PyExc_ValueError, "invalid midx prefix range");
 
     num_i = PyList_Size(ilist);
-    idxs = (struct idx **)PyMem_Malloc(num_i * sizeof(struct idx *));
+    inputs = PyMem_Malloc((num_i ? num_i : 1) * sizeof(*inputs));
+    heap = PyMem_Malloc((num_i ? num_i : 1) * sizeof(*heap));
+    outs = PyMem_Malloc(NUM_OUTS * sizeof(*outs));
+    fanout = PyMem_Malloc(((hi - lo) ? (hi - lo) : 1) * sizeof(*fanout));
+    if (!inputs || !heap || !outs || !fanout)
+    {
+	PyErr_NoMemory();
+	goto done;
+    }
+    memset(inputs, 0, (num_i ? num_i : 1) * sizeof(*inputs));
 
     for (i = 0; i < num_i; i++)
     {
-	long len, sha_ofs, name_map_ofs;
-	idxs[i] = (struct idx *)PyMem_Malloc(sizeof(struct idx));
-	PyObject *itup = PyList_GetItem(ilist, i);
-	if (!PyArg_ParseTuple(itup, "t#llli", &idxs[i]->map, &idxs[i]->bytes,
-		    &len, &sha_ofs, &name_map_ofs, &idxs[i]->name_base))
-	    return NULL;
-	idxs[i]->cur = (struct sha *)&idxs[i]->map[sha_ofs];
-	idxs[i]->end = &idxs[i]->cur[len];
-	if (name_map_ofs)
-	    idxs[i]->cur_name = (uint32_t *)&idxs[i]->map[name_map_ofs];
-	else
-	    idxs[i]->cur_name = NULL;
+	struct midx_input *in = &inputs[i];
+	const char *filename;
+	unsigned long long n, sha_ofs, name_ofs, name_base, crc_ofs, ofs_ofs;
+	unsigned long long ofs64_ofs, nofs64;
+	if (!PyArg_ParseTuple(PyList_GetItem(ilist, i), "sKKKKKKKK",
+			      &filename, &n, &sha_ofs, &name_ofs, &name_base,
+			      &crc_ofs, &ofs_ofs, &ofs64_ofs, &nofs64))
+	    goto done;
+	if (n > 0xffffffff || nofs64 > 0x7fffffff || name_base > 0xffffffff)
+	{
+	    PyErr_Format(PyExc_ValueError, "%s: index is too large", filename);
+	    goto done;
+	}
+	in->i = i;
+	in->n = n;
+	in->nofs64 = nofs64;
+	in->name_base = name_base;
+	if (!_midx_map_input(in, filename, sha_ofs, name_ofs,
+			     crc_ofs, ofs_ofs, ofs64_ofs))
+	    goto done;
+	total += n;
+	ofs64_total += nofs64;
+
+	// Where this range starts in the output is the sum of where it
+	// starts in each input, and likewise for the 64-bit offsets.
+	in->cur = _midx_lower_bound(in, lo, bits);
+	in->end = hi == (1U << bits) ? in->n : _midx_lower_bound(in, hi, bits);
+	row += in->cur;
+	want += in->end - in->cur;
+	if (in->nofs64)
+	{
+	    uint32_t j;
+	    for (j = 0; j < in->cur; j++)
+		if (in->ofs[4 * j] & 0x80)
+		    ++ofs64_row;
+	}
+	if (in->cur < in->end)
+	    heap[heap_len++] = in;
+    }
+    if (total > 0xffffffff)
+    {
+	PyErr_Format(PyExc_ValueError, "too many objects for one midx");
+	goto done;
     }
-    table_ptr = (uint32_t *)&fmap[MIDX4_HEADERLEN];
-    sha_start = sha_ptr = (struct sha *)&table_ptr[1<<bits];
-    name_start = name_ptr = (uint32_t *)&sha_ptr[total];
 
-    last_i = num_i-1;
-    count = 0;
-    prefix = 0;
-    while (last_i >= 0)
+    ofs_base = MIDX5_HEADERLEN + 4ULL * (1U << bits);
+    outs[SHAS].pos = ofs_base + 20 * row;
+    ofs_base += 20 * total;
+    outs[NAMES].pos = ofs_base + 4 * row;
+    ofs_base += 4 * total;
+    outs[CRCS].pos = ofs_base + 4 * row;
+    ofs_base += 4 * total;
+    outs[OFS].pos = ofs_base + 4 * row;
+    ofs_base += 4 * total;
+    outs[OFS64].pos = ofs_base + 8 * ofs64_row;
+    for (i = 0; i < NUM_OUTS; i++)
+	outs[i].len = 0;
+
+    for (i = heap_len / 2 - 1; i >= 0; i--)
+	_midx_heap_down(heap, heap_len, i);
+
+    prefix = lo;
+    while (heap_len)
     {
-	struct idx *idx;
-	uint32_t new_prefix;
-	if (count % 102424 == 0 && istty2)
-	    fprintf(stderr, "midx: writing %.2f%% (%d/%d)\r",
-		    count*100.0/total, count, total);
-	idx = idxs[last_i];
-	new_prefix = _extract_bits((unsigned char *)idx->cur, bits);
+	struct midx_input *in = heap[0];
+	const unsigned char *sha = in->shas + 20 * in->cur;
+	uint32_t new_prefix = _midx_prefix(sha, bits), name, ofs;
+	if (count % 102424 == 0 && istty2 && lo == 0)
+	    fprintf(stderr, "midx: writing %.2f%% (%llu/%llu)\r",
+		    count * 100.0 / want, count, want);
 	while (prefix < new_prefix)
-	    table_ptr[prefix++] = htonl(count);
-	memcpy(sha_ptr++, idx->cur, sizeof(struct sha));
-	*name_ptr++ = htonl(_get_idx_i(idx));
-	++idx->cur;
-	if (idx->cur_name != NULL)
-	    ++idx->cur_name;
-	_fix_idx_order(idxs, &last_i);
+	    fanout[prefix++ - lo] = htonl(row + count);
+	name = in->name_base;
+	if (in->names)
+	    name += ntohl(*(uint32_t *)(in->names + 4 * in->cur));
+	name = htonl(name);
+	ofs = ntohl(*(uint32_t *)(in->ofs + 4 * in->cur));
+	if (ofs & 0x80000000)
+	{
+	    unsigned char ofs64[8];
+	    if ((ofs & 0x7fffffff) >= in->nofs64)
+	    {
+		PyErr_Format(PyExc_ValueError,
+			     "index %d has an invalid 64-bit offset", in->i);
+		goto done;
+	    }
+	    _put_be64(ofs64, _get_be64(in->ofs64 + 8 * (ofs & 0x7fffffff)));
+	    if (_midx_put(fd, &outs[OFS64], ofs64, 8) == -1)
+		goto write_failed;
+	    ofs = 0x80000000 | ofs64_row++;
+	}
+	ofs = htonl(ofs);
+	if (_midx_put(fd, &outs[SHAS], sha, 20) == -1
+	    || _midx_put(fd, &outs[NAMES], &name, 4) == -1
+	    || _midx_put(fd, &outs[CRCS], in->crcs + 4 * in->cur, 4) == -1
+	    || _midx_put(fd, &outs[OFS], &ofs, 4) == -1)
+	    goto write_failed;
 	++count;
+	if (++in->cur == in->end)
+	    heap[0] = heap[--heap_len];
+	_midx_heap_down(heap, heap_len, 0);
     }
-    while (prefix < (1<<bits))
-	table_ptr[prefix++] = htonl(count);
-    assert(count == total);
-    assert(prefix == (1<<bits));
-    assert(sha_ptr == sha_start+count);
-    assert(name_ptr == name_start+count);
-
-    PyMem_Free(idxs);
-    return PyLong_FromUnsignedLong(count);
+    while (prefix < hi)
+	fanout[prefix++ - lo] = htonl(row + count);
+    assert(count == want);
+
+    for (i = 0; i < NUM_OUTS; i++)
+	if (_midx_flush(fd, &outs[i]) == -1)
+	    goto write_failed;
+    outs[0].pos = MIDX5_HEADERLEN + 4ULL * lo;
+    outs[0].len = 0;
+    for (prefix = lo; prefix < hi; prefix += MIDX_OUTBUF_SIZE / 4)
+    {
+	size_t n = hi - prefix < MIDX_OUTBUF_SIZE / 4 ?
+	    hi - prefix : MIDX_OUTBUF_SIZE / 4;
+	if (_midx_put(fd, &outs[0], &fanout[prefix - lo], 4 * n) == -1
+	    || _midx_flush(fd, &outs[0]) == -1)
+	    goto write_failed;
+    }
+    result = PyLong_FromUnsignedLongLong(count);
+    goto done;
+
+ write_failed:
+    PyErr_SetFromErrno(PyExc_IOError);
+ done:
+    if (inputs)
+	for (i = 0; i < num_i; i++)
+	    if (inputs[i].map)
+		munmap(inputs[i].map, inputs[i].map_len);
+    PyMem_Free(inputs);
+    PyMem_Free(heap);
+    PyMem_Free(outs);
+    PyMem_Free(fanout);
+    return result;
+}
+
+static int _cmp_sha_ptrs(const void *a, const void *b)
+{
+    return memcmp(*(const unsigned char **)a, *(const unsigned char **)b, 20);
+}
+
+static PyObject *sorted_exists_many(PyObject *self, PyObject *args)
+{
+    unsigned char *table = NULL, *shas = NULL, *bitmap;
+    const unsigned char **sorted = NULL;
+    Py_ssize_t tlen = 0, len = 0, n, i, lo, hi, mid, step, nrec, pos;
+    int stride = 0, ofs = 0, want_pos = 0, c;
+    PyObject *result = NULL, *positions = NULL, *item;
+
+    if (!PyArg_ParseTuple(args, "t#iit#i", &table, &tlen, &stride, &ofs,
+			  &shas, &len, &want_pos))
+	return NULL;
+    if (stride < 20 || ofs < 0 || ofs + 20 > stride)
+	return PyErr_Format(PyExc_ValueError, "invalid table record layout");
+    if (len % 20 != 0)
+	return PyErr_Format(PyExc_ValueError, "shas length is not a multiple of 20");
+
+    nrec = tlen / stride;
+    n = len / 20;
+    result = PyString_FromStringAndSize(NULL, (n + 7) / 8);
+    if (!result)
+	return NULL;
+    bitmap = (unsigned char *)PyString_AS_STRING(result);
+    memset(bitmap, 0, (n + 7) / 8);
+    if (want_pos)
+    {
+	positions = PyList_New(n);
+	if (!positions)
+	    goto fail;
+	for (i = 0; i < n; i++)
+	{
+	    Py_INCREF(Py_None);
+	    PyList_SET_ITEM(positions, i, Py_None);
+	}
+    }
+
+    sorted = PyMem_Malloc((n ? n : 1) * sizeof(*sorted));
+    if (!sorted)
+    {
+	PyErr_NoMemory();
+	goto fail;
+    }
+    for (i = 0; i < n; i++)
+	sorted[i] = shas + i * 20;
+    qsort(sorted, n, sizeof(*sorted), _cmp_sha_ptrs);
+
+    // Merge the sorted shas with the table, galloping ahead from the
+    // last match, since there may be far fewer shas than records.
+    lo = 0;
+    for (i = 0; i < n && lo < nrec; i++)
+    {
+	hi = lo;
+	step = 1;
+	while (hi < nrec && memcmp(table + hi * stride + ofs, sorted[i], 20) < 0)
+	{
+	    lo = hi + 1;
+	    hi += step;
+	    step *= 2;
+	}
+	if (hi > nrec)
+	    hi = nrec;
+	while (lo < hi)
+	{
+	    mid = lo + (hi - lo) / 2;
+	    if (memcmp(table + mid * stride + ofs, sorted[i], 20) < 0)
+		lo = mid + 1;
+	    else
+		hi = mid;
+	}
+	if (lo >= nrec)
+	    break;
+	c = memcmp(table + lo * stride + ofs, sorted[i], 20);
+	if (c == 0)
+	{
+	    pos = (sorted[i] - shas) / 20;
+	    bitmap[pos >> 3] |= 1 << (pos & 0x7);
+	    if (positions)
+	    {
+		item = PyInt_FromSsize_t(lo);
+		if (!item)
+		    goto fail;
+		PyList_SetItem(positions, pos, item);
+	    }
+	}
+    }
+    PyMem_Free(sorted);
+    if (positions)
+	return Py_BuildValue("NN", result, positions);
+    return result;
+
+ fail:
+    PyMem_Free(sorted);
+    Py_XDECREF(result);
+    Py_XDECREF(positions);
+    return NULL;
+}
+
+
+static PyObject *bitmap_count(PyObject *self, PyObject *args)
+{
+    unsigned char *bitmap = NULL;
+    Py_ssize_t len = 0, i, count = 0;
+    unsigned char b;
+
+    if (!PyArg_ParseTuple(args, "t#", &bitmap, &len))
+	return NULL;
+    for (i = 0; i < len; i++)
+	for (b = bitmap[i]; b; b &= b - 1)
+	    count++;
+    return PyInt_FromSsize_t(count);
 }
 
 #define FAN_ENTRIES 256
@@ -1066,6 +1541,96 @@ static PyObject *fadvise_done(PyObject *self, PyObject *args)
 }
 
 
+static PyObject *fadvise_willneed(PyObject *self, PyObject *args)
+{
+    int fd = -1;
+    long long llofs, lllen = 0;
+    if (!PyArg_ParseTuple(args, "iLL", &fd, &llofs, &lllen))
+	return NULL;
+    off_t ofs, len;
+    if (!INTEGRAL_ASSIGNMENT_FITS(&ofs, llofs))
+        return PyErr_Format(PyExc_OverflowError,
+                            "fadvise offset overflows off_t");
+    if (!INTEGRAL_ASSIGNMENT_FITS(&len, lllen))
+        return PyErr_Format(PyExc_OverflowError,
+                            "fadvise length overflows off_t");
+#ifdef POSIX_FADV_WILLNEED
+    posix_fadvise(fd, ofs, len, POSIX_FADV_WILLNEED);
+#endif
+    return Py_BuildValue("");
+}
+
+
+#ifdef HAVE_MADVISE
+static PyObject *bup_madvise(PyObject *self, PyObject *args)
+{
+    const char *buf;
+    Py_ssize_t buf_len;
+    PyObject *py_ofs, *py_len;
+    int advice;
+    if (!PyArg_ParseTuple(args, "s#OOi", &buf, &buf_len, &py_ofs, &py_len,
+                          &advice))
+	return NULL;
+
+    unsigned long long ofs, len, end, size;
+    if (!(bup_ullong_from_py(&ofs, py_ofs, "ofs")
+          && bup_ullong_from_py(&len, py_len, "len")))
+        return NULL;
+    if (!INTEGRAL_ASSIGNMENT_FITS(&size, buf_len))
+        return PyErr_Format(PyExc_OverflowError, "invalid buf size");
+    if (!uadd(&end, ofs, len))
+        return PyErr_Format(PyExc_OverflowError, "(ofs + len) too large");
+    if (end > size)
+        return PyErr_Format(PyExc_OverflowError, "region runs off end of buf");
+    size_t length;
+    if (!INTEGRAL_ASSIGNMENT_FITS(&length, len))
+        return PyErr_Format(PyExc_OverflowError, "len overflows size_t");
+    if (madvise((void *)(buf + ofs), length, advice) != 0)
+        return PyErr_SetFromErrno(PyExc_OSError);
+    return Py_BuildValue("O", Py_None);
+}
+#endif /* def HAVE_MADVISE */
+
+
+#ifdef HAVE_SYS_INOTIFY_H
+static PyObject *bup_inotify_init(PyObject *self, PyObject *args)
+{
+    int fd;
+    if (!PyArg_ParseTuple(args, ""))
+	return NULL;
+    fd = inotify_init();
+    if (fd < 0)
+	return PyErr_SetFromErrno(PyExc_OSError);
+    return Py_BuildValue("i", fd);
+}
+
+
+static PyObject *bup_inotify_add_watch(PyObject *self, PyObject *args)
+{
+    int fd, wd;
+    char *path;
+    unsigned int mask;
+    if (!PyArg_ParseTuple(args, "isI", &fd, &path, &mask))
+	return NULL;
+    wd = inotify_add_watch(fd, path, mask);
+    if (wd < 0)
+	return PyErr_SetFromErrnoWithFilename(PyExc_OSError, path);
+    return Py_BuildValue("i", wd);
+}
+
+
+static PyObject *bup_inotify_rm_watch(PyObject *self, PyObject *args)
+{
+    int fd, wd;
+    if (!PyArg_ParseTuple(args, "ii", &fd, &wd))
+	return NULL;
+    if (inotify_rm_watch(fd, wd) < 0)
+	return PyErr_SetFromErrno(PyExc_OSError);
+    return Py_BuildValue("");
+}
+#endif /* def HAVE_SYS_INOTIFY_H */
+
+
 // Currently the Linux kernel and FUSE disagree over the type for
 // FS_IOC_GETFLAGS and FS_IOC_SETFLAGS.  The kernel actually uses int,
 // but FUSE chose long (matching the declaration in linux/fs.h).  So
@@ -1490,6 +2055,8 @@ static PyMethodDef helper_methods[] = {
 	"Return the number of bits in the rolling checksum." },
     { "splitbuf", splitbuf, METH_VARARGS,
 	"Split a list of strings based on a rolling checksum." },
+    { "fastcdc_splitbuf", fastcdc_splitbuf, METH_VARARGS,
+	"Split a list of strings based on a FastCDC gear hash." },
     { "bitmatch", bitmatch, METH_VARARGS,
 	"Count the number of matching prefix bits between two strings." },
     { "firstword", firstword, METH_VARARGS,
@@ -1498,10 +2065,20 @@ static PyMethodDef helper_methods[] = {
 	"Check if a bloom filter of 2^nbits bytes contains an object" },
     { "bloom_add", bloom_add, METH_VARARGS,
 	"Add an object to a bloom filter of 2^nbits bytes" },
+    { "bloom_exists_many", bloom_exists_many, METH_VARARGS,
+	"Return a bitmap of the shas a bloom filter (probably) contains" },
+    { "blocked_bloom_contains", blocked_bloom_contains, METH_VARARGS,
+	"Check if a blocked bloom filter of 2^nbits bytes contains an object" },
+    { "blocked_bloom_add", blocked_bloom_add, METH_VARARGS,
+	"Add objects to a blocked bloom filter of 2^nbits bytes" },
     { "extract_bits", extract_bits, METH_VARARGS,
 	"Take the first 'nbits' bits from 'buf' and return them as an int." },
-    { "merge_into", merge_into, METH_VARARGS,
-	"Merges a bunch of idx and midx files into a single midx." },
+    { "sorted_exists_many", sorted_exists_many, METH_VARARGS,
+	"Return a bitmap of the shas that are in a sorted table of records" },
+    { "bitmap_count", bitmap_count, METH_VARARGS,
+	"Return the number of bits set in a bitmap" },
+    { "write_midx_range", write_midx_range, METH_VARARGS,
+	"Merge the given prefix range of idx and midx files into a midx file." },
     { "write_idx", write_idx, METH_VARARGS,
 	"Write a PackIdxV2 file from an idx list of lists of tuples" },
     { "write_random", write_random, METH_VARARGS,
@@ -1512,6 +2089,12 @@ static PyMethodDef helper_methods[] = {
 	"open() the given filename for read with O_NOATIME if possible" },
     { "fadvise_done", fadvise_done, METH_VARARGS,
 	"Inform the kernel that we're finished with earlier parts of a file" },
+    { "fadvise_willneed", fadvise_willneed, METH_VARARGS,
+	"Ask the kernel to start reading part of a file into the page cache" },
+#ifdef HAVE_MADVISE
+    { "madvise", bup_madvise, METH_VARARGS,
+      "madvise(buf, ofs, len, advice) for the region of a memory mapping" },
+#endif
 #ifdef BUP_HAVE_FILE_ATTRS
     { "get_linux_file_attr", bup_get_linux_file_attr, METH_VARARGS,
       "Return the Linux attributes for the given file." },
@@ -1543,6 +2126,14 @@ static PyMethodDef helper_methods[] = {
     { "localtime", bup_localtime, METH_VARARGS,
       "Return struct_time elements plus the timezone offset and name." },
 #endif
+#ifdef HAVE_SYS_INOTIFY_H
+    { "inotify_init", bup_inotify_init, METH_VARARGS,
+      "Return a new inotify file descriptor." },
+    { "inotify_add_watch", bup_inotify_add_watch, METH_VARARGS,
+      "Watch path for the events in mask and return the watch descriptor." },
+    { "inotify_rm_watch", bup_inotify_rm_watch, METH_VARARGS,
+      "Remove the given watch descriptor." },
+#endif
 #ifdef BUP_MINCORE_BUF_TYPE
     { "mincore", bup_mincore, METH_VARARGS,
       "For mincore(src, src_n, src_off, dest, dest_off)"
@@ -1613,6 +2204,44 @@ PyMODINIT_FUNC init_helpers(void)
         Py_DECREF(value);
     }
 #endif
+#ifdef HAVE_MADVISE
+    {
+        PyObject *value;
+        value = INTEGER_TO_PY(MADV_SEQUENTIAL);
+        PyObject_SetAttrString(m, "MADV_SEQUENTIAL", value);
+        Py_DECREF(value);
+        value = INTEGER_TO_PY(MADV_DONTNEED);
+        PyObject_SetAttrString(m, "MADV_DONTNEED", value);
+        Py_DECREF(value);
+    }
+#endif
+#ifdef HAVE_SYS_INOTIFY_H
+    {
+        const struct { const char *name; unsigned int value; } in_flags[] = {
+            { "IN_MODIFY", IN_MODIFY },
+            { "IN_ATTRIB", IN_ATTRIB },
+            { "IN_MOVED_FROM", IN_MOVED_FROM },
+            { "IN_MOVED_TO", IN_MOVED_TO },
+            { "IN_CREATE", IN_CREATE },
+            { "IN_DELETE", IN_DELETE },
+            { "IN_DELETE_SELF", IN_DELETE_SELF },
+            { "IN_MOVE_SELF", IN_MOVE_SELF },
+            { "IN_Q_OVERFLOW", IN_Q_OVERFLOW },
+            { "IN_IGNORED", IN_IGNORED },
+            { "IN_ISDIR", IN_ISDIR },
+            { "IN_ONLYDIR", IN_ONLYDIR },
+            { "IN_DONT_FOLLOW", IN_DONT_FOLLOW },
+            { NULL, 0 }
+        };
+        int i;
+        for (i = 0; in_flags[i].name; i++)
+        {
+            PyObject *value = INTEGER_TO_PY(in_flags[i].value);
+            PyObject_SetAttrString(m, in_flags[i].name, value);
+            Py_DECREF(value);
+        }
+    }
+#endif
 #pragma clang diagnostic pop  // ignored "-Wtautological-compare"
 
     e = getenv("BUP_FORCE_TTY");
@@ -78,16 +78,27 @@ table with k=5 can represent the repository.
 None of this tells us what max_pfalse_positive to choose.
 
 Brandon Low <lostlogic@lostlogicx.com> 2011-02-04
+
+Since the k bits for an entry are spread over the whole filter, a
+lookup in a filter that isn't in the page cache may fault in k
+different pages.  So there's also a "blocked" format (version 3),
+which puts all of the k bits for an entry in the same 64-byte block
+(one cache line), chosen by the first bits of the SHA, and addresses
+the bits within the block with 9 bits from each of the next k 16-bit
+words.  That costs a somewhat higher pfalse_positive for a given size
+(the blocks don't fill evenly), but each lookup touches one page.
 """
 
 import sys, os, math, mmap, struct
 
 from bup import _helpers
 from bup.helpers import (debug1, debug2, log, mmap_read, mmap_readwrite,
-                         mmap_readwrite_private, unlink)
+                         mmap_readwrite_private, progress, qprogress, unlink)
 
 
 BLOOM_VERSION = 2
+BLOCKED_BLOOM_VERSION = 3
+BLOOM_BLOCK_BITS = 6 # log2 of the block size in bytes
 MAX_BITS_EACH = 32 # Kinda arbitrary, but 4 bytes per entry is pretty big
 MAX_BLOOM_BITS = {4: 37, 5: 29} # 160/k-log2(8)
 MAX_PFALSE_POSITIVE = 1. # Totally arbitrary, needs benchmarking
@@ -97,6 +108,9 @@ _total_steps = 0
 
 bloom_contains = _helpers.bloom_contains
 bloom_add = _helpers.bloom_add
+bloom_exists_many = _helpers.bloom_exists_many
+blocked_bloom_contains = _helpers.blocked_bloom_contains
+blocked_bloom_add = _helpers.blocked_bloom_add
 
 # FIXME: check bloom create() and ShaBloom handling/ownership of "f".
 # The ownership semantics should be clarified since the caller needs
@@ -113,6 +127,8 @@ class ShaBloom:
             assert(expected > 0)
             self.rwfile = f = f or open(filename, 'r+b')
             f.seek(0)
+            hdr = f.read(8)
+            f.seek(0)
 
             # Decide if we want to mmap() the pages as writable ('immediate'
             # write) or else map them privately for later writing back to
@@ -130,7 +146,9 @@ class ShaBloom:
             # one bit flipped per memory page), let's use a "private" mmap,
             # which defeats Linux's ability to flush it to disk.  Then we'll
             # flush it as one big lump during close().
-            pages = os.fstat(f.fileno()).st_size / 4096 * 5 # assume k=5
+            pages = os.fstat(f.fileno()).st_size / 4096
+            if hdr[4:] != struct.pack('!I', BLOCKED_BLOOM_VERSION):
+                pages *= 5 # assume k=5
             self.delaywrite = expected > pages
             debug1('bloom: delaywrite=%r\n' % self.delaywrite)
             if self.delaywrite:
@@ -150,11 +168,12 @@ class ShaBloom:
             log('Warning: ignoring old-style (v%d) bloom %r\n' 
                 % (ver, filename))
             return self._init_failed()
-        if ver > BLOOM_VERSION:
+        if ver > BLOCKED_BLOOM_VERSION:
             log('Warning: ignoring too-new (v%d) bloom %r\n'
                 % (ver, filename))
             return self._init_failed()
 
+        self.blocked = (ver == BLOCKED_BLOOM_VERSION)
         self.bits, self.k, self.entries = struct.unpack('!HHI', self.map[8:16])
         idxnamestr = str(self.map[16 + 2**self.bits:])
         if idxnamestr:
@@ -170,6 +189,7 @@ class ShaBloom:
             self.rwfile = None
         self.idxnames = []
         self.bits = self.entries = 0
+        self.blocked = False
 
     def valid(self):
         return self.map and self.bits
@@ -195,13 +215,25 @@ class ShaBloom:
         n = self.entries + additional
         m = 8*2**self.bits
         k = self.k
-        return 100*(1-math.exp(-k*float(n)/m))**k
+        if not self.blocked:
+            return 100*(1-math.exp(-k*float(n)/m))**k
+        # The number of entries in each block is (roughly) Poisson
+        # distributed, so average the pfalse_positive of a block over that.
+        block = 8*2**BLOOM_BLOCK_BITS
+        lam = float(n)*block/m
+        p = math.exp(-lam)
+        total = 0.
+        for i in xrange(int(lam + 10*math.sqrt(lam) + 10)):
+            total += p*(1-(1-1./block)**(k*i))**k
+            p *= lam/(i+1)
+        return 100*total
 
     def add(self, ids):
         """Add the hashes in ids (packed binary 20-bytes) to the filter."""
         if not self.map:
             raise Exception("Cannot add to closed bloom")
-        self.entries += bloom_add(self.map, ids, self.bits, self.k)
+        add = self.blocked and blocked_bloom_add or bloom_add
+        self.entries += add(self.map, ids, self.bits, self.k)
 
     def add_idx(self, ix):
         """Add the object to the filter."""
@@ -219,25 +251,46 @@ class ShaBloom:
         _total_searches += 1
         if not self.map:
             return None
-        found, steps = bloom_contains(self.map, str(sha), self.bits, self.k)
+        contains = self.blocked and blocked_bloom_contains or bloom_contains
+        found, steps = contains(self.map, str(sha), self.bits, self.k)
         _total_steps += steps
         return found
 
+    def exists_many(self, shas):
+        """Return a bitmap (see helpers.bitmap_isset()) of which of
+        shas, a string of packed 20-byte hashes, probably exist in the
+        bloom filter (see exists())."""
+        if not self.map:
+            return '\0' * ((len(shas) // 20 + 7) // 8)
+        return bloom_exists_many(self.map, shas, self.bits, self.k,
+                                 self.blocked)
+
     def __len__(self):
         return int(self.entries)
 
 
-def create(name, expected, delaywrite=None, f=None, k=None):
-    """Create and return a bloom filter for `expected` entries."""
+def create(name, expected, delaywrite=None, f=None, k=None, blocked=False):
+    """Create and return a bloom filter for `expected` entries, in the
+    blocked format if blocked is true."""
     bits = int(math.floor(math.log(expected*MAX_BITS_EACH/8,2)))
-    k = k or ((bits <= MAX_BLOOM_BITS[5]) and 5 or 4)
-    if bits > MAX_BLOOM_BITS[k]:
+    if blocked:
+        # The block is addressed by (at most) the first 32 bits of the SHA.
+        k = k or 5
+        max_bits = 32 + BLOOM_BLOCK_BITS
+        bits = max(bits, BLOOM_BLOCK_BITS)
+    else:
+        k = k or ((bits <= MAX_BLOOM_BITS[5]) and 5 or 4)
+        max_bits = MAX_BLOOM_BITS[k]
+    if bits > max_bits:
         log('bloom: warning, max bits exceeded, non-optimal\n')
-        bits = MAX_BLOOM_BITS[k]
-    debug1('bloom: using 2^%d bytes and %d hash functions\n' % (bits, k))
+        bits = max_bits
+    debug1('bloom: using 2^%d bytes and %d hash functions%s\n'
+           % (bits, k, blocked and ' in blocks' or ''))
     f = f or open(name, 'w+b')
     f.write('BLOM')
-    f.write(struct.pack('!IHHI', BLOOM_VERSION, bits, k, 0))
+    f.write(struct.pack('!IHHI',
+                        blocked and BLOCKED_BLOOM_VERSION or BLOOM_VERSION,
+                        bits, k, 0))
     assert(f.tell() == 16)
     # NOTE: On some systems this will not extend+zerofill, but it does on
     # darwin, linux, bsd and solaris.
@@ -249,5 +302,89 @@ def create(name, expected, delaywrite=None, f=None, k=None):
     return ShaBloom(name, f=f, readwrite=True, expected=expected)
 
 
+def update(path, outfilename=None, k=None, force=False, blocked=False,
+           prefix=''):
+    """Add the objects in the idx files in path that aren't in the
+    bloom filter outfilename (by default, path/bup.bloom) yet, or
+    regenerate it if it's invalid, or if there are too many of them
+    (or with force).  Generate it in the blocked format if blocked is
+    true, or else keep the format of the existing filter."""
+    from bup import git
+    outfilename = outfilename or os.path.join(path, 'bup.bloom')
+    b = None
+    if os.path.exists(outfilename) and not force:
+        b = ShaBloom(outfilename)
+        if not b.valid():
+            debug1("bloom: Existing invalid bloom found, regenerating.\n")
+            b = None
+        elif blocked and not b.blocked:
+            debug1("bloom: regenerating in the blocked format.\n")
+            b = None
+        else:
+            # Keep the existing format when regenerating.
+            blocked = blocked or b.blocked
+
+    add = []
+    rest = []
+    add_count = 0
+    rest_count = 0
+    for name, count in git.idx_counts(path).iteritems():
+        ixbase = os.path.basename(name)
+        if b and (ixbase in b.idxnames):
+            rest.append(name)
+            rest_count += count
+        else:
+            add.append(name)
+            add_count += count
+
+    if not add:
+        debug1("bloom: nothing to do.\n")
+        return
+
+    if b:
+        if len(b) != rest_count:
+            debug1("bloom: size %d != idx total %d, regenerating\n"
+                   % (len(b), rest_count))
+            b = None
+        elif (b.bits < MAX_BLOOM_BITS and
+              b.pfalse_positive(add_count) > MAX_PFALSE_POSITIVE):
+            debug1("bloom: regenerating: adding %d entries gives "
+                   "%.2f%% false positives.\n"
+                   % (add_count, b.pfalse_positive(add_count)))
+            b = None
+        else:
+            b = ShaBloom(outfilename, readwrite=True, expected=add_count)
+    if not b: # Need all idxs to build from scratch
+        add += rest
+        add_count += rest_count
+    del rest
+    del rest_count
+
+    msg = b is None and 'creating from' or 'adding'
+    progress('bloom: %s%s %d file%s (%d object%s).\r'
+        % (prefix, msg,
+           len(add), len(add)!=1 and 's' or '',
+           add_count, add_count!=1 and 's' or ''))
+
+    tfname = None
+    if b is None:
+        tfname = os.path.join(path, 'bup.tmp.bloom')
+        b = create(tfname, expected=add_count, k=k, blocked=blocked)
+    icount = 0
+    for name in add:
+        ix = git.open_idx(name)
+        qprogress('bloom: writing %.2f%% (%d/%d objects)\r'
+                  % (icount*100.0/add_count, icount, add_count))
+        b.add_idx(ix)
+        icount += len(ix)
+
+    # Currently, there's an open file object for tfname inside b.
+    # Make sure it's closed before rename.
+    b.close()
+
+    if tfname:
+        os.rename(tfname, outfilename)
+
+
 def clear_bloom(dir):
     unlink(os.path.join(dir, 'bup.bloom'))
@@ -116,6 +116,76 @@ int bupsplit_find_ofs(const unsigned char *buf, int len, int *bits)
 }
 
 
+// FastCDC (Xia et al., "FastCDC: a Fast and Efficient Content-Defined
+// Chunking Approach for Data Deduplication", USENIX ATC 2016): a
+// "gear" hash, which only needs a shift and an add per byte, checked
+// against a stricter mask before BUP_BLOBSIZE and a looser one after.
+// The high bits of the hash depend on the last 32 bytes.
+//
+// The gear table is generated from a fixed seed, and must never
+// change, or existing repositories that use this chunker would stop
+// deduplicating against new data.
+static uint32_t gear[256];
+static int gear_ready = 0;
+
+static void gear_init(void)
+{
+    uint32_t x = 0x6275703f; // "bup?"
+    int i;
+    for (i = 0; i < 256; i++)
+    {
+	// xorshift32
+	x ^= x << 13;
+	x ^= x >> 17;
+	x ^= x << 5;
+	gear[i] = x;
+    }
+    gear_ready = 1;
+}
+
+
+#define FASTCDC_MASK(n) ((uint32_t)(~0U << (32 - (n))))
+
+int bupsplit_fastcdc_find_ofs(const unsigned char *buf, int len, int *bits)
+{
+    const uint32_t mask_s = FASTCDC_MASK(BUP_FASTCDC_SMALLBITS);
+    const uint32_t mask_l = FASTCDC_MASK(BUP_FASTCDC_LARGEBITS);
+    const int normal = len < BUP_BLOBSIZE ? len : BUP_BLOBSIZE;
+    uint32_t h = 0;
+    int count;
+
+    if (!gear_ready)
+	gear_init();
+    // No cut can happen within the minimum chunk size, so skip it.
+    for (count = BUP_FASTCDC_MIN; count < normal; count++)
+    {
+	h = (h << 1) + gear[buf[count]];
+	if (!(h & mask_s))
+	    goto found;
+    }
+    for (; count < len; count++)
+    {
+	h = (h << 1) + gear[buf[count]];
+	if (!(h & mask_l))
+	    goto found;
+    }
+    return 0;
+
+ found:
+    if (bits)
+    {
+	// Report the number of leading zero bits (like the number of
+	// trailing one bits of the rollsum), so the fanout works the
+	// same way.
+	for (*bits = 0; *bits < 32 && !(h & (0x80000000U >> *bits)); (*bits)++)
+	    ;
+	if (*bits < BUP_BLOBBITS)
+	    *bits = BUP_BLOBBITS;
+    }
+    return count+1;
+}
+
+
 #ifndef BUP_NO_SELFTEST
 #define BUP_SELFTEST_SIZE 100000
 
@@ -35,11 +35,19 @@
 #define BUP_WINDOWBITS (6)
 #define BUP_WINDOWSIZE (1<<BUP_WINDOWBITS)
 
+// The FastCDC chunker never cuts within the first BUP_FASTCDC_MIN
+// bytes, and is less likely to cut before BUP_BLOBSIZE bytes than
+// after, so that chunk sizes cluster around BUP_BLOBSIZE.
+#define BUP_FASTCDC_MIN (BUP_BLOBSIZE/4)
+#define BUP_FASTCDC_SMALLBITS (BUP_BLOBBITS+2)
+#define BUP_FASTCDC_LARGEBITS (BUP_BLOBBITS-2)
+
 #ifdef __cplusplus
 extern "C" {
 #endif
     
 int bupsplit_find_ofs(const unsigned char *buf, int len, int *bits);
+int bupsplit_fastcdc_find_ofs(const unsigned char *buf, int len, int *bits);
 int bupsplit_selftest(void);
 
 #ifdef __cplusplus
@@ -58,6 +58,7 @@ def parse_remote(remote):
 class Client:
     def __init__(self, remote, create=False):
         self._busy = self.conn = None
+        self._commands = None
         self.sock = self.p = self.pout = self.pin = None
         is_reverse = os.environ.get('BUP_SERVER_REVERSE')
         if is_reverse:
@@ -238,7 +239,8 @@ class Client:
             self.conn.write('%s\n' % ob)
         return idx
 
-    def new_packwriter(self, compression_level = 1):
+    def new_packwriter(self, compression_level = 1,
+                       skip_incompressible = False):
         self.check_busy()
         def _set_busy():
             self._busy = 'receive-objects-v2'
@@ -249,7 +251,8 @@ class Client:
                                  onopen = _set_busy,
                                  onclose = self._not_busy,
                                  ensure_busy = self.ensure_busy,
-                                 compression_level = compression_level)
+                                 compression_level = compression_level,
+                                 skip_incompressible = skip_incompressible)
 
     def read_ref(self, refname):
         self.check_busy()
@@ -269,6 +272,42 @@ class Client:
                            (oldval or '').encode('hex')))
         self.check_ok()
 
+    def _server_commands(self):
+        """Return the set of commands the server understands."""
+        if self._commands is None:
+            self.check_busy()
+            self.conn.write('help\n')
+            commands = set()
+            def onempty(rl):
+                if rl != 'Commands:':
+                    commands.add(rl.strip())
+            rv = self.conn._check_ok(onempty)
+            if rv:
+                raise ClientError(rv)
+            self._commands = commands
+        return self._commands
+
+    def config_get(self, name):
+        """Return the value of the config option name in the remote
+        repository, or None if it isn't set (or the server is too old
+        to say)."""
+        if 'config-get' not in self._server_commands():
+            return None
+        self.check_busy()
+        self.conn.write('config-get %s\n' % name)
+        r = self.conn.readline().strip()
+        self.check_ok()
+        return r.decode('hex') or None
+
+    def repo_generation(self):
+        """Return the remote repository's generation, as per
+        git.repo_generation(), or None if the server is too old to
+        say."""
+        if 'config-get' not in self._server_commands():
+            return None
+        return git.parse_repo_generation(
+            self.config_get(git.REPO_GENERATION_CONFIG))
+
     def cat(self, id):
         self.check_busy()
         self._busy = 'cat'
@@ -287,8 +326,10 @@ class PackWriter_Remote(git.PackWriter):
     def __init__(self, conn, objcache_maker, suggest_packs,
                  onopen, onclose,
                  ensure_busy,
-                 compression_level=1):
-        git.PackWriter.__init__(self, objcache_maker)
+                 compression_level=1, skip_incompressible=False):
+        git.PackWriter.__init__(self, objcache_maker,
+                                compression_level=compression_level,
+                                skip_incompressible=skip_incompressible)
         self.file = conn
         self.filename = 'remote socket'
         self.suggest_packs = suggest_packs
@@ -0,0 +1,228 @@
+"""Commit graph cache.
+
+Listing the saves on a branch (in the vfs), or rewriting its history
+("bup rm" and "bup prune-older") only needs the first parent, the tree,
+and the author time of each commit on it.  Rather than asking git for
+them every time, bup keeps them in a cache next to the repository
+(i.e. bupcommits) that's only ever appended to: by the PackWriter, for
+the commits it writes, and by git.rev_list() and
+git.get_commit_summary(), for any commits they had to read from the
+repository instead (e.g. ones written by git itself, or by a remote
+client).
+
+The file is a header (magic and version) followed by fixed-size
+records (commit, parent, tree, author_sec, parent_ix, nparents), where
+parent is the id of the first parent (or zeros), and parent_ix is the
+index of its record (or -1 if it wasn't cached yet when the record was
+written).  Records are appended in batches under an exclusive flock(),
+each parent before its children, so that the parent indexes are known.
+A file that doesn't hold a whole number of records (e.g. after a
+crash) is discarded, and the cache is rebuilt as needed.
+"""
+
+import errno, fcntl, os, struct
+from collections import namedtuple
+
+from bup.helpers import debug1, mmap_read
+
+
+COMMITGRAPH_MAGIC = 'BCGR'
+COMMITGRAPH_VERSION = 1
+COMMITGRAPH_HDR = '!4sI'
+COMMITGRAPH_HDRLEN = struct.calcsize(COMMITGRAPH_HDR)
+COMMITGRAPH_REC = '!20s20s20sqiB'
+COMMITGRAPH_RECLEN = struct.calcsize(COMMITGRAPH_REC)
+NO_PARENT = '\0' * 20
+
+# The number of newest records find() checks before indexing them all.
+RECENT = 64
+
+
+Record = namedtuple('Record', ['commit', 'parent', 'tree', 'author_sec',
+                               'parent_ix', 'nparents'])
+
+
+class CommitGraph:
+    def __init__(self, filename):
+        self.filename = filename
+        self._m = None
+        self._n = 0
+        self._size = None
+        self._index = None  # {commit: record index}, built on demand
+        self.refresh()
+
+    def _discard(self):
+        debug1('discarding damaged commit graph %r\n' % self.filename)
+        try:
+            os.unlink(self.filename)
+        except OSError as e:
+            if e.errno not in (errno.ENOENT,
+                               errno.EACCES, errno.EPERM, errno.EROFS):
+                raise
+
+    def refresh(self):
+        """Pick up any records appended since the file was last read."""
+        try:
+            f = open(self.filename, 'rb')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            f = None
+        size, m = 0, None
+        if f:
+            try:
+                # Appends happen under an exclusive lock, so this never
+                # sees a partial one.
+                fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+                size = os.fstat(f.fileno()).st_size
+                if size == self._size:
+                    return
+                if size >= COMMITGRAPH_HDRLEN:
+                    m = mmap_read(f, close=False)
+            finally:
+                # The map holds on to the file (and so the lock).
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                f.close()
+            if size and (not m or (size - COMMITGRAPH_HDRLEN)
+                         % COMMITGRAPH_RECLEN
+                         or struct.unpack_from(COMMITGRAPH_HDR, m)
+                         != (COMMITGRAPH_MAGIC, COMMITGRAPH_VERSION)):
+                self._discard()
+                size, m = 0, None
+        old_n = self._n
+        self._m = m
+        self._size = size
+        self._n = (size - COMMITGRAPH_HDRLEN) // COMMITGRAPH_RECLEN if m else 0
+        if self._index is not None:
+            if self._n < old_n:
+                self._index = None
+            else:
+                for i in xrange(old_n, self._n):
+                    self._index[self._commit(i)] = i
+
+    def __len__(self):
+        return self._n
+
+    def _commit(self, i):
+        ofs = COMMITGRAPH_HDRLEN + i * COMMITGRAPH_RECLEN
+        return self._m[ofs:ofs + 20]
+
+    def get(self, i):
+        """Return the Record at index i."""
+        return Record(*struct.unpack_from(COMMITGRAPH_REC, self._m,
+                                          COMMITGRAPH_HDRLEN
+                                          + i * COMMITGRAPH_RECLEN))
+
+    def find(self, commit):
+        """Return the index of the record for commit, or None."""
+        if self._index is None:
+            # The commit being looked up is usually a recent one.
+            for i in xrange(self._n - 1, max(-1, self._n - 1 - RECENT), -1):
+                if self._commit(i) == commit:
+                    return i
+            self._index = dict((self._commit(i), i) for i in xrange(self._n))
+        return self._index.get(commit)
+
+    def add(self, records):
+        """Append records, (commit, parent, tree, author_sec, nparents)
+        tuples, where parent may be None, skipping the commits that are
+        already cached.  Each parent must either be cached, or precede
+        its children in records."""
+        records = [r for r in records if self.find(r[0]) is None]
+        if not records:
+            return
+        try:
+            fd = os.open(self.filename,
+                         os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+        except OSError as e:
+            # Don't let reading a repository that can't be written
+            # (read-only, someone else's, ...) fail; just don't cache.
+            if e.errno not in (errno.EACCES, errno.EPERM, errno.EROFS):
+                raise
+            debug1('%s: unable to update commit graph: %s\n'
+                   % (self.filename, e))
+            return
+        f = os.fdopen(fd, 'ab')
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            size = os.fstat(f.fileno()).st_size
+            out = []
+            if not size:
+                out.append(struct.pack(COMMITGRAPH_HDR, COMMITGRAPH_MAGIC,
+                                       COMMITGRAPH_VERSION))
+                size = COMMITGRAPH_HDRLEN
+            elif size < COMMITGRAPH_HDRLEN \
+                 or (size - COMMITGRAPH_HDRLEN) % COMMITGRAPH_RECLEN:
+                self._discard()
+                return
+            n = (size - COMMITGRAPH_HDRLEN) // COMMITGRAPH_RECLEN
+            added = {}
+            for commit, parent, tree, author_sec, nparents in records:
+                parent_ix = None
+                if parent:
+                    parent_ix = added.get(parent)
+                    if parent_ix is None:
+                        parent_ix = self.find(parent)
+                if parent_ix is None:
+                    parent_ix = -1
+                out.append(struct.pack(COMMITGRAPH_REC, commit,
+                                       parent or NO_PARENT, tree, author_sec,
+                                       parent_ix, nparents))
+                added[commit] = n
+                n += 1
+            f.write(''.join(out))
+            f.flush()
+        finally:
+            f.close()
+        self.refresh()
+
+    def history(self, tip, read_history):
+        """Return a list of (author_sec, commit) for tip and each of its
+        ancestors, child before parent, or None if any of them has more
+        than one parent.  Where the cached history stops, call
+        read_history(commit); it must return an iterator of (commit,
+        parents, tree, author_sec) tuples for that commit and its
+        ancestors, child before parent.  The ones read are added to
+        the cache."""
+        result = []
+        new = []
+        missing = None
+        commit, i = tip, self.find(tip)
+        try:
+            while True:
+                if i is not None:
+                    if missing:
+                        # Back on cached history.
+                        missing.close()
+                        missing = None
+                    rec = self.get(i)
+                    parent, sec, nparents = \
+                        rec.parent, rec.author_sec, rec.nparents
+                    i = rec.parent_ix
+                    if i < 0:
+                        i = None
+                else:
+                    if missing is None:
+                        missing = read_history(commit)
+                    rec = next(missing, None)
+                    if not rec or rec[0] != commit:
+                        return None
+                    c, parents, tree, sec = rec
+                    nparents = len(parents)
+                    parent = parents and parents[0] or None
+                    new.append((commit, parent, tree, sec, nparents))
+                if nparents > 1:
+                    return None
+                result.append((sec, commit))
+                if not nparents:
+                    break
+                commit = parent
+                if i is None:
+                    i = self.find(commit)
+        finally:
+            if missing:
+                missing.close()
+            if new:
+                new.reverse()
+                self.add(new)
+        return result
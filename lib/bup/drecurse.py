@@ -1,7 +1,7 @@
 
 import stat, os
 
-from bup.helpers import add_error, should_rx_exclude_path, debug1, resolve_parent
+from bup.helpers import ExcludeMatcher, add_error, debug1, resolve_parent
 import bup.xstat as xstat
 
 
@@ -53,17 +53,16 @@ def _dirlist():
 
 
 def _recursive_dirlist(prepend, xdev, bup_dir=None,
-                       excluded_paths=None,
-                       exclude_rxs=None,
+                       excludes=None,
+                       exclude_node=None,
                        xdev_exceptions=frozenset()):
     for (name,pst) in _dirlist():
         path = prepend + name
-        if excluded_paths:
-            if os.path.normpath(path) in excluded_paths:
-                debug1('Skipping %r: excluded.\n' % path)
+        node = None
+        if excludes:
+            node = excludes.child(exclude_node, name)
+            if excludes.excluded_at(path, node):
                 continue
-        if exclude_rxs and should_rx_exclude_path(path, exclude_rxs):
-            continue
         if name.endswith('/'):
             if bup_dir != None:
                 if os.path.normpath(path) == bup_dir:
@@ -80,8 +79,8 @@ def _recursive_dirlist(prepend, xdev, bup_dir=None,
                 else:
                     for i in _recursive_dirlist(prepend=prepend+name, xdev=xdev,
                                                 bup_dir=bup_dir,
-                                                excluded_paths=excluded_paths,
-                                                exclude_rxs=exclude_rxs,
+                                                excludes=excludes,
+                                                exclude_node=node,
                                                 xdev_exceptions=xdev_exceptions):
                         yield i
                     os.chdir('..')
@@ -92,6 +91,7 @@ def recursive_dirlist(paths, xdev, bup_dir=None,
                       excluded_paths=None,
                       exclude_rxs=None,
                       xdev_exceptions=frozenset()):
+    excludes = ExcludeMatcher(excluded_paths, exclude_rxs)
     startdir = OsFile('.')
     try:
         assert(type(paths) != type(''))
@@ -119,8 +119,8 @@ def recursive_dirlist(paths, xdev, bup_dir=None,
                 prepend = os.path.join(path, '')
                 for i in _recursive_dirlist(prepend=prepend, xdev=xdev,
                                             bup_dir=bup_dir,
-                                            excluded_paths=excluded_paths,
-                                            exclude_rxs=exclude_rxs,
+                                            excludes=excludes,
+                                            exclude_node=excludes.node_for(path),
                                             xdev_exceptions=xdev_exceptions):
                     yield i
                 startdir.fchdir()
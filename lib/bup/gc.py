@@ -1,7 +1,7 @@
 import glob, os, subprocess, sys, tempfile
-from bup import bloom, git, midx
+from bup import _helpers, bloom, git, midx
 from bup.git import MissingObject, walk_object
-from bup.helpers import Nonlocal, log, progress, qprogress
+from bup.helpers import Nonlocal, bitmap_isset, log, progress, qprogress
 from os.path import basename
 
 # This garbage collector uses a Bloom filter to track the live objects
@@ -41,17 +41,10 @@ from os.path import basename
 
 
 def count_objects(dir, verbosity):
-    # For now we'll just use open_idx(), but we could probably be much
-    # more efficient since all we need is a single integer (the last
-    # fanout entry) from each index.
-    object_count = 0
-    indexes = glob.glob(os.path.join(dir, '*.idx'))
-    for i, idx_name in enumerate(indexes):
-        if verbosity:
-            log('found %d objects (%d/%d %s)\r'
-                % (object_count, i + 1, len(indexes), basename(idx_name)))
-        idx = git.open_idx(idx_name)
-        object_count += len(idx)
+    counts = git.idx_counts(dir)
+    object_count = sum(counts.itervalues())
+    if verbosity:
+        log('found %d objects (%d indexes)\r' % (object_count, len(counts)))
     return object_count
 
 
@@ -157,11 +150,8 @@ def sweep(live_objects, existing_count, cat_pipe, threshold, compression,
                       % ((float(collect_count) / existing_count) * 100))
         idx = git.open_idx(idx_name)
 
-        idx_live_count = 0
-        for i in xrange(0, len(idx)):
-            sha = idx.shatable[i * 20 : (i + 1) * 20]
-            if live_objects.exists(sha):
-                idx_live_count += 1
+        live = live_objects.exists_many(idx.shatable)
+        idx_live_count = _helpers.bitmap_count(live)
 
         collect_count += idx_live_count
         if idx_live_count == 0:
@@ -183,8 +173,8 @@ def sweep(live_objects, existing_count, cat_pipe, threshold, compression,
             log('rewriting %s (%.2f%% live)\n' % (basename(idx_name),
                                                   live_frac * 100))
         for i in xrange(0, len(idx)):
-            sha = idx.shatable[i * 20 : (i + 1) * 20]
-            if live_objects.exists(sha):
+            if bitmap_isset(live, i):
+                sha = idx.shatable[i * 20 : (i + 1) * 20]
                 item_it = cat_pipe.get(sha.encode('hex'))
                 type = item_it.next()
                 writer.just_write(sha, type, ''.join(item_it))
@@ -228,6 +218,9 @@ def bup_gc(threshold=10, compression=1, verbosity=0):
             log('bup: missing object %r \n' % ex.id.encode('hex'))
             sys.exit(1)
         try:
+            # Make sure nothing trusts that objects seen before or during
+            # the sweep are still there (see git.repo_generation()).
+            git.new_repo_generation()
             # FIXME: just rename midxes and bloom, and restore them at the end if
             # we didn't change any packs?
             if verbosity: log('clearing midx files\n')
@@ -242,5 +235,6 @@ def bup_gc(threshold=10, compression=1, verbosity=0):
             sweep(live_objects, existing_count, cat_pipe,
                   threshold, compression,
                   verbosity)
+            git.new_repo_generation()
         finally:
             live_objects.close()
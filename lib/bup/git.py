@@ -7,10 +7,11 @@ import errno, os, sys, zlib, time, subprocess, struct, stat, re, tempfile, glob
 from collections import namedtuple
 from itertools import islice
 
-from bup import _helpers, hashsplit, path, midx, bloom, xstat
-from bup.helpers import (Sha1, add_error, chunkyreader, debug1, debug2,
-                         fdatasync,
-                         hostname, localtime, log, merge_iter,
+from bup import _helpers, commitgraph, hashsplit, midx, bloom, xstat
+from bup.helpers import (Sha1, add_error, atomically_replaced_file,
+                         bitmap_isset, chunkyreader,
+                         debug1, debug2, fdatasync,
+                         hostname, localtime, log, merge_iter, mkdirp,
                          mmap_read, mmap_readwrite,
                          progress, qprogress, stat_if_exists,
                          unlink, username, userfullname,
@@ -19,6 +20,11 @@ from bup.helpers import (Sha1, add_error, chunkyreader, debug1, debug2,
 
 max_pack_size = 1000*1000*1000  # larger packs will slow down pruning
 max_pack_objects = 200*1000  # cache memory usage is about 83 bytes per object
+# With skip_incompressible, a blob is stored without compression if
+# compressing its first INCOMPRESSIBLE_SAMPLE bytes doesn't shrink them
+# to less than INCOMPRESSIBLE_RATIO of their size.
+INCOMPRESSIBLE_SAMPLE = 2048
+INCOMPRESSIBLE_RATIO = 0.95
 
 verbose = 0
 ignore_midx = 0
@@ -147,25 +153,17 @@ def all_packdirs():
 
 
 def auto_midx(objdir):
-    args = [path.exe(), 'midx', '--auto', '--dir', objdir]
+    """Merge the idx files in objdir into midx files as needed (like
+    "bup midx --auto"), and add any new ones to the bloom filter (like
+    "bup bloom")."""
     try:
-        rv = subprocess.call(args, stdout=open('/dev/null', 'w'))
-    except OSError as e:
-        # make sure 'args' gets printed to help with debugging
-        add_error('%r: exception: %s' % (args, e))
-        raise
-    if rv:
-        add_error('%r: returned %d' % (args, rv))
-
-    args = [path.exe(), 'bloom', '--dir', objdir]
+        midx.update_dir(objdir, auto=True)
+    except (EnvironmentError, GitError) as e:
+        add_error('midx: %s: %s' % (objdir, e))
     try:
-        rv = subprocess.call(args, stdout=open('/dev/null', 'w'))
-    except OSError as e:
-        # make sure 'args' gets printed to help with debugging
-        add_error('%r: exception: %s' % (args, e))
-        raise
-    if rv:
-        add_error('%r: returned %d' % (args, rv))
+        bloom.update(objdir)
+    except (EnvironmentError, GitError) as e:
+        add_error('bloom: %s: %s' % (objdir, e))
 
 
 def mangle_name(name, mode, gitmode):
@@ -327,6 +325,19 @@ class PackIdx:
             return want_source and os.path.basename(self.name) or True
         return None
 
+    def exists_many(self, shas, want_source=False):
+        """Return a bitmap (see helpers.bitmap_isset()) of which of
+        shas, a string of packed 20-byte hashes, exist in this index,
+        or with want_source, (bitmap, sources), where sources lists
+        what exists() would return for each of them."""
+        found = _helpers.sorted_exists_many(self.shatable, self._rec_len,
+                                            self._rec_sha_ofs, shas, False)
+        if not want_source:
+            return found
+        name = os.path.basename(self.name)
+        return found, [bitmap_isset(found, i) and name or None
+                       for i in xrange(len(shas) // 20)]
+
     def __len__(self):
         return int(self.fanout[255])
 
@@ -354,6 +365,9 @@ class PackIdx:
 
 class PackIdxV1(PackIdx):
     """Object representation of a Git pack index (version 1) file."""
+    _rec_len = 24
+    _rec_sha_ofs = 4
+
     def __init__(self, filename, f):
         self.name = filename
         self.idxnames = [self.name]
@@ -378,6 +392,9 @@ class PackIdxV1(PackIdx):
 
 class PackIdxV2(PackIdx):
     """Object representation of a Git pack index (version 2) file."""
+    _rec_len = 20
+    _rec_sha_ofs = 0
+
     def __init__(self, filename, f):
         self.name = filename
         self.idxnames = [self.name]
@@ -411,6 +428,28 @@ class PackIdxV2(PackIdx):
             yield buffer(self.map, 8 + 256*4 + 20*i, 20)
 
 
+def _stat_stamp(st):
+    """Return a value that changes whenever the file (or directory)
+    described by st is replaced or modified, or None if it changed so
+    recently that another change might not alter its mtime."""
+    if xstat.fstime_floor_secs(st.st_mtime) >= int(time.time()) - 1:
+        return None
+    return st.st_dev, st.st_ino, st.st_mtime, st.st_ctime, st.st_size
+
+
+def _dir_stamp(path):
+    """Return a value that changes whenever an entry is added to or
+    removed from the directory path, or None if path doesn't exist or
+    see _stat_stamp()."""
+    try:
+        st = xstat.stat(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    return _stat_stamp(st)
+
+
 _mpi_count = 0
 class PackIdxList:
     def __init__(self, dir):
@@ -422,6 +461,7 @@ class PackIdxList:
         self.packs = []
         self.do_bloom = False
         self.bloom = None
+        self._stamp = None
         self.refresh()
 
     def __del__(self):
@@ -458,6 +498,49 @@ class PackIdxList:
         self.do_bloom = True
         return None
 
+    def exists_many(self, shas, want_source=False):
+        """Return a bitmap (see helpers.bitmap_isset()) of which of
+        shas, a string of packed 20-byte hashes, exist in the index
+        files, or with want_source, (bitmap, sources), where sources
+        lists what exists() would return for each of them."""
+        n = len(shas) // 20
+        found = bytearray((n + 7) // 8)
+        sources = want_source and [None] * n or None
+        todo = range(n)
+        if self.also:
+            todo = []
+            for i in xrange(n):
+                if str(shas[i*20:(i+1)*20]) in self.also:
+                    found[i >> 3] |= 1 << (i & 7)
+                    if sources:
+                        sources[i] = True
+                else:
+                    todo.append(i)
+            shas = ''.join(str(shas[i*20:(i+1)*20]) for i in todo)
+        if todo and self.bloom:
+            maybe = self.bloom.exists_many(shas)
+            todo = [i for j, i in enumerate(todo) if bitmap_isset(maybe, j)]
+            shas = ''.join(str(shas[j*20:(j+1)*20])
+                           for j in xrange(len(shas) // 20)
+                           if bitmap_isset(maybe, j))
+        for p in self.packs:
+            if not todo:
+                break
+            result = p.exists_many(shas, want_source=want_source)
+            bitmap, srcs = want_source and result or (result, None)
+            rest = []
+            for j, i in enumerate(todo):
+                if bitmap_isset(bitmap, j):
+                    found[i >> 3] |= 1 << (i & 7)
+                    if sources:
+                        sources[i] = srcs[j]
+                else:
+                    rest.append(j)
+            todo = [todo[j] for j in rest]
+            shas = ''.join(str(shas[j*20:(j+1)*20]) for j in rest)
+        found = str(found)
+        return want_source and (found, sources) or found
+
     def refresh(self, skip_midx = False):
         """Refresh the index list.
         This method verifies if .midx files were superseded (e.g. all of its
@@ -469,26 +552,44 @@ class PackIdxList:
 
         The module-global variable 'ignore_midx' can force this function to
         always act as if skip_midx was True.
+
+        Only the files added to or removed from the directory since the
+        last refresh are opened or dropped, and if the directory hasn't
+        changed at all (see _dir_stamp()), nothing else is done.
         """
+        skip_midx = skip_midx or ignore_midx
+        stamp = _dir_stamp(self.dir)
+        if stamp and (stamp, skip_midx) == self._stamp:
+            return
+        self._stamp = stamp and (stamp, skip_midx)
         self.bloom = None # Always reopen the bloom as it may have been relaced
         self.do_bloom = False
-        skip_midx = skip_midx or ignore_midx
-        d = dict((p.name, p) for p in self.packs
-                 if not skip_midx or not isinstance(p, midx.PackMidx))
-        if os.path.exists(self.dir):
+        try:
+            present = set(os.path.join(self.dir, name)
+                          for name in os.listdir(self.dir)
+                          if not name.startswith('.')
+                          and (name.endswith('.idx')
+                               or (not skip_midx and name.endswith('.midx'))))
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            present = None
+        if present is not None:
+            # Drop whatever has been removed (or is being skipped).
+            d = dict((p.name, p) for p in self.packs if p.name in present)
             if not skip_midx:
                 midxl = []
-                for ix in self.packs:
+                for ix in d.values():
                     if isinstance(ix, midx.PackMidx):
                         for name in ix.idxnames:
                             d[os.path.join(self.dir, name)] = ix
-                for full in glob.glob(os.path.join(self.dir,'*.midx')):
-                    if not d.get(full):
+                for full in present:
+                    if full.endswith('.midx') and not d.get(full):
                         mx = midx.PackMidx(full)
                         (mxd, mxf) = os.path.split(mx.name)
                         broken = False
                         for n in mx.idxnames:
-                            if not os.path.exists(os.path.join(mxd, n)):
+                            if os.path.join(mxd, n) not in present:
                                 log(('warning: index %s missing\n' +
                                     '  used by %s\n') % (n, mxf))
                                 broken = True
@@ -517,8 +618,8 @@ class PackIdxList:
                                % os.path.basename(ix.name))
                         ix.close()
                         unlink(ix.name)
-            for full in glob.glob(os.path.join(self.dir,'*.idx')):
-                if not d.get(full):
+            for full in present:
+                if full.endswith('.idx') and not d.get(full):
                     try:
                         ix = open_idx(full)
                     except GitError as e:
@@ -542,27 +643,107 @@ class PackIdxList:
         self.also.add(hash)
 
 
+def _idx_version(filename, header):
+    """Return the version of the idx file filename, given its first 8
+    bytes."""
+    if header[0:4] == '\377tOc':
+        version = struct.unpack('!I', header[4:8])[0]
+        if version != 2:
+            raise GitError('%s: expected idx file version 2, got %d'
+                           % (filename, version))
+        return version
+    elif len(header) == 8 and header[0:4] < '\377tOc':
+        return 1
+    raise GitError('%s: unrecognized idx file header' % filename)
+
+
 def open_idx(filename):
     if filename.endswith('.idx'):
         f = open(filename, 'rb')
-        header = f.read(8)
-        if header[0:4] == '\377tOc':
-            version = struct.unpack('!I', header[4:8])[0]
-            if version == 2:
-                return PackIdxV2(filename, f)
-            else:
-                raise GitError('%s: expected idx file version 2, got %d'
-                               % (filename, version))
-        elif len(header) == 8 and header[0:4] < '\377tOc':
-            return PackIdxV1(filename, f)
-        else:
-            raise GitError('%s: unrecognized idx file header' % filename)
+        if _idx_version(filename, f.read(8)) == 2:
+            return PackIdxV2(filename, f)
+        return PackIdxV1(filename, f)
     elif filename.endswith('.midx'):
         return midx.PackMidx(filename)
     else:
         raise GitError('idx filenames must end with .idx or .midx')
 
 
+def idx_object_count(filename):
+    """Return the number of objects in the idx file filename, i.e. the
+    last entry of its fanout table, without mapping the file."""
+    with open(filename, 'rb') as f:
+        header = f.read(8)
+        fanout_ofs = _idx_version(filename, header) == 2 and 8 or 0
+        f.seek(fanout_ofs + 255*4)
+        last = f.read(4)
+    if len(last) != 4:
+        raise GitError('%s: idx file is truncated' % filename)
+    return struct.unpack('!I', last)[0]
+
+
+IDX_COUNTS_NAME = 'bup.idxcounts'
+IDX_COUNTS_HEADER = 'bup idx counts 1\n'
+
+
+def _read_idx_counts(filename):
+    """Return {idx name: (mtime, size, count)} from the idx count
+    summary filename, or {} if it's missing or unreadable."""
+    counts = {}
+    try:
+        with open(filename, 'rb') as f:
+            if f.readline() != IDX_COUNTS_HEADER:
+                return {}
+            for line in f:
+                count, mtime, size, name = line.rstrip('\n').split(' ', 3)
+                counts[name] = (int(mtime), int(size), int(count))
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    except ValueError:
+        debug1('%s: ignoring corrupt idx counts\n' % filename)
+        return {}
+    return counts
+
+
+def idx_counts(dir):
+    """Return {idx path: object count} for the idx files in dir.
+    Avoid reading the idx files by keeping a summary of their counts,
+    keyed by name, mtime, and size, in dir/bup.idxcounts, which is
+    updated if anything changed (and dir is writable)."""
+    summary = os.path.join(dir, IDX_COUNTS_NAME)
+    cached = _read_idx_counts(summary)
+    current = {}
+    result = {}
+    for path in glob.glob(os.path.join(dir, '*.idx')):
+        name = os.path.basename(path)
+        try:
+            st = xstat.stat(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:  # removed since the glob
+                raise
+            continue
+        key = st.st_mtime, st.st_size
+        hit = cached.get(name)
+        if hit and hit[:2] == key:
+            count = hit[2]
+        else:
+            count = idx_object_count(path)
+        current[name] = key + (count,)
+        result[path] = count
+    if current != cached:
+        try:
+            with atomically_replaced_file(summary, 'wb') as f:
+                f.write(IDX_COUNTS_HEADER)
+                for name, (mtime, size, count) in sorted(current.iteritems()):
+                    f.write('%d %d %d %s\n' % (count, mtime, size, name))
+        except EnvironmentError as e:
+            if e.errno not in (errno.EACCES, errno.EPERM, errno.EROFS):
+                raise
+            debug1('%s: unable to update idx counts: %s\n' % (summary, e))
+    return result
+
+
 def idxmerge(idxlist, final_progress=True):
     """Generate a list of all the objects reachable in a PackIdxList."""
     def pfunc(count, total):
@@ -584,7 +765,8 @@ def _make_objcache():
 class PackWriter:
     """Writes Git objects inside a pack file."""
     def __init__(self, objcache_maker=_make_objcache, compression_level=1,
-                 run_midx=True, on_pack_finish=None):
+                 run_midx=True, on_pack_finish=None,
+                 skip_incompressible=False):
         self.file = None
         self.parentfd = None
         self.count = 0
@@ -594,8 +776,16 @@ class PackWriter:
         self.objcache_maker = objcache_maker
         self.objcache = None
         self.compression_level = compression_level
+        self.skip_incompressible = skip_incompressible
+        self.compressed_bytes = 0
+        self.compress_secs = 0.0
+        self.uncompressed_count = 0
+        self.uncompressed_bytes = 0
+        self.uncompressed_growth = 0
+        self.sample_secs = 0.0
         self.run_midx=run_midx
         self.on_pack_finish = on_pack_finish
+        self.commits = []  # for the commit graph, once the pack is done
 
     def __del__(self):
         self.close()
@@ -651,13 +841,51 @@ class PackWriter:
             log('>')
         if not sha:
             sha = calc_hash(type, content)
-        size, crc = self._raw_write(_encode_packobj(type, content,
-                                                    self.compression_level),
-                                    sha=sha)
+        if not self.skip_incompressible:
+            data = _encode_packobj(type, content, self.compression_level)
+        else:
+            data = self._encode_adaptively(type, content)
+        size, crc = self._raw_write(data, sha=sha)
         if self.outbytes >= max_pack_size or self.count >= max_pack_objects:
             self.breakpoint()
         return sha
 
+    def _encode_adaptively(self, type, content):
+        level = self.compression_level
+        if level and type == 'blob' and len(content) > INCOMPRESSIBLE_SAMPLE:
+            start = time.time()
+            sample_size = len(zlib.compress(content[:INCOMPRESSIBLE_SAMPLE],
+                                            1))
+            self.sample_secs += time.time() - start
+            if sample_size >= INCOMPRESSIBLE_SAMPLE * INCOMPRESSIBLE_RATIO:
+                data = list(_encode_packobj(type, content, 0))
+                # What compression might have saved, going by the sample.
+                self.uncompressed_growth += sum(len(d) for d in data) \
+                    - len(content) * sample_size // INCOMPRESSIBLE_SAMPLE
+                self.uncompressed_count += 1
+                self.uncompressed_bytes += len(content)
+                return data
+        start = time.time()
+        data = list(_encode_packobj(type, content, level))
+        self.compress_secs += time.time() - start
+        self.compressed_bytes += len(content)
+        return data
+
+    def incompressible_summary(self):
+        """Return a description of the effect of skip_incompressible, or
+        None if no blob has been stored uncompressed."""
+        if not self.uncompressed_count:
+            return None
+        # Assume the skipped blobs would have compressed as fast as the
+        # rest did.
+        rate = self.compress_secs / max(1, self.compressed_bytes)
+        saved = self.uncompressed_bytes * rate - self.sample_secs
+        return ('stored %d incompressible blobs (%d bytes) uncompressed,'
+                ' saving about %.2fs of CPU time and changing the output'
+                ' size by about %+d bytes'
+                % (self.uncompressed_count, self.uncompressed_bytes,
+                   saved, self.uncompressed_growth))
+
     def breakpoint(self):
         """Clear byte and object counts and return the last processed id."""
         id = self._end(self.run_midx)
@@ -720,7 +948,11 @@ class PackWriter:
         if committer: l.append('committer %s %s' % (committer, cdate_str))
         l.append('')
         l.append(msg)
-        return self.maybe_write('commit', '\n'.join(l))
+        sha = self.maybe_write('commit', '\n'.join(l))
+        if tree:
+            self.commits.append((sha, parent, tree, adate_sec,
+                                 parent and 1 or 0))
+        return sha
 
     def abort(self):
         """Remove the pack file from disk."""
@@ -728,6 +960,7 @@ class PackWriter:
         if f:
             pfd = self.parentfd
             self.file = None
+            self.commits = []
             self.parentfd = None
             self.idx = None
             try:
@@ -781,6 +1014,10 @@ class PackWriter:
         finally:
             os.close(self.parentfd)
 
+        if self.commits:
+            commit_graph().add(self.commits)
+            self.commits = []
+
         if run_midx:
             auto_midx(repo('objects/pack'))
 
@@ -848,6 +1085,115 @@ def _gitenv(repo_dir = None):
     return env
 
 
+# Refs are read and written directly, rather than via git show-ref
+# and update-ref, because forking git dominates listing them (e.g. for
+# each directory of refs in the vfs).  Loose ref files and packed-refs
+# are cached by _stat_stamp(), and updates take the same lock files
+# that git does.
+
+_bad_ref_rx = re.compile(r'(^|/)\.|\.\.|[\x00-\x20\x7f~^:?*[\\]|@\{'
+                         r'|\.lock(/|$)|//|/$|\.$')
+_ref_file_cache = {}  # path -> (stamp, contents)
+_packed_refs_cache = {}  # path -> (stamp, {refname: hex})
+
+
+def _check_ref_name(refname):
+    if _bad_ref_rx.search(refname):
+        raise GitError('invalid ref name %r' % refname)
+
+
+def _read_ref_file(path, st=None):
+    """Return the stripped contents of the loose ref file path, or None
+    if it doesn't exist.  With st, its lstat(), cache the result."""
+    stamp = st and _stat_stamp(st)
+    if stamp:
+        cached = _ref_file_cache.get(path)
+        if cached and cached[0] == stamp:
+            return cached[1]
+    try:
+        with open(path, 'rb') as f:
+            contents = f.read().strip()
+    except IOError as e:
+        if e.errno in (errno.ENOENT, errno.EISDIR):
+            return None
+        raise
+    if stamp:
+        _ref_file_cache[path] = stamp, contents
+    return contents
+
+
+def _loose_refs(repo_dir):
+    """Return {refname: contents} for the loose refs in repo_dir."""
+    refs = {}
+    dirs = ['refs']
+    while dirs:
+        rel = dirs.pop()
+        try:
+            names = os.listdir(os.path.join(repo_dir, rel))
+        except OSError as e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                continue
+            raise
+        for name in names:
+            refname = rel + '/' + name
+            if _bad_ref_rx.search(refname):  # e.g. a lock file
+                continue
+            path = os.path.join(repo_dir, refname)
+            try:
+                st = xstat.lstat(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                dirs.append(refname)
+            elif stat.S_ISREG(st.st_mode):
+                contents = _read_ref_file(path, st)
+                if contents:
+                    refs[refname] = contents
+    return refs
+
+
+def _packed_refs(repo_dir):
+    """Return {refname: hex} for the refs in repo_dir's packed-refs."""
+    path = os.path.join(repo_dir, 'packed-refs')
+    try:
+        st = xstat.stat(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return {}
+    stamp = _stat_stamp(st)
+    cached = _packed_refs_cache.get(path)
+    if stamp and cached and cached[0] == stamp:
+        return cached[1]
+    refs = {}
+    with open(path, 'rb') as f:
+        for line in f:
+            # Skip the header, and the peeled values of annotated tags.
+            if line.startswith('#') or line.startswith('^'):
+                continue
+            fields = line.rstrip('\n').split(' ', 1)
+            if len(fields) == 2 and len(fields[0]) == 40:
+                refs[fields[1]] = fields[0]
+    if stamp:
+        _packed_refs_cache[path] = stamp, refs
+    return refs
+
+
+def _resolve_ref(refname, loose, packed):
+    """Return the hex id refname refers to, following symbolic refs,
+    or None."""
+    for i in xrange(5):
+        value = loose.get(refname) or packed.get(refname)
+        if not value or not value.startswith('ref: '):
+            break
+        refname = value[5:].strip()
+    if value and len(value) == 40:
+        return value
+    return None
+
+
 def list_refs(refnames=None, repo_dir=None,
               limit_to_heads=False, limit_to_tags=False):
     """Yield (refname, hash) tuples for all repository refs unless
@@ -856,26 +1202,79 @@ def list_refs(refnames=None, repo_dir=None,
     refs/tags.  If both limits are specified, items from both sources
     will be included.
 
+    As with git show-ref, a refname matches the refs that end with it
+    at a path component boundary, e.g. 'x' matches refs/heads/x, and
+    the refs are yielded in order.
     """
-    argv = ['git', 'show-ref']
+    repo_dir = repo_dir or repo()
+    refnames = refnames and tuple(refnames)
+    prefixes = ()
     if limit_to_heads:
-        argv.append('--heads')
+        prefixes += ('refs/heads/',)
     if limit_to_tags:
-        argv.append('--tags')
-    argv.append('--')
-    if refnames:
-        argv += refnames
-    p = subprocess.Popen(argv,
-                         preexec_fn = _gitenv(repo_dir),
-                         stdout = subprocess.PIPE)
-    out = p.stdout.read().strip()
-    rv = p.wait()  # not fatal
-    if rv:
-        assert(not out)
-    if out:
-        for d in out.split('\n'):
-            (sha, name) = d.split(' ', 1)
-            yield (name, sha.decode('hex'))
+        prefixes += ('refs/tags/',)
+    loose = _loose_refs(repo_dir)
+    packed = _packed_refs(repo_dir)
+    for name in sorted(set(loose) | set(packed)):
+        if prefixes and not name.startswith(prefixes):
+            continue
+        if refnames and not any(name == r or name.endswith('/' + r)
+                                for r in refnames):
+            continue
+        hexsha = _resolve_ref(name, loose, packed)
+        if hexsha:
+            try:
+                yield name, hexsha.decode('hex')
+            except TypeError:
+                log('warning: ignoring broken ref %s\n' % name)
+
+
+def git_config_get(option, repo_dir=None):
+    """Return the value of the config option in the repository, or None
+    if it isn't set."""
+    p = subprocess.Popen(['git', 'config', '--get', option],
+                         stdout=subprocess.PIPE, preexec_fn=_gitenv(repo_dir))
+    value = p.stdout.read()
+    rv = p.wait()
+    if rv == 1:  # Not set
+        return None
+    if rv != 0:
+        raise GitError('git config --get %s returned error %d' % (option, rv))
+    return value.rstrip('\n')
+
+
+REPO_GENERATION_CONFIG = 'bup.generation'
+
+def repo_generation(repo_dir=None):
+    """Return the repository's generation, a random non-zero number that
+    changes whenever objects might be removed from the repository (see
+    new_repo_generation()), or 0 if it doesn't have one.  An object that
+    was present while the repository had a given generation is still
+    present as long as the generation hasn't changed."""
+    return parse_repo_generation(git_config_get(REPO_GENERATION_CONFIG,
+                                                repo_dir))
+
+
+def parse_repo_generation(value):
+    """Return the generation given by value, the repository's setting
+    for REPO_GENERATION_CONFIG (or None), as per repo_generation()."""
+    try:
+        return int(value or '0', 16)
+    except ValueError:
+        return 0
+
+
+def new_repo_generation(repo_dir=None):
+    """Give the repository a new generation and return it.  This must be
+    done before removing any objects from the repository."""
+    gen = 0
+    while not gen:
+        gen = struct.unpack('!Q', os.urandom(8))[0]
+    p = subprocess.Popen(['git', 'config', REPO_GENERATION_CONFIG,
+                          '%016x' % gen],
+                         stdout=sys.stderr, preexec_fn=_gitenv(repo_dir))
+    _git_wait('git config', p)
+    return gen
 
 
 def read_ref(refname, repo_dir = None):
@@ -889,17 +1288,51 @@ def read_ref(refname, repo_dir = None):
         return None
 
 
-def rev_list(ref, count=None, repo_dir=None):
-    """Generate a list of reachable commits in reverse chronological order.
+_commit_graphs = {}  # path -> CommitGraph
 
-    This generator walks through commits, from child to parent, that are
-    reachable via the specified ref and yields a series of tuples of the form
-    (date,hash).
 
-    If count is a non-zero integer, limit the number of commits to "count"
-    objects.
-    """
-    assert(not ref.startswith('-'))
+def commit_graph(repo_dir=None):
+    """Return the repository's commit graph cache (see commitgraph),
+    including anything other processes have added to it."""
+    path = repo('bupcommits', repo_dir)
+    graph = _commit_graphs.get(path)
+    if graph:
+        graph.refresh()
+    else:
+        graph = _commit_graphs[path] = commitgraph.CommitGraph(path)
+    return graph
+
+
+def _rev_list_records(commit, repo_dir=None):
+    """Yield (commit, parents, tree, author_sec) for commit and each of
+    its ancestors, as binary ids, in git rev-list order."""
+    argv = ['git', 'rev-list', '--pretty=format:%T %P %at',
+            commit.encode('hex'), '--']
+    p = subprocess.Popen(argv,
+                         preexec_fn = _gitenv(repo_dir),
+                         stdout = subprocess.PIPE)
+    done = False
+    try:
+        for row in p.stdout:
+            s = row.strip()
+            if s.startswith('commit '):
+                commit = s[7:].decode('hex')
+            else:
+                fields = s.split(' ')
+                yield (commit,
+                       [x.decode('hex') for x in fields[1:-1] if x],
+                       fields[0].decode('hex'), int(fields[-1]))
+        done = True
+    finally:
+        if not done:
+            p.stdout.close()
+            p.wait()
+    rv = p.wait()
+    if rv:
+        raise GitError, 'git rev-list returned error %d' % rv
+
+
+def _git_rev_list(ref, count=None, repo_dir=None):
     opts = []
     if count:
         opts += ['-n', str(atoi(count))]
@@ -920,12 +1353,64 @@ def rev_list(ref, count=None, repo_dir=None):
         raise GitError, 'git rev-list returned error %d' % rv
 
 
+def rev_list(ref, count=None, repo_dir=None):
+    """Generate a list of reachable commits in reverse chronological order.
+
+    This generator walks through commits, from child to parent, that are
+    reachable via the specified ref and yields a series of tuples of the form
+    (date,hash).
+
+    If count is a non-zero integer, limit the number of commits to "count"
+    objects.
+
+    When ref is a commit id whose history is linear (as bup's branches
+    are), the commits come from the commit graph cache, which is
+    brought up to date as needed.
+    """
+    assert(not ref.startswith('-'))
+    if not count and len(ref) == 40:
+        try:
+            tip = ref.decode('hex')
+        except TypeError:
+            tip = None
+        if tip:
+            revs = commit_graph(repo_dir).history(
+                tip, lambda commit: _rev_list_records(commit, repo_dir))
+            if revs is not None:
+                return iter(revs)
+    return _git_rev_list(ref, count, repo_dir)
+
+
+def get_commit_summary(commit, repo_dir=None):
+    """Return the commitgraph.Record for commit (a binary id), reading
+    the commit (and caching it) if the commit graph doesn't have it."""
+    graph = commit_graph(repo_dir)
+    i = graph.find(commit)
+    if i is not None:
+        return graph.get(i)
+    ci = get_commit_items(commit.encode('hex'), cp(repo_dir))
+    parents = [x.decode('hex') for x in ci.parents]
+    parent = parents and parents[0] or None
+    tree = ci.tree.decode('hex')
+    graph.add([(commit, parent, tree, ci.author_sec, len(parents))])
+    return commitgraph.Record(commit, parent or commitgraph.NO_PARENT, tree,
+                              ci.author_sec, -1, len(parents))
+
+
 def get_commit_dates(refs, repo_dir=None):
     """Get the dates for the specified commit refs.  For now, every unique
        string in refs must resolve to a different commit or this
        function will fail."""
     result = []
     for ref in refs:
+        if len(ref) == 40:
+            try:
+                commit = ref.decode('hex')
+            except TypeError:
+                commit = None
+            if commit:
+                result.append(get_commit_summary(commit, repo_dir).author_sec)
+                continue
         commit = get_commit_items(ref, cp(repo_dir))
         result.append(commit.author_sec)
     return result
@@ -958,25 +1443,157 @@ def rev_parse(committish, repo_dir=None):
     return None
 
 
+class _LockFile:
+    """A lock on path, taken as git does, by exclusively creating
+    path.lock, which replaces path on commit(), and is otherwise
+    removed when the lock is closed."""
+    def __init__(self, path):
+        self.path = path
+        self.name = path + '.lock'
+        self.file = None
+        try:
+            fd = os.open(self.name, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         0666)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                raise GitError('unable to lock %r: %r exists'
+                               % (path, self.name))
+            raise
+        self.file = os.fdopen(fd, 'wb')
+
+    def __del__(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def commit(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
+        os.rename(self.name, self.path)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+            unlink(self.name)
+
+
+def _current_ref(refname, repo_dir):
+    """Return the hash refname (a full name) refers to right now, or
+    None.  Don't follow symbolic refs; they can't be updated here."""
+    path = os.path.join(repo_dir, refname)
+    contents = _read_ref_file(path)
+    if contents is None:
+        contents = _packed_refs(repo_dir).get(refname)
+        if contents is None:
+            return None
+    if contents.startswith('ref: '):
+        raise GitError('%s is a symbolic ref' % refname)
+    try:
+        return contents.decode('hex')
+    except TypeError:
+        raise GitError('%s is broken' % refname)
+
+
+def _reflog_ident():
+    name = os.environ.get('GIT_COMMITTER_NAME') or userfullname()
+    email = os.environ.get('GIT_COMMITTER_EMAIL') \
+        or '%s@%s' % (username(), hostname())
+    return '%s <%s>' % (name, email)
+
+
+def _log_ref_update(refname, oldval, newval, repo_dir):
+    """Append the update to refname's reflog, if it has one or should
+    have one according to core.logAllRefUpdates."""
+    path = os.path.join(repo_dir, 'logs', refname)
+    if not os.path.exists(path):
+        log_all = (git_config_get('core.logAllRefUpdates', repo_dir)
+                   or '').lower()
+        if log_all != 'always' \
+           and not (log_all in ('true', 'yes', 'on', '1')
+                    and refname.startswith(('refs/heads/', 'refs/remotes/',
+                                            'refs/notes/'))):
+            return
+        mkdirp(os.path.dirname(path))
+    with open(path, 'ab') as f:
+        f.write('%s %s %s %s\n'
+                % ((oldval or '\0' * 20).encode('hex'), newval.encode('hex'),
+                   _reflog_ident(), _local_git_date_str(int(time.time()))))
+
+
+def _delete_packed_ref(refname, repo_dir):
+    path = os.path.join(repo_dir, 'packed-refs')
+    if refname not in _packed_refs(repo_dir):
+        return
+    with _LockFile(path) as lock:
+        with open(path, 'rb') as f:
+            lines = f.readlines()
+        deleting = False
+        for line in lines:
+            if not line.startswith('^'):  # (peeled lines follow their ref)
+                deleting = line.rstrip('\n').split(' ', 1)[1:] == [refname]
+            if not deleting:
+                lock.file.write(line)
+        lock.commit()
+
+
 def update_ref(refname, newval, oldval, repo_dir=None):
-    """Update a repository reference."""
+    """Update a repository reference, as git update-ref would, but
+    only if it currently refers to oldval (or if oldval is empty,
+    doesn't exist)."""
     if not oldval:
-        oldval = ''
+        oldval = None
     assert(refname.startswith('refs/heads/') \
            or refname.startswith('refs/tags/'))
-    p = subprocess.Popen(['git', 'update-ref', refname,
-                          newval.encode('hex'), oldval.encode('hex')],
-                         preexec_fn = _gitenv(repo_dir))
-    _git_wait('git update-ref', p)
-
-
-def delete_ref(refname, oldvalue=None):
-    """Delete a repository reference (see git update-ref(1))."""
+    _check_ref_name(refname)
+    repo_dir = repo_dir or repo()
+    path = os.path.join(repo_dir, refname)
+    try:
+        mkdirp(os.path.dirname(path))
+    except OSError as e:
+        raise GitError('unable to create %s: %s' % (refname, e))
+    with _LockFile(path) as lock:
+        current = _current_ref(refname, repo_dir)
+        if current != oldval:
+            raise GitError('unable to update %s: expected %s, found %s'
+                           % (refname, (oldval or '').encode('hex') or 'none',
+                              (current or '').encode('hex') or 'none'))
+        lock.file.write(newval.encode('hex') + '\n')
+        _log_ref_update(refname, oldval, newval, repo_dir)
+        lock.commit()
+
+
+def delete_ref(refname, oldvalue=None, repo_dir=None):
+    """Delete a repository reference (see git update-ref(1)).  If
+    oldvalue (a hex id) is given, only delete it if it refers to that.
+    """
     assert(refname.startswith('refs/'))
-    oldvalue = [] if not oldvalue else [oldvalue]
-    p = subprocess.Popen(['git', 'update-ref', '-d', refname] + oldvalue,
-                         preexec_fn = _gitenv())
-    _git_wait('git update-ref', p)
+    _check_ref_name(refname)
+    repo_dir = repo_dir or repo()
+    path = os.path.join(repo_dir, refname)
+    if _current_ref(refname, repo_dir) is None:
+        if oldvalue:
+            raise GitError('unable to delete %s: it does not exist' % refname)
+        return
+    try:
+        mkdirp(os.path.dirname(path))  # (for a lock on a packed ref)
+    except OSError as e:
+        raise GitError('unable to delete %s: %s' % (refname, e))
+    with _LockFile(path):
+        current = _current_ref(refname, repo_dir)
+        if oldvalue and current != oldvalue.decode('hex'):
+            raise GitError('unable to delete %s: expected %s, found %s'
+                           % (refname, oldvalue,
+                              (current or '').encode('hex') or 'none'))
+        _delete_packed_ref(refname, repo_dir)
+        unlink(path)
+        unlink(os.path.join(repo_dir, 'logs', refname))
 
 
 def guess_repo(path=None):
@@ -995,8 +1612,9 @@ def guess_repo(path=None):
             repodir = os.path.expanduser('~/.bup')
 
 
-def init_repo(path=None):
-    """Create the Git bare repository for bup in a given path."""
+def init_repo(path=None, chunker=None):
+    """Create the Git bare repository for bup in a given path.  If
+    chunker is given, record it as the repository's chunker."""
     guess_repo(path)
     d = repo()  # appends a / to the path
     parent = os.path.dirname(os.path.dirname(d))
@@ -1016,6 +1634,12 @@ def init_repo(path=None):
     p = subprocess.Popen(['git', 'config', 'core.logAllRefUpdates', 'true'],
                          stdout=sys.stderr, preexec_fn = _gitenv())
     _git_wait('git config', p)
+    if chunker:
+        p = subprocess.Popen(['git', 'config', hashsplit.CHUNKER_CONFIG,
+                              chunker],
+                             stdout=sys.stderr, preexec_fn = _gitenv())
+        _git_wait('git config', p)
+    new_repo_generation()
 
 
 def check_repo_or_die(path=None):
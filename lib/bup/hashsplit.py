@@ -1,47 +1,126 @@
-import io, math, os
+import errno, io, math, mmap, os, stat
+from collections import deque
+from itertools import chain
 
 from bup import _helpers, helpers
 from bup.helpers import sc_page_size
 
 _fmincore = getattr(helpers, 'fmincore', None)
+_madvise = getattr(_helpers, 'madvise', None)
 
 BLOB_MAX = 8192*4   # 8192 is the "typical" blob size for bupsplit
 BLOB_READ_SIZE = 1024*1024
 MAX_PER_TREE = 256
+# Split regular files of at least this size by mapping them rather than
+# reading them (if not None).  Off by default, since the process will
+# be killed (SIGBUS) if such a file shrinks while it's being split.
+mmap_min_size = None
+MMAP_WINDOW = 256*1024*1024
+MMAP_RELEASE_SIZE = 8*1024*1024
+READAHEAD_FILES = 32
+READAHEAD_ITEMS = 4096
 progress_callback = None
 fanout = 16
 
+# The content-defined chunkers, mapped to the name of the _helpers
+# function that finds the next split point.  The chunker a repository
+# uses is recorded in its config (as CHUNKER_CONFIG), since data split
+# by different chunkers won't deduplicate.
+CHUNKER_CONFIG = 'bup.split.chunker'
+DEFAULT_CHUNKER = 'rollsum'
+CHUNKERS = {
+    'rollsum': 'splitbuf',
+    'fastcdc': 'fastcdc_splitbuf',
+}
+chunker = DEFAULT_CHUNKER
+
 GIT_MODE_FILE = 0100644
 GIT_MODE_TREE = 040000
 GIT_MODE_SYMLINK = 0120000
 assert(GIT_MODE_TREE != 40000)  # 0xxx should be treated as octal
 
-# The purpose of this type of buffer is to avoid copying on peek(), get(),
-# and eat().  We do copy the buffer contents on put(), but that should
-# be ok if we always only put() large amounts of data at a time.
+# The purpose of this type of buffer is to avoid copying data more than
+# once.  Data is read straight into a bytearray slab by fill() (or
+# copied there by put()), and peek(), get(), and eat() hand out buffer()
+# views of it.  Those views are only valid until the next fill() or
+# put(), which may move the unconsumed data to the front of the slab
+# (at most BLOB_MAX bytes, when the data is being split), or grow it,
+# so they never leave this module: hashsplit_iter() hands out copies,
+# and only split_to_blobs() passes the views (straight to makeblob).
+_free_slabs = []
+
 class Buf:
     def __init__(self):
-        self.data = ''
-        self.start = 0
+        self.data = _free_slabs and _free_slabs.pop() or bytearray()
+        self.start = self.end = 0
+
+    def close(self):
+        """Release the slab for reuse by another Buf."""
+        if self.data is not None:
+            if len(_free_slabs) < 4:
+                _free_slabs.append(self.data)
+            self.data = None
+
+    def _make_room(self, count):
+        if self.end + count <= len(self.data):
+            return
+        used = self.end - self.start
+        if used + count > len(self.data):
+            data = bytearray(max(used + count, 2 * len(self.data)))
+            data[0:used] = memoryview(self.data)[self.start:self.end]
+            self.data = data
+        elif used <= self.start:
+            self.data[0:used] = memoryview(self.data)[self.start:self.end]
+        else:
+            # Overlapping move (rare, since the data is normally consumed
+            # down to less than BLOB_MAX bytes).
+            self.data[0:used] = bytes(self.data[self.start:self.end])
+        self.start, self.end = 0, used
 
     def put(self, s):
         if s:
-            self.data = buffer(self.data, self.start) + s
-            self.start = 0
-            
+            self._make_room(len(s))
+            self.data[self.end:self.end + len(s)] = s
+            self.end += len(s)
+
+    def fill(self, f, count):
+        """Read up to count bytes from f (which may return more if it
+        has no readinto()) into the buffer, and return a view of
+        them."""
+        readinto = getattr(f, 'readinto', None)
+        if not readinto:
+            s = f.read(count)
+            self.put(s)
+            return buffer(self.data, self.end - len(s), len(s))
+        self._make_room(count)
+        n = readinto(memoryview(self.data)[self.end:self.end + count])
+        self.end += n
+        return buffer(self.data, self.end - n, n)
+
     def peek(self, count):
-        return buffer(self.data, self.start, count)
-    
+        return buffer(self.data, self.start, min(count, self.used()))
+
     def eat(self, count):
         self.start += count
 
     def get(self, count):
-        v = buffer(self.data, self.start, count)
+        v = self.peek(count)
         self.start += count
         return v
 
     def used(self):
-        return len(self.data) - self.start
+        return self.end - self.start
+
+
+def set_chunker(name):
+    """Split data with the chunker name (or the default if name is
+    None) from now on."""
+    global chunker
+    name = name or DEFAULT_CHUNKER
+    if name not in CHUNKERS:
+        raise ValueError('unsupported chunker %r (expected one of %s)'
+                         % (name, ', '.join(sorted(CHUNKERS))))
+    chunker = name
 
 
 def _fadvise_pages_done(fd, first_page, count):
@@ -89,27 +168,44 @@ def _uncache_ours_upto(fd, offset, first_region, remaining_regions):
     return (rstart, rlen)
 
 
-def readfile_iter(files, progress=None):
+def _our_page_regions(f):
+    """Return (fd, regions, first_region) for f, where regions
+    iterates over the (start_page, count) regions of f that aren't in
+    the page cache yet, i.e. those that should be uncached once we're
+    done with them (see _uncache_ours_upto()), or (None, None, (None,
+    None)) if that can't be determined."""
+    fd = rpr = rstart = rlen = None
+    if _fmincore and hasattr(f, 'fileno'):
+        try:
+            fd = f.fileno()
+        except io.UnsupportedOperation:
+            pass
+        if fd:
+            mcore = _fmincore(fd)
+            if mcore:
+                max_chunk = max(1, (8 * 1024 * 1024) / sc_page_size)
+                rpr = _nonresident_page_regions(mcore, helpers.MINCORE_INCORE,
+                                                max_chunk)
+                rstart, rlen = next(rpr, (None, None))
+    return fd, rpr, (rstart, rlen)
+
+
+def readfile_iter(files, progress=None, read=None):
+    """Yield the data read from each of files in turn, via read(f,
+    size) if given, or f.read(size), from its current position."""
     for filenum,f in enumerate(files):
-        ofs = 0
         b = ''
-        fd = rpr = rstart = rlen = None
-        if _fmincore and hasattr(f, 'fileno'):
-            try:
-                fd = f.fileno()
-            except io.UnsupportedOperation:
-                pass
-            if fd:
-                mcore = _fmincore(fd)
-                if mcore:
-                    max_chunk = max(1, (8 * 1024 * 1024) / sc_page_size)
-                    rpr = _nonresident_page_regions(mcore, helpers.MINCORE_INCORE,
-                                                    max_chunk)
-                    rstart, rlen = next(rpr, (None, None))
+        fd, rpr, (rstart, rlen) = _our_page_regions(f)
+        # f may already be partway through, e.g. past the part of a
+        # file that was only appended to since it was last saved.
+        ofs = rpr and f.tell() or 0
         while 1:
             if progress:
                 progress(filenum, len(b))
-            b = f.read(BLOB_READ_SIZE)
+            if read:
+                b = read(f, BLOB_READ_SIZE)
+            else:
+                b = f.read(BLOB_READ_SIZE)
             ofs += len(b)
             if rpr:
                 rstart, rlen = _uncache_ours_upto(fd, ofs, (rstart, rlen), rpr)
@@ -120,10 +216,32 @@ def readfile_iter(files, progress=None):
             rstart, rlen = _uncache_ours_upto(fd, ofs, (rstart, rlen), rpr)
 
 
-def _splitbuf(buf, basebits, fanbits):
+class StringsFile:
+    """A file-like object whose content is the concatenation of the
+    strings yielded by an iterable, so that data produced piecewise
+    can be split without being joined first."""
+    def __init__(self, strings):
+        self._it = iter(strings)
+        self._rest = ''
+
+    def read(self, size):
+        parts = [self._rest]
+        n = len(self._rest)
+        if n < size:
+            for s in self._it:
+                parts.append(s)
+                n += len(s)
+                if n >= size:
+                    break
+        data = ''.join(parts)
+        self._rest = data[size:]
+        return data[:size]
+
+
+def _splitbuf(buf, basebits, fanbits, splitbuf):
     while 1:
         b = buf.peek(buf.used())
-        (ofs, bits) = _helpers.splitbuf(b)
+        (ofs, bits) = splitbuf(b)
         if ofs:
             if ofs > BLOB_MAX:
                 ofs = BLOB_MAX
@@ -139,20 +257,114 @@ def _splitbuf(buf, basebits, fanbits):
         yield buf.get(BLOB_MAX), 0
 
 
+def _mmap_size(f):
+    """Return the size of f if it should be split via mmap, or None."""
+    if mmap_min_size is None or not hasattr(f, 'fileno'):
+        return None
+    try:
+        fd = f.fileno()
+    except io.UnsupportedOperation:
+        return None
+    st = os.fstat(fd)
+    if not stat.S_ISREG(st.st_mode) or st.st_size < mmap_min_size:
+        return None
+    if f.tell() != 0:
+        return None
+    return st.st_size
+
+
+def _mmap_splits(f, size, progress, splitbuf, basebits, fanbits):
+    """Split the size bytes of f via a series of read-only mappings,
+    in exactly the same places the reading splitter would.  Yield
+    nothing if f can't be mapped."""
+    fd = f.fileno()
+    rpr, region = _our_page_regions(f)[1:]
+    gran = mmap.ALLOCATIONGRANULARITY
+    # Each window must be able to hold a whole blob after pos.
+    window = max(MMAP_WINDOW, BLOB_MAX + 2 * gran)
+    window -= window % gran
+    pos = 0  # offset in the file of the next unsplit byte
+    while pos < size:
+        mstart = pos - pos % gran
+        mlen = min(window, size - mstart)
+        try:
+            m = mmap.mmap(fd, mlen, mmap.MAP_PRIVATE, mmap.PROT_READ,
+                          offset=mstart)
+        except mmap.error as e:
+            if pos == 0 and e.errno in (errno.EINVAL, errno.ENODEV):
+                return
+            raise
+        if _madvise:
+            _madvise(m, 0, mlen, _helpers.MADV_SEQUENTIAL)
+        last = mstart + mlen == size
+        ofs = reported = pos - mstart
+        released = 0
+        while ofs < mlen:
+            avail = min(mlen - ofs, BLOB_MAX)
+            (n, bits) = splitbuf(buffer(m, ofs, avail))
+            if n:
+                level = (bits-basebits)//fanbits  # integer division
+            elif avail == BLOB_MAX or last:
+                n, level = avail, 0
+            else:
+                break  # Continue in the next window
+            yield buffer(m, ofs, n), level
+            ofs += n
+            if ofs - released >= MMAP_RELEASE_SIZE:
+                # The blobs before ofs have been handled (they're only
+                # valid until the next one is requested), so drop their
+                # pages from the mapping, and if they weren't cached
+                # before, from the page cache.
+                if progress:
+                    progress(0, ofs - reported)
+                    reported = ofs
+                done = ofs - ofs % sc_page_size
+                if _madvise:
+                    _madvise(m, released, done - released,
+                             _helpers.MADV_DONTNEED)
+                if rpr:
+                    region = _uncache_ours_upto(fd, mstart + done, region, rpr)
+                released = done
+        if progress and ofs > reported:
+            progress(0, ofs - reported)
+        pos = mstart + ofs
+        m = None
+    if rpr:
+        _uncache_ours_upto(fd, size, region, rpr)
+
+
 def _hashsplit_iter(files, progress):
     assert(BLOB_READ_SIZE > BLOB_MAX)
     basebits = _helpers.blobbits()
     fanbits = int(math.log(fanout or 128, 2))
+    splitbuf = getattr(_helpers, CHUNKERS[chunker])
+    if mmap_min_size is not None:
+        # Blobs may span files, so only a lone file can be mapped.
+        files = iter(files)
+        peeked = [f for f in (next(files, None), next(files, None)) if f]
+        size = len(peeked) == 1 and _mmap_size(peeked[0])
+        if size:
+            splits = _mmap_splits(peeked[0], size, progress,
+                                  splitbuf, basebits, fanbits)
+            first = next(splits, None)
+            if first:
+                yield first
+                for buf_and_level in splits:
+                    yield buf_and_level
+                return
+        files = chain(peeked, files)
     buf = Buf()
-    for inblock in readfile_iter(files, progress):
-        buf.put(inblock)
-        for buf_and_level in _splitbuf(buf, basebits, fanbits):
-            yield buf_and_level
-    if buf.used():
-        yield buf.get(buf.used()), 0
+    try:
+        for inblock in readfile_iter(files, progress, read=buf.fill):
+            for buf_and_level in _splitbuf(buf, basebits, fanbits, splitbuf):
+                yield buf_and_level
+        if buf.used():
+            yield buf.get(buf.used()), 0
+    finally:
+        buf.close()
 
 
-def _hashsplit_iter_keep_boundaries(files, progress):
+def _hashsplit_views_keep_boundaries(files, progress):
     for real_filenum,f in enumerate(files):
         if progress:
             def prog(filenum, nbytes):
@@ -165,17 +377,24 @@ def _hashsplit_iter_keep_boundaries(files, progress):
             yield buf_and_level
 
 
-def hashsplit_iter(files, keep_boundaries, progress):
+def _hashsplit_views(files, keep_boundaries, progress):
+    """Like hashsplit_iter(), but yield views that are only valid
+    until the next blob is requested."""
     if keep_boundaries:
-        return _hashsplit_iter_keep_boundaries(files, progress)
+        return _hashsplit_views_keep_boundaries(files, progress)
     else:
         return _hashsplit_iter(files, progress)
 
 
+def hashsplit_iter(files, keep_boundaries, progress):
+    for (blob, level) in _hashsplit_views(files, keep_boundaries, progress):
+        yield str(blob), level
+
+
 total_split = 0
 def split_to_blobs(makeblob, files, keep_boundaries, progress):
     global total_split
-    for (blob, level) in hashsplit_iter(files, keep_boundaries, progress):
+    for (blob, level) in _hashsplit_views(files, keep_boundaries, progress):
         sha = makeblob(blob)
         total_split += len(blob)
         if progress_callback:
@@ -211,9 +430,7 @@ def _squish(maketree, stacks, n):
         i += 1
 
 
-def split_to_shalist(makeblob, maketree, files,
-                     keep_boundaries, progress=None):
-    sl = split_to_blobs(makeblob, files, keep_boundaries, progress)
+def _blobs_to_shalist(maketree, sl):
     assert(fanout != 0)
     if not fanout:
         shal = []
@@ -231,10 +448,16 @@ def split_to_shalist(makeblob, maketree, files,
         return _make_shalist(stacks[-1])[0]
 
 
-def split_to_blob_or_tree(makeblob, maketree, files,
-                          keep_boundaries, progress=None):
-    shalist = list(split_to_shalist(makeblob, maketree,
-                                    files, keep_boundaries, progress))
+def split_to_shalist(makeblob, maketree, files,
+                     keep_boundaries, progress=None):
+    sl = split_to_blobs(makeblob, files, keep_boundaries, progress)
+    return _blobs_to_shalist(maketree, sl)
+
+
+def blobs_to_blob_or_tree(makeblob, maketree, blobs):
+    """Return (mode, id) for the file made of the (sha, size, level)
+    blobs, as yielded by split_to_blobs()."""
+    shalist = list(_blobs_to_shalist(maketree, blobs))
     if len(shalist) == 1:
         return (shalist[0][0], shalist[0][2])
     elif len(shalist) == 0:
@@ -243,6 +466,12 @@ def split_to_blob_or_tree(makeblob, maketree, files,
         return (GIT_MODE_TREE, maketree(shalist))
 
 
+def split_to_blob_or_tree(makeblob, maketree, files,
+                          keep_boundaries, progress=None):
+    sl = split_to_blobs(makeblob, files, keep_boundaries, progress)
+    return blobs_to_blob_or_tree(makeblob, maketree, sl)
+
+
 def open_noatime(name):
     fd = _helpers.open_noatime(name)
     try:
@@ -253,3 +482,96 @@ def open_noatime(name):
         except:
             pass
         raise
+
+
+class ReadAhead:
+    """Iterate over items, asking the kernel to start reading the files
+    the consumer is going to read next.
+
+    want(item) returns the (path, size) of the file the consumer will
+    read for the item, or None.  Up to max_files of the upcoming files,
+    covering at most max_bytes, are opened ahead of time, and the
+    kernel is asked to read them into the page cache, so that the data
+    is likely to be there by the time the consumer gets to them.  The
+    consumer must get the file via open(path) while the item is the
+    current one; otherwise it's closed when the next item is requested.
+    """
+    def __init__(self, items, want, max_bytes, max_files=READAHEAD_FILES):
+        self._items = iter(items)
+        self._want = want
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self._pending = deque()  # (item, path or None, bytes advised)
+        self._files = {}  # path -> file opened ahead
+        self._bytes = 0
+        self._current = None
+
+    def close(self):
+        self._current = None
+        self._pending.clear()
+        for f in self._files.itervalues():
+            f.close()
+        self._files = {}
+        self._bytes = 0
+
+    def __del__(self):
+        self.close()
+
+    def _fill(self):
+        while len(self._pending) < READAHEAD_ITEMS:
+            room = len(self._files) < self.max_files \
+                   and self._bytes < self.max_bytes
+            if self._pending and not room:
+                return
+            try:
+                item = next(self._items)
+            except StopIteration:
+                return
+            path, n = None, 0
+            want = room and self._want(item)
+            if want and want[0] not in self._files:
+                try:
+                    f = open_noatime(want[0])
+                except (IOError, OSError):
+                    # Leave it to the consumer to run into the error.
+                    pass
+                else:
+                    path = want[0]
+                    n = max(0, min(want[1], self.max_bytes - self._bytes))
+                    self._files[path] = f
+                    self._bytes += n
+                    if n:
+                        _helpers.fadvise_willneed(f.fileno(), 0, n)
+            self._pending.append((item, path, n))
+
+    def _release(self):
+        if self._current:
+            path, n = self._current
+            self._current = None
+            self._bytes -= n
+            f = self._files.pop(path, None)
+            if f:
+                f.close()
+
+    def __iter__(self):
+        try:
+            while True:
+                self._release()
+                self._fill()
+                if not self._pending:
+                    return
+                item, path, n = self._pending.popleft()
+                if path:
+                    self._current = (path, n)
+                yield item
+        finally:
+            self.close()
+
+    def open(self, path):
+        """Return the file at path (as per open_noatime()) for the
+        current item."""
+        if self._current and self._current[0] == path:
+            f = self._files.pop(path, None)
+            if f:
+                return f
+        return open_noatime(path)
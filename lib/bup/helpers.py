@@ -877,6 +877,12 @@ def count(l):
     return reduce(lambda x,y: x+1, l)
 
 
+def bitmap_isset(bitmap, i):
+    """Return nonzero if bit i is set in bitmap, a string with bit i%8
+    of byte i/8 for each i (as returned by the exists_many() methods)."""
+    return ord(bitmap[i >> 3]) & (1 << (i & 7))
+
+
 saved_errors = []
 def add_error(e):
     """Append an error message to the list of saved errors.
@@ -1003,14 +1009,90 @@ def parse_rx_excludes(options, fatal):
     return excluded_patterns
 
 
-def should_rx_exclude_path(path, exclude_rxs):
-    """Return True if path matches a regular expression in exclude_rxs."""
-    for rx in exclude_rxs:
-        if rx.search(path):
-            debug1('Skipping %r: excluded by rx pattern %r.\n'
-                   % (path, rx.pattern))
+def _rx_combinable(rx):
+    # Patterns with flags, group references, or named groups can't
+    # safely be embedded in a larger alternation.
+    if rx.flags or rx.groupindex:
+        return False
+    return not (rx.groups and re.search(r'\\[1-9]|\(\?\(', rx.pattern))
+
+
+def _exclude_path_parts(path):
+    path = os.path.normpath(path)
+    if path == '/':
+        return ['']
+    if path == '.':
+        return []
+    return path.split('/')
+
+
+class ExcludeMatcher:
+    """Match paths against the --exclude paths and --exclude-rx patterns.
+
+    The patterns are combined into a single alternation regex (aside
+    from any that can't be, i.e. those with flags or backreferences),
+    and the excluded paths are stored in a trie of path components, so
+    that a traversal can carry the trie node for the current directory
+    (see node_for() and child()) and test each entry with a single
+    dict lookup.  A node of None means that no excluded path lies at
+    or below the corresponding directory.
+    """
+    def __init__(self, excluded_paths=(), exclude_rxs=()):
+        self._root = None
+        for path in excluded_paths or ():
+            node = self._root = self._root or {}
+            for part in _exclude_path_parts(path):
+                node = node.setdefault(part, {})
+            node[None] = True
+        self._rxs = list(exclude_rxs or ())
+        combinable = [rx for rx in self._rxs if _rx_combinable(rx)]
+        self._others = [rx for rx in self._rxs if not _rx_combinable(rx)]
+        self._rx = None
+        if combinable:
+            self._rx = re.compile('|'.join('(?:%s)' % rx.pattern
+                                           for rx in combinable))
+
+    def __nonzero__(self):
+        return bool(self._root or self._rxs)
+
+    def node_for(self, path):
+        """Return the trie node for path, or None."""
+        node = self._root
+        if not node:
+            return None
+        for part in _exclude_path_parts(path):
+            if not node:
+                return None
+            node = node.get(part)
+        return node
+
+    def child(self, node, name):
+        """Return the trie node for name (a basename, possibly with a
+        trailing slash) within the directory with trie node node."""
+        if not node:
+            return None
+        return node.get(name.rstrip('/'))
+
+    def excluded_at(self, path, node):
+        """Return True if path, whose trie node is node, is excluded."""
+        if node and None in node:
+            debug1('Skipping %r: excluded.\n' % path)
             return True
-    return False
+        return self._rx_excluded(path)
+
+    def excluded(self, path):
+        """Return True if path is excluded."""
+        return self.excluded_at(path, self.node_for(path))
+
+    def _rx_excluded(self, path):
+        if self._rx and self._rx.search(path) \
+           or any(rx.search(path) for rx in self._others):
+            if buglvl >= 1:
+                rx = next(rx for rx in self._rxs if rx.search(path))
+                debug1('Skipping %r: excluded by rx pattern %r.\n'
+                       % (path, rx.pattern))
+            return True
+        return False
 
 
 # FIXME: Carefully consider the use of functions (os.path.*, etc.)
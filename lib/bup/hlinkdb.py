@@ -1,20 +1,132 @@
-import cPickle, errno, os, tempfile
+"""Hard link database.
+
+The database maps each (dev, ino) node that has more than one link to
+the list of indexed paths for that node, and each such path back to
+its node.  It's stored in a compact binary file (i.e. bupindex.hlink)
+that is looked up via mmap, so neither index nor save has to load the
+whole thing.  Changes are kept in memory and merged into a new file
+by prepare_save().
+
+The file consists of a header followed by four sections:
+
+  nodes:      node_n records (dev, ino, first, count) sorted by
+              (dev, ino), where first and count select the node's
+              paths from the node_paths section.
+  node_paths: path_n path numbers, grouped by node, each group in
+              the order the paths were added.
+  paths:      path_n records (name_ofs, name_len, node) sorted by
+              name, where node is the index of the path's node.
+  names:      the path names, in paths order.
+
+Older versions of bup stored a pickled dict, which is still read (and
+converted on the next save).
+"""
+
+import cPickle, errno, os, struct, tempfile
+from array import array
+
+from bup.helpers import chunkyreader, mmap_read
+
+
+HLINK_MAGIC = 'BHLK'
+HLINK_VERSION = 1
+HLINK_HDR = '!4sIQQ'
+HLINK_HDRLEN = struct.calcsize(HLINK_HDR)
+HLINK_NODE = '!QQQQ'
+HLINK_NODELEN = struct.calcsize(HLINK_NODE)
+HLINK_NODE_PATH = '!Q'
+HLINK_NODE_PATHLEN = struct.calcsize(HLINK_NODE_PATH)
+HLINK_PATH = '!QQQ'
+HLINK_PATHLEN = struct.calcsize(HLINK_PATH)
+
 
 class Error(Exception):
     pass
 
+
+class _Table:
+    """Read-only view of the nodes and paths in a hard link file."""
+    def __init__(self, m):
+        self.map = m
+        if not m:
+            self.node_n = self.path_n = 0
+            return
+        magic, ver, self.node_n, self.path_n \
+            = struct.unpack(HLINK_HDR, m[0:HLINK_HDRLEN])
+        if magic != HLINK_MAGIC or ver != HLINK_VERSION:
+            raise Error('unexpected hard link database format')
+        self.nodes_ofs = HLINK_HDRLEN
+        self.node_paths_ofs = self.nodes_ofs + self.node_n * HLINK_NODELEN
+        self.paths_ofs = self.node_paths_ofs + self.path_n * HLINK_NODE_PATHLEN
+        self.names_ofs = self.paths_ofs + self.path_n * HLINK_PATHLEN
+
+    def node_at(self, i):
+        """Return (dev, ino, first, count) for node i."""
+        return struct.unpack_from(HLINK_NODE, self.map,
+                                  self.nodes_ofs + i * HLINK_NODELEN)
+
+    def node_key(self, i):
+        return struct.unpack_from('!QQ', self.map,
+                                  self.nodes_ofs + i * HLINK_NODELEN)
+
+    def node_path_numbers(self, i):
+        dev, ino, first, count = self.node_at(i)
+        ofs = self.node_paths_ofs + first * HLINK_NODE_PATHLEN
+        return struct.unpack_from('!%dQ' % count, self.map, ofs)
+
+    def node_paths(self, i):
+        return [self.path_at(j)[0] for j in self.node_path_numbers(i)]
+
+    def path_at(self, i):
+        """Return (name, node) for path i."""
+        name_ofs, name_len, node \
+            = struct.unpack_from(HLINK_PATH, self.map,
+                                 self.paths_ofs + i * HLINK_PATHLEN)
+        ofs = self.names_ofs + name_ofs
+        return self.map[ofs:ofs + name_len], node
+
+    def find_node(self, key):
+        lo, hi = 0, self.node_n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            k = self.node_key(mid)
+            if k < key:
+                lo = mid + 1
+            elif k > key:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def find_path(self, path):
+        lo, hi = 0, self.path_n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            name = self.path_at(mid)[0]
+            if name < path:
+                lo = mid + 1
+            elif name > path:
+                hi = mid
+            else:
+                return mid
+        return None
+
+
 class HLinkDB:
     def __init__(self, filename):
-        # Map a "dev:ino" node to a list of paths associated with that node.
-        self._node_paths = {}
-        # Map a path to a "dev:ino" node.
-        self._path_node = {}
         self._filename = filename
         self._save_prepared = None
         self._tmpname = None
+        self._empty = False
+        # In-memory changes: nodes that have been modified, mapped to
+        # their complete (possibly empty) path lists, and modified
+        # paths, mapped to their node (or None if removed).
+        self._changed_nodes = {}
+        self._changed_paths = {}
+        m = ''
         f = None
         try:
-            f = open(filename, 'r')
+            f = open(filename, 'rb')
         except IOError as e:
             if e.errno == errno.ENOENT:
                 pass
@@ -22,21 +134,148 @@ class HLinkDB:
                 raise
         if f:
             try:
-                self._node_paths = cPickle.load(f)
+                if f.read(len(HLINK_MAGIC)) == HLINK_MAGIC:
+                    m = mmap_read(f, close=False)
+                elif os.fstat(f.fileno()).st_size:
+                    f.seek(0)
+                    self._load_legacy(f)
             finally:
                 f.close()
                 f = None
-        # Set up the reverse hard link index.
-        for node, paths in self._node_paths.iteritems():
+        self._base = _Table(m)
+
+    def _load_legacy(self, f):
+        for node, paths in cPickle.load(f).iteritems():
+            dev, ino = node.split(':')
+            key = (int(dev), int(ino))
+            self._changed_nodes[key] = list(paths)
             for path in paths:
-                self._path_node[path] = node
+                self._changed_paths[path] = key
+
+    def _node_of(self, path):
+        if path in self._changed_paths:
+            return self._changed_paths[path]
+        i = self._base.find_path(path)
+        if i is None:
+            return None
+        return self._base.node_key(self._base.path_at(i)[1])
+
+    def _touch_node(self, key):
+        paths = self._changed_nodes.get(key)
+        if paths is None:
+            i = self._base.find_node(key)
+            paths = [] if i is None else self._base.node_paths(i)
+            self._changed_nodes[key] = paths
+        return paths
+
+    def _merged_nodes(self):
+        """Yield (key, base_index, paths) for every non-empty node in
+        (dev, ino) order, where paths is None for unchanged nodes."""
+        changed = sorted(self._changed_nodes.iterkeys())
+        base = self._base
+        ci = 0
+        for i in xrange(base.node_n):
+            key = base.node_key(i)
+            while ci < len(changed) and changed[ci] < key:
+                ck = changed[ci]
+                if self._changed_nodes[ck]:
+                    yield ck, None, self._changed_nodes[ck]
+                ci += 1
+            if ci < len(changed) and changed[ci] == key:
+                if self._changed_nodes[key]:
+                    yield key, i, self._changed_nodes[key]
+                ci += 1
+            else:
+                yield key, i, None
+        for ck in changed[ci:]:
+            if self._changed_nodes[ck]:
+                yield ck, None, self._changed_nodes[ck]
+
+    def _merged_paths(self):
+        """Yield (name, node_key_or_None, base_index) for every path in
+        name order, where node_key_or_None is None for unchanged paths."""
+        changed = sorted(p for p, key in self._changed_paths.iteritems()
+                         if key is not None)
+        base = self._base
+        ci = 0
+        for i in xrange(base.path_n):
+            name, node = base.path_at(i)
+            while ci < len(changed) and changed[ci] < name:
+                yield changed[ci], self._changed_paths[changed[ci]], None
+                ci += 1
+            if name in self._changed_paths:
+                continue
+            yield name, None, i
+        for name in changed[ci:]:
+            yield name, self._changed_paths[name], None
+
+    def _write(self, f):
+        base = self._base
+        node_remap = array('l', [-1]) * base.node_n
+        changed_node_index = {}
+        node_n = 0
+        for key, base_i, paths in self._merged_nodes():
+            if base_i is not None:
+                node_remap[base_i] = node_n
+            if paths is not None:
+                changed_node_index[key] = node_n
+            node_n += 1
+
+        path_remap = array('l', [-1]) * base.path_n
+        changed_path_index = {}
+        path_recs = tempfile.TemporaryFile()
+        names = tempfile.TemporaryFile()
+        try:
+            path_n = name_ofs = 0
+            for name, key, base_i in self._merged_paths():
+                if base_i is None:
+                    node = changed_node_index[key]
+                    changed_path_index[name] = path_n
+                else:
+                    node = node_remap[base.path_at(base_i)[1]]
+                    path_remap[base_i] = path_n
+                assert(node >= 0)
+                path_recs.write(struct.pack(HLINK_PATH,
+                                            name_ofs, len(name), node))
+                names.write(name)
+                name_ofs += len(name)
+                path_n += 1
+
+            f.write(struct.pack(HLINK_HDR, HLINK_MAGIC, HLINK_VERSION,
+                                node_n, path_n))
+            node_path_numbers = array('L')
+            for key, base_i, paths in self._merged_nodes():
+                if paths is None:
+                    nums = [path_remap[j]
+                            for j in base.node_path_numbers(base_i)]
+                else:
+                    nums = []
+                    for path in paths:
+                        j = changed_path_index.get(path)
+                        if j is None:
+                            j = path_remap[base.find_path(path)]
+                        nums.append(j)
+                f.write(struct.pack(HLINK_NODE, key[0], key[1],
+                                    len(node_path_numbers), len(nums)))
+                node_path_numbers.extend(nums)
+            assert(len(node_path_numbers) == path_n)
+            for j in node_path_numbers:
+                f.write(struct.pack(HLINK_NODE_PATH, j))
+            for section in (path_recs, names):
+                section.seek(0)
+                for b in chunkyreader(section):
+                    f.write(b)
+        finally:
+            path_recs.close()
+            names.close()
+        return node_n
 
     def prepare_save(self):
         """ Commit all of the relevant data to disk.  Do as much work
         as possible without actually making the changes visible."""
         if self._save_prepared:
             raise Error('save of %r already in progress' % self._filename)
-        if self._node_paths:
+        if self._changed_nodes:
             (dir, name) = os.path.split(self._filename)
             (ffd, self._tmpname) = tempfile.mkstemp('.tmp', name, dir)
             try:
@@ -46,7 +285,7 @@ class HLinkDB:
                     os.close(ffd)
                     raise
                 try:
-                    cPickle.dump(self._node_paths, f, 2)
+                    self._empty = not self._write(f)
                 finally:
                     f.close()
                     f = None
@@ -55,6 +294,11 @@ class HLinkDB:
                 self._tmpname = None
                 os.unlink(tmpname)
                 raise
+            if self._empty:
+                os.unlink(self._tmpname)
+                self._tmpname = None
+        else:
+            self._empty = not self._base.node_n
         self._save_prepared = True
 
     def commit_save(self):
@@ -64,7 +308,7 @@ class HLinkDB:
         if self._tmpname:
             os.rename(self._tmpname, self._filename)
             self._tmpname = None
-        else: # No data -- delete _filename if it exists.
+        elif self._empty: # No data -- delete _filename if it exists.
             try:
                 os.unlink(self._filename)
             except OSError as e:
@@ -84,33 +328,33 @@ class HLinkDB:
 
     def add_path(self, path, dev, ino):
         # Assume path is new.
-        node = '%s:%s' % (dev, ino)
-        self._path_node[path] = node
-        link_paths = self._node_paths.get(node)
-        if link_paths and path not in link_paths:
-            link_paths.append(path)
-        else:
-            self._node_paths[node] = [path]
-
-    def _del_node_path(self, node, path):
-        link_paths = self._node_paths[node]
-        link_paths.remove(path)
-        if not link_paths:
-            del self._node_paths[node]
+        node = (dev, ino)
+        prev_node = self._node_of(path)
+        if prev_node == node:
+            return
+        if prev_node:
+            self._touch_node(prev_node).remove(path)
+        self._touch_node(node).append(path)
+        self._changed_paths[path] = node
 
     def change_path(self, path, new_dev, new_ino):
-        prev_node = self._path_node.get(path)
-        if prev_node:
-            self._del_node_path(prev_node, path)
-        self.add_path(new_dev, new_ino, path)
+        self.add_path(path, new_dev, new_ino)
 
     def del_path(self, path):
         # Path may not be in db (if updating a pre-hardlink support index).
-        node = self._path_node.get(path)
+        node = self._node_of(path)
         if node:
-            self._del_node_path(node, path)
-            del self._path_node[path]
+            self._touch_node(node).remove(path)
+            self._changed_paths[path] = None
 
     def node_paths(self, dev, ino):
-        node = '%s:%s' % (dev, ino)
-        return self._node_paths[node]
+        node = (dev, ino)
+        paths = self._changed_nodes.get(node)
+        if paths is None:
+            i = self._base.find_node(node)
+            if i is None:
+                raise KeyError(node)
+            return self._base.node_paths(i)
+        if not paths:
+            raise KeyError(node)
+        return paths
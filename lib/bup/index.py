@@ -1,14 +1,15 @@
 import errno, metadata, os, stat, struct, tempfile
+from bisect import bisect_left
 
-from bup import xstat
+from bup import _helpers, xstat
 from bup._helpers import UINT_MAX
-from bup.helpers import (add_error, log, merge_iter, mmap_readwrite,
+from bup.helpers import (Sha1, add_error, log, merge_iter, mmap_readwrite,
                          progress, qprogress, resolve_parent, slashappend)
 
 EMPTY_SHA = '\0'*20
 FAKE_SHA = '\x01'*20
 
-INDEX_HDR = 'BUPI\0\0\0\7'
+INDEX_HDR = 'BUPI\0\0\0\x09'
 
 # Time values are handled as integer nanoseconds since the epoch in
 # memory, but are written as xstat/metadata timespecs.  This behavior
@@ -31,9 +32,21 @@ INDEX_SIG = ('!'
              'H'                # flags
              'Q'                # children_ofs
              'I'                # children_n
-             'Q')               # meta_ofs
+             'Q'                # meta_ofs
+             'Q'                # verified_gen
+             'Q'                # pending_n
+             'Q')               # pending_size
+
+# verified_gen is the repository generation (see git.repo_generation())
+# at which the entry's sha was last found in the repository, or 0.
+# pending_n and pending_size are the number and total size of the
+# entries below the entry that need to be saved, i.e. that exist but
+# aren't IX_HASHVALID, so that save can tell how much work there is
+# without a pass over the index.
 
 ENTLEN = struct.calcsize(INDEX_SIG)
+PENDING_SIG = '!QQ'
+PENDING_OFS = ENTLEN - struct.calcsize(PENDING_SIG)
 FOOTER_SIG = '!Q'
 FOOTLEN = struct.calcsize(FOOTER_SIG)
 
@@ -63,53 +76,211 @@ class MetaStoreReader:
         return metadata.Metadata.read(self._file)
 
 
+META_IX_MAGIC = 'BMIX'
+META_IX_VERSION = 1
+META_IX_HDR = '!4sIIQQ'
+META_IX_HDRLEN = struct.calcsize(META_IX_HDR)
+META_IX_SLOTLEN = struct.calcsize('!20sQ')
+META_IX_BITS = 8
+META_IX_DIRTY = 2**64 - 1
+
+def _meta_ix_size(bits):
+    return META_IX_HDRLEN + (1 << bits) * META_IX_SLOTLEN
+
+
+class MetaStoreIndex:
+    """Persistent hash table mapping encoded metadata to store offsets.
+
+    The table lives next to the metadata store (i.e. bupindex.meta.idx)
+    and maps the SHA-1 of each encoded metadata record to its offset
+    in the store, so that opening a MetaStoreWriter doesn't have to
+    read and decode the whole store.  It's an mmapped open addressing
+    table with linear probing; a slot holds the 20-byte digest and
+    the offset plus one (so that an all-zero slot is empty).
+
+    The header records the size of the store the table covers.  That
+    size is set to META_IX_DIRTY while a writer has the table open, so
+    an interrupted run just causes a rebuild.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.map = None
+        self._file = None
+        f = open(filename, 'a+b')
+        try:
+            f.seek(0)
+            hdr = f.read(META_IX_HDRLEN)
+            if len(hdr) == META_IX_HDRLEN:
+                (magic, ver, bits, count, covered) \
+                    = struct.unpack(META_IX_HDR, hdr)
+            else:
+                magic = None
+            if magic == META_IX_MAGIC and ver == META_IX_VERSION \
+               and os.fstat(f.fileno()).st_size == _meta_ix_size(bits):
+                self.bits, self.count, self.covered = bits, count, covered
+            else:
+                self.bits, self.count, self.covered = META_IX_BITS, 0, None
+                f.truncate(0)
+                f.truncate(_meta_ix_size(self.bits))
+            self._file = open(filename, 'r+b')
+        finally:
+            f.close()
+        self._mmap()
+
+    def _mmap(self):
+        self.map = mmap_readwrite(self._file, close=False)
+        self.mask = (1 << self.bits) - 1
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self.map:
+            self.map.flush()
+            self.map.close()
+            self.map = None
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _write_header(self, covered):
+        self.map[0:META_IX_HDRLEN] = struct.pack(META_IX_HDR, META_IX_MAGIC,
+                                                 META_IX_VERSION, self.bits,
+                                                 self.count, covered)
+
+    def mark_dirty(self):
+        self._write_header(META_IX_DIRTY)
+        self.map.flush()
+
+    def mark_clean(self, covered):
+        self.covered = covered
+        self._write_header(covered)
+        self.map.flush()
+
+    def clear(self):
+        self.map.close()
+        self._file.truncate(0)
+        self._file.truncate(_meta_ix_size(self.bits))
+        self.count = 0
+        self._mmap()
+        self.mark_dirty()
+
+    def _slot(self, digest):
+        # Return the offset of the slot for digest, and the stored value
+        # (zero if the slot is empty).
+        m = self.map
+        i = _helpers.firstword(digest) & self.mask
+        while True:
+            pos = META_IX_HDRLEN + i * META_IX_SLOTLEN
+            val = struct.unpack('!Q', m[pos+20:pos+META_IX_SLOTLEN])[0]
+            if not val or m[pos:pos+20] == digest:
+                return pos, val
+            i = (i + 1) & self.mask
+
+    def get(self, digest):
+        pos, val = self._slot(digest)
+        if val:
+            return val - 1
+        return None
+
+    def add(self, digest, ofs):
+        if (self.count + 1) * 3 > (1 << self.bits) * 2:
+            self._grow()
+        pos, val = self._slot(digest)
+        if not val:
+            self.count += 1
+        self.map[pos:pos+META_IX_SLOTLEN] = struct.pack('!20sQ', digest, ofs + 1)
+
+    def _grow(self):
+        m = self.map
+        entries = []
+        for i in xrange(1 << self.bits):
+            pos = META_IX_HDRLEN + i * META_IX_SLOTLEN
+            digest, val = struct.unpack('!20sQ', m[pos:pos+META_IX_SLOTLEN])
+            if val:
+                entries.append((digest, val - 1))
+        m.close()
+        self.bits += 1
+        self._file.truncate(0)
+        self._file.truncate(_meta_ix_size(self.bits))
+        self._mmap()
+        self.mark_dirty()
+        self.count = 0
+        for digest, ofs in entries:
+            self.add(digest, ofs)
+
+
 class MetaStoreWriter:
     # For now, we just append to the file, and try to handle any
     # truncation or corruption somewhat sensibly.
 
     def __init__(self, filename):
-        # Map metadata hashes to bupindex.meta offsets.
-        self._offsets = {}
+        # Map metadata hashes to bupindex.meta offsets via a persistent
+        # MetaStoreIndex, so that only records appended since the index
+        # was last closed (if any) have to be read here.
         self._filename = filename
         self._file = None
-        # FIXME: see how slow this is; does it matter?
+        self._index = None
+        self._index = MetaStoreIndex(filename + '.idx')
         m_file = open(filename, 'ab+')
         try:
-            m_file.seek(0)
-            try:
-                m_off = m_file.tell()
-                m = metadata.Metadata.read(m_file)
-                while m:
-                    m_encoded = m.encode()
-                    self._offsets[m_encoded] = m_off
-                    m_off = m_file.tell()
-                    m = metadata.Metadata.read(m_file)
-            except EOFError:
-                pass
-            except:
-                log('index metadata in %r appears to be corrupt' % filename)
-                raise
+            m_file.seek(0, os.SEEK_END)
+            m_size = m_file.tell()
+            covered = self._index.covered
+            if covered is None or covered == META_IX_DIRTY \
+               or covered > m_size:
+                # Missing, interrupted, or stale (the store shrank).
+                self._index.clear()
+                covered = 0
+            else:
+                self._index.mark_dirty()
+            if covered < m_size:
+                self._scan(m_file, covered)
         finally:
             m_file.close()
         self._file = open(filename, 'ab')
 
+    def _scan(self, m_file, start):
+        m_file.seek(start)
+        try:
+            m_off = m_file.tell()
+            m = metadata.Metadata.read(m_file)
+            while m:
+                m_encoded = m.encode()
+                self._index.add(Sha1(m_encoded).digest(), m_off)
+                m_off = m_file.tell()
+                m = metadata.Metadata.read(m_file)
+        except EOFError:
+            pass
+        except:
+            log('index metadata in %r appears to be corrupt' % self._filename)
+            raise
+
     def close(self):
+        # The index stays mapped (for lookups) until we're collected.
         if self._file:
+            self._file.flush()
+            m_size = os.fstat(self._file.fileno()).st_size
             self._file.close()
             self._file = None
+            self._index.mark_clean(m_size)
 
     def __del__(self):
         # Be optimistic.
         self.close()
+        if self._index:
+            self._index.close()
+            self._index = None
 
     def store(self, metadata):
         meta_encoded = metadata.encode(include_path=False)
-        ofs = self._offsets.get(meta_encoded)
-        if ofs:
+        digest = Sha1(meta_encoded).digest()
+        ofs = self._index.get(digest)
+        if ofs is not None:
             return ofs
         ofs = self._file.tell()
         self._file.write(meta_encoded)
-        self._offsets[meta_encoded] = ofs
+        self._index.add(digest, ofs)
         return ofs
 
 
@@ -119,6 +290,8 @@ class Level:
         self.ename = ename
         self.list = []
         self.count = 0
+        self.pending_n = 0
+        self.pending_size = 0
 
     def write(self, f):
         (ofs,n) = (f.tell(), len(self.list))
@@ -128,6 +301,9 @@ class Level:
             #    % (''.join(self.ename), count))
             for e in self.list:
                 e.write(f)
+                pending_n, pending_size = e.pending_totals()
+                self.pending_n += pending_n
+                self.pending_size += pending_size
             if self.parent:
                 self.parent.count += count + self.count
         return (ofs,n)
@@ -141,6 +317,7 @@ def _golevel(level, f, ename, newentry, metastore, tmax):
         n = BlankNewEntry(level.ename[-1], default_meta_ofs, tmax)
         n.flags |= IX_EXISTS
         (n.children_ofs,n.children_n) = level.write(f)
+        (n.pending_n, n.pending_size) = (level.pending_n, level.pending_size)
         level.parent.list.append(n)
         level = level.parent
 
@@ -153,6 +330,7 @@ def _golevel(level, f, ename, newentry, metastore, tmax):
     n = newentry or \
         BlankNewEntry(ename and level.ename[-1] or None, default_meta_ofs, tmax)
     (n.children_ofs,n.children_n) = level.write(f)
+    (n.pending_n, n.pending_size) = (level.pending_n, level.pending_size)
     if level.parent:
         level.parent.list.append(n)
     level = level.parent
@@ -160,6 +338,12 @@ def _golevel(level, f, ename, newentry, metastore, tmax):
     return level
 
 
+def _pending(flags, size):
+    if (flags & (IX_EXISTS | IX_HASHVALID)) == IX_EXISTS:
+        return 1, size
+    return 0, 0
+
+
 class Entry:
     def __init__(self, basename, name, meta_ofs, tmax):
         self.basename = str(basename)
@@ -168,6 +352,8 @@ class Entry:
         self.tmax = tmax
         self.children_ofs = 0
         self.children_n = 0
+        self.pending_n = 0
+        self.pending_size = 0
 
     def __repr__(self):
         return ("(%s,0x%04x,%d,%d,%d,%d,%d,%d,%s/%s,0x%04x,%d,0x%08x/%d)"
@@ -190,7 +376,8 @@ class Entry:
                                self.size, self.mode,
                                self.gitmode, self.sha, self.flags,
                                self.children_ofs, self.children_n,
-                               self.meta_ofs)
+                               self.meta_ofs, self.verified_gen,
+                               self.pending_n, self.pending_size)
         except (DeprecationWarning, struct.error) as e:
             log('pack error: %s (%r)\n' % (e, self))
             raise
@@ -249,8 +436,15 @@ class Entry:
         f = IX_HASHVALID|IX_EXISTS
         return (self.flags & f) == f
 
+    def pending_totals(self):
+        """Return the number and total size of the entries at or below
+        this one that need to be saved."""
+        n, size = _pending(self.flags, self.size)
+        return n + self.pending_n, size + self.pending_size
+
     def invalidate(self):
         self.flags &= ~IX_HASHVALID
+        self.verified_gen = 0
 
     def validate(self, gitmode, sha):
         assert(sha)
@@ -258,7 +452,14 @@ class Entry:
         assert(gitmode+0 == gitmode)
         self.gitmode = gitmode
         self.sha = sha
-        self.flags |= IX_HASHVALID|IX_EXISTS
+        self.flags = (self.flags | IX_HASHVALID|IX_EXISTS) & ~IX_SHAMISSING
+        self.verified_gen = 0
+
+    def verified_in(self, gen):
+        """Return true if the entry is valid, and its sha was found in
+        the repository when it was at generation gen (see
+        git.repo_generation())."""
+        return gen and self.verified_gen == gen and self.is_valid()
 
     def exists(self):
         return not self.is_deleted()
@@ -272,6 +473,7 @@ class Entry:
     def set_deleted(self):
         if self.flags & IX_EXISTS:
             self.flags &= ~(IX_EXISTS | IX_HASHVALID)
+            self.verified_gen = 0
 
     def is_real(self):
         return not self.is_fake()
@@ -299,6 +501,7 @@ class NewEntry(Entry):
          self.flags, self.children_ofs, self.children_n
          ) = (dev, ino, nlink, ctime, mtime, atime,
               size, mode, gitmode, sha, flags, children_ofs, children_n)
+        self.verified_gen = 0
         self._fixup()
 
 
@@ -310,16 +513,18 @@ class BlankNewEntry(NewEntry):
 
 
 class ExistingEntry(Entry):
-    def __init__(self, parent, basename, name, m, ofs):
+    def __init__(self, parent, basename, name, m, ofs, fields=None):
         Entry.__init__(self, basename, name, None, None)
         self.parent = parent
         self._m = m
         self._ofs = ofs
+        if fields is None:
+            fields = struct.unpack(INDEX_SIG, str(buffer(m, ofs, ENTLEN)))
         (self.dev, self.ino, self.nlink,
          self.ctime, ctime_ns, self.mtime, mtime_ns, self.atime, atime_ns,
          self.size, self.mode, self.gitmode, self.sha,
-         self.flags, self.children_ofs, self.children_n, self.meta_ofs
-         ) = struct.unpack(INDEX_SIG, str(buffer(m, ofs, ENTLEN)))
+         self.flags, self.children_ofs, self.children_n, self.meta_ofs,
+         self.verified_gen, self.pending_n, self.pending_size) = fields
         self.atime = xstat.timespec_to_nsecs((self.atime, atime_ns))
         self.mtime = xstat.timespec_to_nsecs((self.mtime, mtime_ns))
         self.ctime = xstat.timespec_to_nsecs((self.ctime, ctime_ns))
@@ -343,39 +548,152 @@ class ExistingEntry(Entry):
             self.repack()
 
     def repack(self):
+        old = _ent_unpack_from(self._m, self._ofs)
+        # The totals in the index are kept up to date by the entries
+        # below, so they're more current than ours.
+        self.pending_n = old[_ent_field_i['pending_n']]
+        self.pending_size = old[_ent_field_i['pending_size']]
         self._m[self._ofs:self._ofs+ENTLEN] = self.packed()
+        old_n, old_size = _pending(old[_ent_field_i['flags']],
+                                   old[_ent_field_i['size']])
+        n, size = _pending(self.flags, self.size)
+        if (n, size) != (old_n, old_size):
+            parent = self.parent
+            while parent:
+                parent._add_pending(n - old_n, size - old_size)
+                parent = parent.parent
         if self.parent and not self.is_valid():
             self.parent.invalidate()
             self.parent.repack()
 
-    def iter(self, name=None, wantrecurse=None):
+    def _add_pending(self, n, size):
+        ofs = self._ofs + PENDING_OFS
+        old_n, old_size = struct.unpack_from(PENDING_SIG, self._m, ofs)
+        self.pending_n = max(0, old_n + n)
+        self.pending_size = max(0, old_size + size)
+        self._m[ofs:self._ofs+ENTLEN] = struct.pack(PENDING_SIG,
+                                                    self.pending_n,
+                                                    self.pending_size)
+
+    def iter(self, name=None, wantrecurse=None, select=None):
         dname = name
         if dname and not dname.endswith('/'):
             dname += '/'
         ofs = self.children_ofs
         assert(ofs <= len(self._m))
         assert(self.children_n <= UINT_MAX)  # i.e. python struct 'I'
-        for i in xrange(self.children_n):
-            eon = self._m.find('\0', ofs)
-            assert(eon >= 0)
-            assert(eon >= ofs)
-            assert(eon > ofs)
-            basename = str(buffer(self._m, ofs, eon-ofs))
-            child = ExistingEntry(self, basename, self.name + basename,
-                                  self._m, eon+1)
-            if (not dname
-                 or child.name.startswith(dname)
-                 or child.name.endswith('/') and dname.startswith(child.name)):
+        remaining = self.children_n
+        while remaining:
+            block = EntryBlock(self._m, ofs, min(remaining, BLOCK_MAX))
+            ofs = block.end
+            remaining -= len(block)
+            for e in self._iter_block(block, name, dname, wantrecurse, select):
+                yield e
+
+    def _iter_block(self, block, name, dname, wantrecurse, select):
+        names = [self.name + basename for basename in block.names]
+        if name:
+            wanted = [i for i, n in enumerate(names)
+                      if n == name or n.startswith(dname)]
+        else:
+            wanted = range(len(names))
+        if select and wanted:
+            if len(wanted) == len(names):
+                chosen = select(block)
+            else:
+                chosen = select(block.subset(wanted))
+            wanted = [i for i, ok in zip(wanted, chosen) if ok]
+        wanted = set(wanted)
+        children_n = block.column('children_n')
+        for i, cname in enumerate(names):
+            # Entries without children have nothing to recurse into.
+            recurse = children_n[i] \
+                and (not dname
+                     or cname.startswith(dname)
+                     or cname.endswith('/') and dname.startswith(cname))
+            if not recurse and i not in wanted:
+                continue
+            child = block.entry(i, self, cname)
+            if recurse:
                 if not wantrecurse or wantrecurse(child):
-                    for e in child.iter(name=name, wantrecurse=wantrecurse):
+                    for e in child.iter(name=name, wantrecurse=wantrecurse,
+                                        select=select):
                         yield e
-            if not name or child.name == name or child.name.startswith(dname):
+            if i in wanted:
                 yield child
-            ofs = eon + 1 + ENTLEN
 
     def __iter__(self):
         return self.iter()
-            
+
+
+ENT_FIELDS = ('dev', 'ino', 'nlink',
+              'ctime', 'ctime_ns', 'mtime', 'mtime_ns', 'atime', 'atime_ns',
+              'size', 'mode', 'gitmode', 'sha', 'flags',
+              'children_ofs', 'children_n', 'meta_ofs', 'verified_gen',
+              'pending_n', 'pending_size')
+_ent_field_i = dict((name, i) for i, name in enumerate(ENT_FIELDS))
+_ent_unpack_from = struct.Struct(INDEX_SIG).unpack_from
+
+# Limit the number of decoded entries held at once for huge directories.
+BLOCK_MAX = 4096
+
+class EntryBlock:
+    """The fixed-width fields of a run of consecutive sibling entries.
+
+    The fields for every entry are decoded up front (one C call per
+    entry), and each field can then be retrieved for the whole block
+    as a column via column().  That allows callers to test a block
+    with a few tight passes and only create ExistingEntry objects for
+    the entries that matter.
+    """
+    def __init__(self, m, ofs, n, names=None, rows=None):
+        if names is None:
+            names = []
+            rows = []
+            for i in xrange(n):
+                eon = m.find('\0', ofs)
+                assert(eon >= 0)
+                assert(eon > ofs)
+                names.append(str(buffer(m, ofs, eon-ofs)))
+                rows.append((eon + 1, _ent_unpack_from(m, eon + 1)))
+                ofs = eon + 1 + ENTLEN
+        self._m = m
+        self.names = names
+        self._rows = rows
+        self.end = ofs
+        self._columns = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def column(self, field):
+        """Return a list of the values of field (see ENT_FIELDS) for
+        each entry.  Times are the raw seconds, see the *_ns fields."""
+        col = self._columns.get(field)
+        if col is None:
+            i = _ent_field_i[field]
+            col = self._columns[field] = [row[i] for ofs, row in self._rows]
+        return col
+
+    def subset(self, indexes):
+        return EntryBlock(self._m, self.end, len(indexes),
+                          names=[self.names[i] for i in indexes],
+                          rows=[self._rows[i] for i in indexes])
+
+    def entry(self, i, parent, name):
+        ofs, row = self._rows[i]
+        return ExistingEntry(parent, self.names[i], name, self._m, ofs,
+                             fields=row)
+
+
+def select_flags(on=0, off=0):
+    """Return an iter() select function that chooses the entries with
+    all of the "on" flags set and all of the "off" flags clear."""
+    def select(block):
+        return [(f & on) == on and not (f & off)
+                for f in block.column('flags')]
+    return select
+
 
 class Reader:
     def __init__(self, filename):
@@ -383,6 +701,9 @@ class Reader:
         self.m = ''
         self.writable = False
         self.count = 0
+        # children_ofs -> (basenames, record offsets) in ascending name
+        # order, filled in by _child_index() as directories are visited.
+        self._dir_ix = {}
         f = None
         try:
             f = open(filename, 'r+')
@@ -421,25 +742,113 @@ class Reader:
             yield ExistingEntry(None, basename, basename, self.m, eon+1)
             ofs = eon + 1 + ENTLEN
 
-    def iter(self, name=None, wantrecurse=None):
-        if len(self.m) > len(INDEX_HDR)+ENTLEN:
+    def iter(self, name=None, wantrecurse=None, select=None):
+        """Yield the entries at or below name, children before their
+        parents.  Don't descend into an entry unless wantrecurse(entry)
+        is true (if specified).  If select is specified, only yield
+        the entries it chooses; it will be called with EntryBlocks of
+        the candidates and must return a sequence of booleans, one for
+        each entry in the block."""
+        if name and name != '/':
+            for e in self._iter_under(name, wantrecurse, select):
+                yield e
+        elif len(self.m) > len(INDEX_HDR)+ENTLEN:
             dname = name
             if dname and not dname.endswith('/'):
                 dname += '/'
-            root = ExistingEntry(None, '/', '/',
-                                 self.m, len(self.m)-FOOTLEN-ENTLEN)
-            for sub in root.iter(name=name, wantrecurse=wantrecurse):
+            root_ofs = len(self.m)-FOOTLEN-ENTLEN
+            root_fields = _ent_unpack_from(self.m, root_ofs)
+            root = ExistingEntry(None, '/', '/', self.m, root_ofs,
+                                 fields=root_fields)
+            for sub in root.iter(name=name, wantrecurse=wantrecurse,
+                                 select=select):
                 yield sub
             if not dname or dname == root.name:
+                if select:
+                    block = EntryBlock(self.m, root_ofs, 1, names=['/'],
+                                       rows=[(root_ofs, root_fields)])
+                    if not select(block)[0]:
+                        return
                 yield root
 
+    def _iter_under(self, name, wantrecurse, select):
+        # Go straight to the parent of name via _lookup() rather than
+        # scanning every directory along the way.
+        parts = pathsplit(name)
+        parent = self._lookup(parts[:-1], wantrecurse)
+        if not parent:
+            return
+        base = parts[-1]
+        if base.endswith('/'):
+            candidates = (base,)
+        else:
+            candidates = (base + '/', base)  # i.e. in index order
+        for base in candidates:
+            e = self._child(parent, base)
+            if not e:
+                continue
+            if e.children_n and (not wantrecurse or wantrecurse(e)):
+                for sub in e.iter(wantrecurse=wantrecurse, select=select):
+                    yield sub
+            if select:
+                block = EntryBlock(self.m, e._ofs, 1, names=[e.basename],
+                                   rows=[(e._ofs,
+                                          _ent_unpack_from(self.m, e._ofs))])
+                if not select(block)[0]:
+                    continue
+            yield e
+
+    def _child_index(self, parent):
+        """Return (basenames, offsets) for the children of parent, in
+        ascending name order, where each offset is the position of the
+        child's record."""
+        if not parent.children_n:
+            return (), ()
+        ix = self._dir_ix.get(parent.children_ofs)
+        if ix is None:
+            m = self.m
+            names = []
+            offsets = []
+            ofs = parent.children_ofs
+            for i in xrange(parent.children_n):
+                eon = m.find('\0', ofs)
+                assert(eon > ofs)
+                names.append(str(buffer(m, ofs, eon-ofs)))
+                offsets.append(eon + 1)
+                ofs = eon + 1 + ENTLEN
+            # The index stores siblings in reverse order.
+            names.reverse()
+            offsets.reverse()
+            ix = self._dir_ix[parent.children_ofs] = (names, offsets)
+        return ix
+
+    def _child(self, parent, basename):
+        names, offsets = self._child_index(parent)
+        i = bisect_left(names, basename)
+        if i == len(names) or names[i] != basename:
+            return None
+        return ExistingEntry(parent, basename, parent.name + basename,
+                             self.m, offsets[i])
+
+    def _lookup(self, parts, wantrecurse=None):
+        """Return the entry for the path split into parts by
+        pathsplit(), or None if it's not in the index, or if it's below
+        a (non-root) directory for which wantrecurse() is false."""
+        if not parts or parts[0] != '/' \
+           or len(self.m) <= len(INDEX_HDR)+ENTLEN:
+            return None
+        e = ExistingEntry(None, '/', '/', self.m, len(self.m)-FOOTLEN-ENTLEN)
+        for part in parts[1:]:
+            e = self._child(e, part)
+            if not e or (wantrecurse and not wantrecurse(e)):
+                return None
+        return e
+
     def __iter__(self):
         return self.iter()
 
     def find(self, name):
-        return next((e for e in self.iter(name, wantrecurse=lambda x : True)
-                     if e.name == name),
-                    None)
+        return self._lookup(pathsplit(name))
 
     def exists(self):
         return self.m
@@ -455,15 +864,30 @@ class Reader:
             self.m = None
             self.writable = False
 
-    def filter(self, prefixes, wantrecurse=None):
+    def pending_totals(self, prefixes):
+        """Return the number and total size of the entries under each
+        prefix, as per filter(), that need to be saved."""
+        n = size = 0
+        for (rp, path) in reduce_paths(prefixes, quiet=True):
+            e = self.find(rp)
+            if e:
+                e_n, e_size = e.pending_totals()
+                n += e_n
+                size += e_size
+        return n, size
+
+    def filter(self, prefixes, wantrecurse=None, select=None):
+        """Yield (name, entry) for the entries under each prefix, as
+        per iter().  Unless select is specified, always yield at least
+        the entry for the prefix itself."""
         for (rp, path) in reduce_paths(prefixes):
             any_entries = False
-            for e in self.iter(rp, wantrecurse=wantrecurse):
+            for e in self.iter(rp, wantrecurse=wantrecurse, select=select):
                 any_entries = True
                 assert(e.name.startswith(rp))
                 name = path + e.name[len(rp):]
                 yield (name, e)
-            if not any_entries:
+            if not any_entries and not select:
                 # Always return at least the top for each prefix.
                 # Otherwise something like "save x/y" will produce
                 # nothing if x is up to date.
@@ -573,14 +997,15 @@ class Writer:
         return Reader(self.tmpname)
 
 
-def _slashappend_or_add_error(p, caller):
+def _slashappend_or_add_error(p, caller, quiet=False):
     """Return p, after ensuring it has a single trailing slash if it names
     a directory, unless there's an OSError, in which case, call
-    add_error() and return None."""
+    add_error() (unless quiet) and return None."""
     try:
         st = os.lstat(p)
     except OSError as e:
-        add_error('%s: %s' % (caller, e))
+        if not quiet:
+            add_error('%s: %s' % (caller, e))
         return None
     else:
         if stat.S_ISDIR(st.st_mode):
@@ -595,10 +1020,11 @@ def unique_resolved_paths(paths):
     return frozenset((x for x in rps if x is not None))
 
 
-def reduce_paths(paths):
+def reduce_paths(paths, quiet=False):
     xpaths = []
     for p in paths:
-        rp = _slashappend_or_add_error(resolve_parent(p), 'reduce_paths')
+        rp = _slashappend_or_add_error(resolve_parent(p), 'reduce_paths',
+                                       quiet=quiet)
         if rp:
             xpaths.append((rp, slashappend(p) if rp.endswith('/') else p))
     xpaths.sort()
@@ -0,0 +1,368 @@
+"""Change journal for bup index.
+
+"bup index --watch" runs a Watcher, which uses Linux inotify to record
+the paths that change below the watched directories in a journal next
+to the index (i.e. bupindex.journal), so that "bup index -u
+--from-journal" can restat just those paths instead of walking the
+whole tree.
+
+The journal is a sequence of records, each a one byte kind followed by
+a path and a NUL.  Directory paths end with a slash.  The kinds are:
+
+  PATH:   restat the path (and nothing below it)
+  TREE:   restat the path and everything below it
+  RESET:  the journal can't be trusted (the watcher just started, or
+          the kernel dropped events); walk everything
+
+The watcher holds an exclusive lock on the watch file (i.e.
+bupindex.watch) for as long as it runs, and once it's ready, writes
+the watched directories there.  So a reader can tell whether the
+journal covers a given directory via watched_roots().
+
+The watcher only writes its records out every so often, so before
+taking the journal, a reader asks it (via sync()) to write out what it
+has seen so far: it creates a request file next to the index
+(bupindex.sync.*), and the watcher, which also watches the index's
+directory, writes out its records and removes the file when it gets
+to the request's event.  The kernel queues a watcher's events in
+order, so by then, it has handled every change made before the
+request.
+
+The watcher appends to the journal while holding a lock on it, and
+take() moves the journal aside (to bupindex.journal.pending) under the
+same lock, so no records are lost.  The pending records are only
+removed by finish(), after the index has been updated.
+"""
+
+import errno, fcntl, os, select, stat, struct, tempfile, time
+
+from bup import _helpers
+from bup.helpers import atomically_replaced_file, debug1, log, unlink
+
+
+PATH = 'p'
+TREE = 'r'
+RESET = 'R'
+
+_inotify_init = getattr(_helpers, 'inotify_init', None)
+
+# How long sync() waits for the watcher to answer.
+SYNC_TIMEOUT = 10
+
+_event_sig = 'iIII'  # struct inotify_event: wd, mask, cookie, len
+_event_len = struct.calcsize(_event_sig)
+
+
+class Error(Exception):
+    pass
+
+
+def encode(records):
+    return ''.join(kind + path + '\0' for kind, path in records)
+
+
+def decode(data):
+    return [(rec[0], rec[1:]) for rec in data.split('\0')[:-1]]
+
+
+def append(filename, records):
+    """Append records to the journal filename."""
+    data = encode(records)
+    while True:
+        fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0600)
+        f = os.fdopen(fd, 'ab')
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            # Make sure take() didn't move the journal aside while we
+            # were waiting for the lock.
+            st = os.fstat(f.fileno())
+            try:
+                cur = os.stat(filename)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                cur = None
+            if cur and (cur.st_dev, cur.st_ino) == (st.st_dev, st.st_ino):
+                f.write(data)
+                f.flush()
+                return
+        finally:
+            f.close()
+
+
+def take(filename):
+    """Move the records in the journal filename to the pending journal,
+    and return all of the pending records."""
+    pending = filename + '.pending'
+    try:
+        f = open(filename, 'rb')
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        f = None
+    if f:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            if os.path.exists(pending):
+                with open(pending, 'ab') as pf:
+                    pf.write(f.read())
+                    pf.flush()
+                    os.fsync(pf.fileno())
+                os.unlink(filename)
+            else:
+                os.rename(filename, pending)
+        finally:
+            f.close()
+    try:
+        with open(pending, 'rb') as f:
+            return decode(f.read())
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return []
+
+
+def finish(filename, remainder=()):
+    """Replace the pending records for the journal filename with
+    remainder, i.e. the records that haven't been handled."""
+    pending = filename + '.pending'
+    if remainder:
+        with atomically_replaced_file(pending, 'wb') as f:
+            f.write(encode(remainder))
+    else:
+        try:
+            os.unlink(pending)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def watched_roots(filename):
+    """Return the directories a running watcher covers, according to
+    the watch file filename, or None if no watcher is running."""
+    try:
+        f = open(filename, 'rb')
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    try:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return f.read().split('\0')[:-1]
+        return None
+    finally:
+        f.close()
+
+
+def _sync_prefix(indexfile):
+    return os.path.basename(indexfile) + '.sync.'
+
+
+def sync(indexfile, timeout=SYNC_TIMEOUT):
+    """Ask the watcher for indexfile to write out the changes it has
+    seen so far, and wait for it.  Return false if it didn't answer
+    within timeout seconds."""
+    fd, name = tempfile.mkstemp(prefix=_sync_prefix(indexfile),
+                                dir=os.path.dirname(indexfile) or '.')
+    os.close(fd)
+    deadline = time.time() + timeout
+    while os.path.exists(name):
+        if time.time() >= deadline:
+            unlink(name)
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def covering(tops, path):
+    """Return the first of tops that contains path, or None.  Only the
+    tops that end in '/' (i.e. directories) contain anything besides
+    themselves."""
+    for top in tops:
+        if path == top.rstrip('/') \
+           or (top.endswith('/') and path.startswith(top)):
+            return top
+    return None
+
+
+_watch_mask = 0
+if _inotify_init:
+    _watch_mask = (_helpers.IN_MODIFY | _helpers.IN_ATTRIB
+                   | _helpers.IN_MOVED_FROM | _helpers.IN_MOVED_TO
+                   | _helpers.IN_CREATE | _helpers.IN_DELETE
+                   | _helpers.IN_ONLYDIR | _helpers.IN_DONT_FOLLOW)
+    _entries_changed = (_helpers.IN_CREATE | _helpers.IN_DELETE
+                        | _helpers.IN_MOVED_FROM | _helpers.IN_MOVED_TO)
+
+
+class Watcher:
+    """Record the changes below roots (directory paths ending in '/')
+    in the journal for indexfile, leaving out the paths that excludes
+    (an ExcludeMatcher, if given) matches, and everything below them."""
+    def __init__(self, indexfile, roots, xdev=False, skip=(), excludes=None):
+        if not _inotify_init:
+            raise Error('inotify is not supported on this system')
+        self.journal = indexfile + '.journal'
+        self._sync_dir = os.path.dirname(os.path.abspath(indexfile)) + '/'
+        self._sync_prefix = _sync_prefix(indexfile)
+        self._sync_wd = None
+        self.roots = roots
+        self.xdev = xdev
+        self.skip = frozenset(skip)
+        self.excludes = excludes
+        self.records = set()
+        self.wds = {}
+        self.fd = None
+        self._limit_warned = False
+        self._state = open(indexfile + '.watch', 'a+b')
+        try:
+            fcntl.flock(self._state.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                raise Error('%s is already being watched' % indexfile)
+            raise
+        self._state.truncate(0)
+        self._state.flush()
+        self.fd = _inotify_init()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self._state:
+            self._state.close()
+            self._state = None
+
+    def start(self):
+        """Watch the roots, and once that's done, mark the journal as
+        requiring a full walk, and advertise the roots."""
+        # Watch for sync() requests (see the module docs).
+        self._sync_wd = _helpers.inotify_add_watch(self.fd, self._sync_dir,
+                                                   _watch_mask)
+        for root in self.roots:
+            self._watch(root, os.lstat(root).st_dev)
+        append(self.journal, [(RESET, '')])
+        self._state.write(''.join(root + '\0' for root in self.roots))
+        self._state.flush()
+
+    def _watch(self, top, dev):
+        # Watch each directory before listing it, so nothing created
+        # in between is missed.
+        dirs = [top]
+        while dirs:
+            path = dirs.pop()
+            try:
+                wd = _helpers.inotify_add_watch(self.fd, path, _watch_mask)
+            except OSError as e:
+                if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                if e.errno != errno.ENOSPC:
+                    log('warning: unable to watch %r: %s\n' % (path, e))
+                    continue
+                if not self._limit_warned:
+                    log('warning: inotify watch limit reached;'
+                        ' index updates will walk the whole tree\n')
+                    self._limit_warned = True
+                self.records.add((RESET, ''))
+                continue
+            self.wds[wd] = (path, dev)
+            try:
+                names = os.listdir(path)
+            except OSError as e:
+                continue
+            for name in names:
+                sub = path + name + '/'
+                try:
+                    st = os.lstat(sub[:-1])
+                except OSError:
+                    continue
+                if not stat.S_ISDIR(st.st_mode) or self._excluded(sub):
+                    continue
+                if self.xdev and st.st_dev != dev:
+                    continue
+                dirs.append(sub)
+
+    def _excluded(self, path):
+        if path.endswith('/') and path[:-1] in self.skip:
+            return True
+        return bool(self.excludes) and self.excludes.excluded(path)
+
+    def _unwatch(self, top):
+        for wd, (path, dev) in self.wds.items():
+            if path.startswith(top):
+                del self.wds[wd]
+                try:
+                    _helpers.inotify_rm_watch(self.fd, wd)
+                except OSError:
+                    pass
+
+    def handle_event(self, wd, mask, name):
+        if mask & _helpers.IN_Q_OVERFLOW:
+            debug1('watch: event queue overflowed\n')
+            self.records.add((RESET, ''))
+            return
+        if wd == self._sync_wd and name.startswith(self._sync_prefix):
+            if mask & (_helpers.IN_CREATE | _helpers.IN_MOVED_TO):
+                self.flush()
+                unlink(self._sync_dir + name)
+            return
+        watched = self.wds.get(wd)
+        if not watched:
+            return
+        dir, dev = watched
+        if mask & _helpers.IN_IGNORED:
+            del self.wds[wd]
+            return
+        if not name:
+            self.records.add((PATH, dir))
+            return
+        isdir = mask & _helpers.IN_ISDIR
+        path = dir + name + (isdir and '/' or '')
+        if isdir and mask & _helpers.IN_MOVED_FROM:
+            self._unwatch(path)
+        if not self._excluded(path):
+            if isdir and mask & (_helpers.IN_CREATE | _helpers.IN_MOVED_TO):
+                self._watch(path, dev)
+                self.records.add((TREE, path))
+            else:
+                self.records.add((PATH, path))
+        if mask & _entries_changed:
+            self.records.add((PATH, dir))
+
+    def read_events(self):
+        data = os.read(self.fd, 65536)
+        ofs = 0
+        while ofs < len(data):
+            wd, mask, cookie, n = struct.unpack_from(_event_sig, data, ofs)
+            ofs += _event_len
+            name = data[ofs:ofs + n].rstrip('\0')
+            ofs += n
+            self.handle_event(wd, mask, name)
+
+    def flush(self):
+        if self.records:
+            append(self.journal, sorted(self.records))
+            self.records = set()
+
+    def run(self, interval=1):
+        """Record changes until interrupted, flushing the records to the
+        journal at most every interval seconds, or when sync() asks."""
+        last_flush = time.time()
+        try:
+            while True:
+                timeout = max(0, last_flush + interval - time.time())
+                ready = select.select([self.fd], [], [], timeout)[0]
+                if ready:
+                    self.read_events()
+                if time.time() - last_flush >= interval:
+                    self.flush()
+                    last_flush = time.time()
+        finally:
+            self.flush()
@@ -1,11 +1,16 @@
 
-import git, glob, mmap, os, struct
+import git, glob, math, os, struct
 
-from bup import _helpers
-from bup.helpers import log, mmap_read
+from bup import _helpers, xstat
+from bup.helpers import (Sha1, atomically_replaced_file, debug1, log,
+                         mmap_read, unlink)
 
 
-MIDX_VERSION = 4
+MIDX_VERSION = 5
+MIDX_HDR = '!4sIII'
+MIDX_HDRLEN = struct.calcsize(MIDX_HDR)
+PAGE_SIZE = 4096
+SHA_PER_PAGE = PAGE_SIZE/20.
 
 extract_bits = _helpers.extract_bits
 _total_searches = 0
@@ -17,6 +22,13 @@ class PackMidx:
     Multiple index (.midx) files constitute a wrapper around index (.idx) files
     and make it possible for bup to expand Git's indexing capabilities to vast
     amounts of files.
+
+    After the header (MIDX_HDR: magic, version, bits, and the number of
+    64-bit offsets), a midx contains a fanout table of 2^bits entries,
+    the sorted SHAs, and for each SHA, the number of the idx it came
+    from, its CRC, and its offset in the pack, where, as in an idx v2
+    file, offsets with the high bit set refer to the table of 64-bit
+    offsets that follows.  The idx names come last.
     """
     def __init__(self, filename):
         self.name = filename
@@ -40,15 +52,20 @@ class PackMidx:
             self.force_keep = True  # new stuff is exciting
             return self._init_failed()
 
-        self.bits = _helpers.firstword(self.map[8:12])
+        self.bits, self.nofs64 \
+            = struct.unpack(MIDX_HDR, self.map[0:MIDX_HDRLEN])[2:]
         self.entries = 2**self.bits
-        self.fanout = buffer(self.map, 12, self.entries*4)
-        self.sha_ofs = 12 + self.entries*4
+        self.fanout = buffer(self.map, MIDX_HDRLEN, self.entries*4)
+        self.sha_ofs = MIDX_HDRLEN + self.entries*4
         self.nsha = nsha = self._fanget(self.entries-1)
         self.shatable = buffer(self.map, self.sha_ofs, nsha*20)
         self.which_ofs = self.sha_ofs + 20*nsha
         self.whichlist = buffer(self.map, self.which_ofs, nsha*4)
-        self.idxnames = str(self.map[self.which_ofs + 4*nsha:]).split('\0')
+        self.crc_ofs = self.which_ofs + 4*nsha
+        self.ofs_ofs = self.crc_ofs + 4*nsha
+        self.ofs64_ofs = self.ofs_ofs + 4*nsha
+        names_ofs = self.ofs64_ofs + 8*self.nofs64
+        self.idxnames = str(self.map[names_ofs:]).split('\0')
 
     def __del__(self):
         self.close()
@@ -74,6 +91,17 @@ class PackMidx:
     def _get_idxname(self, i):
         return self.idxnames[self._get_idx_i(i)]
 
+    def _get_ofs(self, i):
+        ofs = struct.unpack_from('!I', self.map, self.ofs_ofs + i*4)[0]
+        if ofs & 0x80000000:
+            idx64 = ofs & 0x7fffffff
+            ofs = struct.unpack_from('!Q', self.map,
+                                     self.ofs64_ofs + idx64*8)[0]
+        return ofs
+
+    def _get_crc(self, i):
+        return struct.unpack_from('!I', self.map, self.crc_ofs + i*4)[0]
+
     def close(self):
         if self.map is not None:
             self.map.close()
@@ -81,6 +109,27 @@ class PackMidx:
 
     def exists(self, hash, want_source=False):
         """Return nonempty if the object exists in the index files."""
+        i = self._idx_from_hash(hash)
+        if i is None:
+            return None
+        return want_source and self._get_idxname(i) or True
+
+    def locate(self, hash):
+        """Return (idx name, pack offset, crc) for the object, or None
+        if it isn't in the index files."""
+        i = self._idx_from_hash(hash)
+        if i is None:
+            return None
+        return self._get_idxname(i), self._get_ofs(i), self._get_crc(i)
+
+    def find_offset(self, hash):
+        """Get the offset of an object inside its pack file."""
+        i = self._idx_from_hash(hash)
+        if i is None:
+            return None
+        return self._get_ofs(i)
+
+    def _idx_from_hash(self, hash):
         global _total_searches, _total_steps
         _total_searches += 1
         want = str(hash)
@@ -110,9 +159,21 @@ class PackMidx:
                 end = mid
                 endv = _helpers.firstword(v)
             else: # got it!
-                return want_source and self._get_idxname(mid) or True
+                return mid
         return None
 
+    def exists_many(self, shas, want_source=False):
+        """Return a bitmap (see helpers.bitmap_isset()) of which of
+        shas, a string of packed 20-byte hashes, exist in the index
+        files, or with want_source, (bitmap, sources), where sources
+        lists what exists() would return for each of them."""
+        table = buffer(self.shatable, 0, len(self)*20)
+        if not want_source:
+            return _helpers.sorted_exists_many(table, 20, 0, shas, False)
+        found, positions = _helpers.sorted_exists_many(table, 20, 0, shas, True)
+        return found, [pos is not None and self._get_idxname(pos) or None
+                       for pos in positions]
+
     def __iter__(self):
         for i in xrange(self._fanget(self.entries-1)):
             yield buffer(self.shatable, i*20, 20)
@@ -125,3 +186,199 @@ def clear_midxes(dir=None):
     dir = dir or git.repo('objects/pack')
     for midx in glob.glob(os.path.join(dir, '*.midx')):
         os.unlink(midx)
+
+
+def _layout(ix, name_base):
+    """Return the write_midx_range() input tuple describing ix."""
+    n = len(ix)
+    if isinstance(ix, PackMidx):
+        return (ix.name, n, ix.sha_ofs, ix.which_ofs, name_base,
+                ix.crc_ofs, ix.ofs_ofs, ix.ofs64_ofs, ix.nofs64)
+    if isinstance(ix, git.PackIdxV2):
+        crc_ofs = ix.sha_ofs + 20*n
+        # (The idx ends with the pack and idx SHAs.)
+        return (ix.name, n, ix.sha_ofs, 0, name_base,
+                crc_ofs, crc_ofs + 4*n, crc_ofs + 8*n,
+                (len(ix.ofs64table) - 40) // 8)
+    raise git.GitError('%r: only v2 idx files can be merged' % ix.name)
+
+
+def _write_ranges(fd, bits, inp, jobs):
+    """Write the tables for the inputs inp to the midx file fd,
+    splitting the fanout table into jobs ranges written by as many
+    processes in parallel."""
+    entries = 2**bits
+    jobs = max(1, min(jobs, entries))
+    if jobs == 1:
+        _helpers.write_midx_range(fd, bits, 0, entries, inp)
+        return
+    outstanding = []
+    failed = 0
+    for i in xrange(jobs):
+        pid = os.fork()
+        if pid:  # parent
+            outstanding.append(pid)
+            continue
+        # child: never unwind the parent's stack, which would remove
+        # the midx being written.
+        rc = 99
+        try:
+            try:
+                _helpers.write_midx_range(fd, bits, entries*i // jobs,
+                                          entries*(i+1) // jobs, inp)
+                rc = 0
+            except Exception as e:
+                log('midx: %s\n' % e)
+        finally:
+            os._exit(rc)
+    # Only reap our own children; the caller may have others.
+    for pid in outstanding:
+        pid, rc = os.waitpid(pid, 0)
+        if rc:
+            failed += 1
+    if failed:
+        raise git.GitError('%d of %d midx jobs failed' % (failed, jobs))
+
+
+def create(outdir, outfilename, infilenames, auto=False, force=False,
+           prefixstr='', jobs=1):
+    """Merge the idx and midx files infilenames into one midx named
+    outfilename (or one named after the inputs in outdir), and return
+    (object count, midx name), or None if there was nothing to do.
+    With auto or force, don't bother with fewer than two inputs, and
+    with auto, with fewer than three small ones.
+
+    The inputs are merged with a heap, and the result is written out
+    sequentially, so memory use doesn't depend on the number of
+    objects, and only one input file is open at a time.  With jobs,
+    that many processes write disjoint ranges of the midx in parallel.
+    """
+    if not outfilename:
+        assert(outdir)
+        sum = Sha1('\0'.join(infilenames)).hexdigest()
+        outfilename = '%s/midx-%s.midx' % (outdir, sum)
+
+    inp = []
+    total = 0
+    ofs64_total = 0
+    allfilenames = []
+    for name in infilenames:
+        ix = git.open_idx(name)
+        try:
+            layout = _layout(ix, len(allfilenames))
+            for iname in ix.idxnames:
+                allfilenames.append(os.path.basename(iname))
+        finally:
+            if isinstance(ix, PackMidx):
+                ix.close()
+            ix = None
+        inp.append(layout)
+        total += layout[1]
+        ofs64_total += layout[8]
+
+    debug1('midx: %screating from %d files (%d objects).\n'
+           % (prefixstr, len(infilenames), total))
+    if (auto and (total < 1024 and len(infilenames) < 3)) \
+       or ((auto or force) and len(infilenames) < 2) \
+       or (force and not total):
+        debug1('midx: nothing to do.\n')
+        return
+
+    pages = int(total/SHA_PER_PAGE) or 1
+    bits = int(math.ceil(math.log(pages, 2)))
+    entries = 2**bits
+    debug1('midx: table size: %d (%d bits)\n' % (entries*4, bits))
+
+    unlink(outfilename)
+    with atomically_replaced_file(outfilename, 'wb') as f:
+        f.write(struct.pack(MIDX_HDR, 'MIDX', MIDX_VERSION, bits,
+                            ofs64_total))
+        assert(f.tell() == MIDX_HDRLEN)
+        end = MIDX_HDRLEN + 4*entries + 32*total + 8*ofs64_total
+        f.truncate(end)
+        f.flush()
+        _write_ranges(f.fileno(), bits, inp, jobs)
+        f.seek(end)
+        f.write('\0'.join(allfilenames))
+
+    return total, outfilename
+
+
+def _group(l, count):
+    for i in xrange(0, len(l), count):
+        yield l[i:i+count]
+
+
+def _create_group(outdir, outfilename, infiles, auto, force, max_open, jobs):
+    groups = list(_group(infiles, max_open or len(infiles)))
+    gprefix = ''
+    for n,sublist in enumerate(groups):
+        if len(groups) != 1:
+            gprefix = 'Group %d: ' % (n+1)
+        rv = create(outdir, outfilename, sublist, auto=auto, force=force,
+                    prefixstr=gprefix, jobs=jobs)
+        if rv:
+            yield rv
+
+
+def update_dir(path, outfilename=None, auto=True, force=False, max_open=None,
+               jobs=1):
+    """Merge the idx and midx files in path (at most max_open at a
+    time, if given) until there are only a few (or with force, one)
+    left, removing any redundant midx files, and return the names of
+    the midx files created.  See create() for jobs."""
+    already = {}
+    sizes = {}
+    if force and not auto:
+        midxs = []   # don't use existing midx files
+    else:
+        midxs = glob.glob('%s/*.midx' % path)
+        contents = {}
+        for mname in midxs:
+            m = git.open_idx(mname)
+            contents[mname] = [('%s/%s' % (path,i)) for i in m.idxnames]
+            sizes[mname] = len(m)
+
+        # sort the biggest+newest midxes first, so that we can eliminate
+        # smaller (or older) redundant ones that come later in the list
+        midxs.sort(key=lambda ix: (-sizes[ix], -xstat.stat(ix).st_mtime))
+
+        for mname in midxs:
+            any = 0
+            for iname in contents[mname]:
+                if not already.get(iname):
+                    already[iname] = 1
+                    any = 1
+            if not any:
+                debug1('%r is redundant\n' % mname)
+                unlink(mname)
+                already[mname] = 1
+
+    midxs = [k for k in midxs if not already.get(k)]
+    idxs = []
+    for iname, count in git.idx_counts(path).iteritems():
+        if not already.get(iname):
+            idxs.append(iname)
+            sizes[iname] = count
+
+    all = [(sizes[n],n) for n in (midxs + idxs)]
+
+    # FIXME: what are the optimal values?  Does this make sense?
+    DESIRED_HWM = force and 1 or 5
+    DESIRED_LWM = force and 1 or 2
+    existed = dict((name,1) for sz,name in all)
+    debug1('midx: %d indexes; want no more than %d.\n'
+           % (len(all), DESIRED_HWM))
+    if len(all) <= DESIRED_HWM:
+        debug1('midx: nothing to do.\n')
+    while len(all) > DESIRED_HWM:
+        all.sort()
+        part1 = [name for sz,name in all[:len(all)-DESIRED_LWM+1]]
+        part2 = all[len(all)-DESIRED_LWM+1:]
+        all = list(_create_group(path, outfilename, part1,
+                                 auto, force, max_open, jobs)) + part2
+        if len(all) > DESIRED_HWM:
+            debug1('\nStill too many indexes (%d > %d).  Merging again.\n'
+                   % (len(all), DESIRED_HWM))
+
+    return [name for sz,name in all if not existed.get(name)]
@@ -29,8 +29,7 @@ def filter_branch(tip_commit_hex, exclude, writer):
     first_exclusion = next(i for i, c in enumerate(commits) if exclude(c))
     if first_exclusion != 0:
         last_c = commits[first_exclusion - 1]
-        tree = get_commit_items(last_c.encode('hex'),
-                                git.cp()).tree.decode('hex')
+        tree = git.get_commit_summary(last_c).tree
         commits = commits[first_exclusion:]
     for c in commits:
         if exclude(c):
@@ -0,0 +1,212 @@
+"""Split database.
+
+The database records, for each large regular file saved by "bup save
+--assume-appends", the id of the object the file was saved as and the
+list of (sha, size, level) blobs it was split into, so that if the
+file has only grown since, just its tail has to be split again (see
+hashsplit.split_to_blobs()).  It's stored next to the index (i.e.
+bupindex.splits) and looked up via mmap.
+
+The file consists of a header naming the chunker and fanout the blobs
+were split with (records for any other setting are ignored), followed
+by two sections:
+
+  records: rec_n records (path_ofs, path_len, oid, blobs_ofs, blob_n)
+           sorted by path, where the offsets are relative to the data
+           section.
+  data:    the paths and the blob lists, each blob a BLOB record.
+"""
+
+import errno, os, struct
+
+from bup import git
+from bup.helpers import atomically_replaced_file, mmap_read
+
+
+SPLITDB_MAGIC = 'BSPL'
+SPLITDB_VERSION = 1
+SPLITDB_HDR = '!4sI16sII'
+SPLITDB_HDRLEN = struct.calcsize(SPLITDB_HDR)
+SPLITDB_REC = '!QI20sQQ'
+SPLITDB_RECLEN = struct.calcsize(SPLITDB_REC)
+BLOB = '!20sIB'
+BLOBLEN = struct.calcsize(BLOB)
+
+# Smaller files aren't worth recording.
+MIN_SIZE = 1024 * 1024
+# The number of old blobs (besides the first and the last stable one)
+# that are read back to check that a file has only grown.
+SAMPLES = 16
+
+
+class Error(Exception):
+    pass
+
+
+def blobs(packed):
+    """Yield the (sha, size, level) tuples in packed, a BLOB array."""
+    for ofs in xrange(0, len(packed), BLOBLEN):
+        yield struct.unpack_from(BLOB, packed, ofs)
+
+
+def pack_blobs(it, out):
+    """Append each (sha, size, level) tuple from it to the bytearray out
+    as it's yielded."""
+    for blob in it:
+        out.extend(struct.pack(BLOB, *blob))
+        yield blob
+
+
+def grown_prefix(f, packed, exists):
+    """Return (size, packed blobs) for the part of f that packed, the
+    blobs f was saved as, still describes if f has only been appended
+    to since, or None.  That's every blob but the last, which may have
+    only ended where it did because the file did.  Check that all of
+    those blobs are still in the repository (via exists), and as a
+    sample, that the first, the last, and SAMPLES others still match
+    the file.  Leave f positioned at the end of the prefix."""
+    n = len(packed) // BLOBLEN
+    if n < 2:
+        return None
+    picks = set(i * (n - 2) // (SAMPLES + 1) for i in xrange(SAMPLES + 2))
+    samples = []
+    ofs = 0
+    for i, (sha, size, level) in enumerate(blobs(packed)):
+        if i < n - 1:
+            if not exists(sha):
+                return None
+            if i in picks:
+                samples.append((ofs, sha, size))
+        ofs += size
+    if os.fstat(f.fileno()).st_size <= ofs:
+        return None
+    for ofs, sha, size in samples:
+        f.seek(ofs)
+        if git.calc_hash('blob', f.read(size)) != sha:
+            return None
+    ofs, sha, size = samples[-1]
+    f.seek(ofs + size)
+    return ofs + size, buffer(packed, 0, (n - 1) * BLOBLEN)
+
+
+class SplitDB:
+    def __init__(self, filename, chunker, fanout):
+        self._filename = filename
+        self._chunker = chunker
+        self._fanout = fanout
+        self._changed = {}  # path -> (oid, packed blobs) or None
+        self._rec_n = 0
+        self._m = None
+        try:
+            f = open(filename, 'rb')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        m = mmap_read(f)
+        if len(m) < SPLITDB_HDRLEN:
+            raise Error('%r is truncated' % filename)
+        magic, ver, db_chunker, db_fanout, rec_n \
+            = struct.unpack_from(SPLITDB_HDR, m)
+        if magic != SPLITDB_MAGIC or ver != SPLITDB_VERSION:
+            raise Error('unexpected split database format in %r' % filename)
+        if (db_chunker.rstrip('\0'), db_fanout) == (chunker, fanout):
+            self._m = m
+            self._rec_n = rec_n
+            self._data_ofs = SPLITDB_HDRLEN + rec_n * SPLITDB_RECLEN
+        else:
+            # The blobs wouldn't match a fresh split, so start over.
+            self._changed = None
+
+    def _rec(self, i):
+        return struct.unpack_from(SPLITDB_REC, self._m,
+                                  SPLITDB_HDRLEN + i * SPLITDB_RECLEN)
+
+    def _path(self, rec):
+        ofs = self._data_ofs + rec[0]
+        return self._m[ofs:ofs + rec[1]]
+
+    def _blobs(self, rec):
+        return buffer(self._m, self._data_ofs + rec[3], rec[4] * BLOBLEN)
+
+    def _find(self, path):
+        lo, hi = 0, self._rec_n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            rec = self._rec(mid)
+            name = self._path(rec)
+            if name < path:
+                lo = mid + 1
+            elif name > path:
+                hi = mid
+            else:
+                return rec
+        return None
+
+    def get(self, path):
+        """Return (oid, packed blobs) for path, or None."""
+        if self._changed is None:
+            return None
+        if path in self._changed:
+            return self._changed[path]
+        rec = self._find(path)
+        if not rec:
+            return None
+        return rec[2], self._blobs(rec)
+
+    def set(self, path, oid, packed):
+        if self._changed is None:
+            self._changed = {}
+        self._changed[path] = (oid, packed)
+
+    def remove(self, path):
+        if self.get(path):
+            self._changed[path] = None
+
+    def _merged(self, keep):
+        """Yield (path, oid, packed blobs) for each record in path order."""
+        changed = sorted(self._changed.iteritems()) if self._changed else []
+        ci = 0
+        for i in xrange(self._rec_n):
+            rec = self._rec(i)
+            path = self._path(rec)
+            while ci < len(changed) and changed[ci][0] < path:
+                if changed[ci][1]:
+                    yield (changed[ci][0],) + changed[ci][1]
+                ci += 1
+            if ci < len(changed) and changed[ci][0] == path:
+                if changed[ci][1]:
+                    yield (path,) + changed[ci][1]
+                ci += 1
+            elif not keep or keep(path):
+                yield path, rec[2], self._blobs(rec)
+        for path, val in changed[ci:]:
+            if val:
+                yield (path,) + val
+
+    def commit(self, keep=None):
+        """Write the database, if anything changed, dropping the
+        unchanged records whose path doesn't satisfy keep (if given)."""
+        if self._changed is not None and not self._changed:
+            if not keep or all(keep(self._path(self._rec(i)))
+                               for i in xrange(self._rec_n)):
+                return
+        recs = list(self._merged(keep))
+        if not recs:
+            try:
+                os.unlink(self._filename)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            return
+        with atomically_replaced_file(self._filename, 'wb') as f:
+            f.write(struct.pack(SPLITDB_HDR, SPLITDB_MAGIC, SPLITDB_VERSION,
+                                self._chunker, self._fanout, len(recs)))
+            ofs = 0
+            for path, oid, packed in recs:
+                f.write(struct.pack(SPLITDB_REC, ofs, len(path), oid,
+                                    ofs + len(path), len(packed) // BLOBLEN))
+                ofs += len(path) + len(packed)
+            for path, oid, packed in recs:
+                f.write(path)
+                f.write(packed)
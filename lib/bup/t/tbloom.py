@@ -4,7 +4,7 @@ import errno, platform, tempfile
 from wvtest import *
 
 from bup import bloom
-from bup.helpers import mkdirp
+from bup.helpers import bitmap_isset, mkdirp
 from buptest import no_lingering_errors, test_tempdir
 
 
@@ -18,21 +18,28 @@ def test_bloom():
             ix = Idx()
             ix.name='dummy.idx'
             ix.shatable = ''.join(hashes)
-            for k in (4, 5):
-                b = bloom.create(tmpdir + '/pybuptest.bloom', expected=100, k=k)
+            for k, blocked in ((4, False), (5, False), (4, True), (5, True)):
+                b = bloom.create(tmpdir + '/pybuptest.bloom', expected=100, k=k,
+                                 blocked=blocked)
                 b.add_idx(ix)
-                WVPASSLT(b.pfalse_positive(), .1)
+                # Small blocked filters fill unevenly.
+                WVPASSLT(b.pfalse_positive(), blocked and .2 or .1)
                 b.close()
                 b = bloom.ShaBloom(tmpdir + '/pybuptest.bloom')
+                WVPASSEQ(b.blocked, blocked)
                 all_present = True
                 for h in hashes:
                     all_present &= b.exists(h)
                 WVPASS(all_present)
                 false_positives = 0
-                for h in [os.urandom(20) for i in range(1000)]:
+                others = [os.urandom(20) for i in range(1000)]
+                for h in others:
                     if b.exists(h):
                         false_positives += 1
                 WVPASSLT(false_positives, 5)
+                found = b.exists_many(''.join(hashes + others))
+                WVPASS(all(bool(bitmap_isset(found, i)) == bool(b.exists(h))
+                           for i, h in enumerate(hashes + others)))
                 os.unlink(tmpdir + '/pybuptest.bloom')
 
             tf = tempfile.TemporaryFile(dir=tmpdir)
@@ -58,3 +65,23 @@ def test_bloom():
                     raise
             if not skip_test:
                 WVPASSEQ(b.k, 4)
+
+
+@wvtest
+def test_blocked_bloom():
+    with no_lingering_errors():
+        with test_tempdir('bup-tbloom-') as tmpdir:
+            b = bloom.create(tmpdir + '/pybuptest.bloom', expected=1000,
+                             blocked=True)
+            WVPASSEQ(b.k, 5)
+            WVPASSEQ(b.entries, 0)
+            b.add(os.urandom(20))
+            table = str(b.map[16:16 + 2**b.bits])
+            used = [i for i, c in enumerate(table) if c != '\0']
+            WVPASS(used)
+            WVPASSEQ(used[0] // 64, used[-1] // 64)
+            # The estimate should be a bit worse than the classic one.
+            b.entries = 1000
+            WVPASSLT(b.pfalse_positive(), 0.5)
+            WVPASSLT(0.01, b.pfalse_positive())
+            b.close()
@@ -141,6 +141,27 @@ def test_midx_refreshing():
             WVPASSEQ(len(pi.packs), 1)
 
 
+@wvtest
+def test_config_get():
+    with no_lingering_errors():
+        with test_tempdir('bup-tclient-') as tmpdir:
+            os.environ['BUP_MAIN_EXE'] = '../../../bup'
+            os.environ['BUP_DIR'] = bupdir = tmpdir
+            git.init_repo(bupdir)
+            subprocess.check_call(['git', 'config', 'bup.test', 'x y'],
+                                  cwd=bupdir)
+            c = client.Client(bupdir, create=True)
+            WVPASSEQ(c.config_get('bup.test'), 'x y')
+            WVPASSEQ(c.config_get('bup.unset'), None)
+            WVPASS('config-get' in c._server_commands())
+            # Pretend the server predates config-get.
+            c._commands = c._server_commands() - set(['config-get'])
+            WVPASSEQ(c.config_get('bup.test'), None)
+            WVPASSEQ(c.repo_generation(), None)
+            WVPASSEQ(c.read_ref('refs/heads/unset'), None)
+            c.close()
+
+
 @wvtest
 def test_remote_parsing():
     with no_lingering_errors():
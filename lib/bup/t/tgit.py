@@ -1,11 +1,12 @@
 
-from subprocess import check_call
-import struct, os, time
+from subprocess import PIPE, Popen, check_call
+import errno, glob, random, struct, os, time
 
 from wvtest import *
 
-from bup import git
-from bup.helpers import localtime, log, mkdirp, readpipe
+from bup import bloom, git, midx
+from bup.helpers import (bitmap_isset, localtime, log, mkdirp, readpipe,
+                         unlink)
 from buptest import no_lingering_errors, test_tempdir
 
 
@@ -126,6 +127,30 @@ def testpacks():
             WVFAIL(r.exists('\0'*20))
 
 
+@wvtest
+def test_skip_incompressible():
+    with no_lingering_errors():
+        with test_tempdir('bup-tgit-') as tmpdir:
+            os.environ['BUP_MAIN_EXE'] = bup_exe
+            os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+            git.init_repo(bupdir)
+            noise = os.urandom(10000)
+            text = 'all work and no play makes jack a dull boy\n' * 300
+            w = git.PackWriter(skip_incompressible=True)
+            WVPASSEQ(w.incompressible_summary(), None)
+            blobs = [w.new_blob(noise), w.new_blob(text),
+                     w.new_blob(noise[:100])]
+            WVPASSEQ(w.uncompressed_count, 1)
+            WVPASSEQ(w.uncompressed_bytes, len(noise))
+            WVPASSEQ(w.compressed_bytes, len(text) + 100)
+            WVPASS(w.incompressible_summary())
+            w.close()
+            # The pack is valid either way.
+            cat = git.cp()
+            for sha, content in zip(blobs, (noise, text, noise[:100])):
+                WVPASSEQ(''.join(cat.join(sha.encode('hex'))), content)
+
+
 @wvtest
 def test_pack_name_lookup():
     with no_lingering_errors():
@@ -153,6 +178,146 @@ def test_pack_name_lookup():
                     WVPASSEQ(r.exists(hashes[i], want_source=True), idxname)
 
 
+@wvtest
+def test_refresh_stamp():
+    with no_lingering_errors():
+        with test_tempdir('bup-tgit-') as tmpdir:
+            os.environ['BUP_MAIN_EXE'] = bup_exe
+            os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+            git.init_repo(bupdir)
+            packdir = git.repo('objects/pack')
+            names = []
+            for start in range(0, 6, 2):
+                w = git.PackWriter()
+                for i in range(start, start + 2):
+                    w.new_blob(str(i))
+                names.append(w.close() + '.idx')
+            old = time.time() - 60
+            os.utime(packdir, (old, old))
+            r = git.PackIdxList(packdir)
+            WVPASSEQ(len(r.packs), 3)
+            b = r.bloom
+            WVPASS(b)
+            # Nothing changed, so nothing is reopened.
+            r.refresh()
+            WVPASS(r.bloom is b)
+            WVPASSEQ(len(r.packs), 3)
+            # A change, even a very recent one, is noticed.
+            os.unlink(names[0])
+            r.refresh()
+            WVPASSEQ(sorted(p.name for p in r.packs), sorted(names[1:]))
+            WVPASS(r.bloom is not b)
+            r.refresh(skip_midx=True)
+            WVPASSEQ(len(r.packs), 2)
+            del r
+
+
+@wvtest
+def test_auto_midx():
+    with no_lingering_errors():
+        with test_tempdir('bup-tgit-') as tmpdir:
+            os.environ['BUP_MAIN_EXE'] = bup_exe
+            os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+            git.init_repo(bupdir)
+            packdir = git.repo('objects/pack')
+            for start in range(0, 1200, 200):
+                w = git.PackWriter()
+                for i in range(start, start + 200):
+                    w.new_blob(str(i))
+                w.close()
+            WVPASSEQ(len(glob.glob(packdir + '/*.idx')), 6)
+            midxs = glob.glob(packdir + '/*.midx')
+            WVPASSEQ(len(midxs), 1)
+            WVPASSEQ(len(git.open_idx(midxs[0]).idxnames), 5)
+            b = bloom.ShaBloom(packdir + '/bup.bloom')
+            WVPASS(b.valid())
+            WVPASSEQ(len(b), 1200)
+            WVPASSEQ(sorted(b.idxnames),
+                     sorted(os.path.basename(n)
+                            for n in glob.glob(packdir + '/*.idx')))
+            b.close()
+
+
+@wvtest
+def test_idx_counts():
+    with no_lingering_errors():
+        with test_tempdir('bup-tgit-') as tmpdir:
+            os.environ['BUP_MAIN_EXE'] = bup_exe
+            os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+            git.init_repo(bupdir)
+            packdir = git.repo('objects/pack')
+            for n in (3, 5):
+                w = git.PackWriter()
+                for i in range(n):
+                    w.new_blob(str(i) * n)
+                w.close()
+            idxs = glob.glob(packdir + '/*.idx')
+            expected = dict((name, len(git.open_idx(name))) for name in idxs)
+            WVPASSEQ(sorted(expected.values()), [3, 5])
+            for name in idxs:
+                WVPASSEQ(git.idx_object_count(name), expected[name])
+            summary = packdir + '/' + git.IDX_COUNTS_NAME
+            unlink(summary)
+            WVPASSEQ(git.idx_counts(packdir), expected)
+            WVPASS(os.path.exists(summary))
+            # The counts come from the summary while the idx is unchanged...
+            lines = open(summary).read().splitlines()
+            with open(summary, 'w') as f:
+                f.write(git.IDX_COUNTS_HEADER)
+                for line in lines[1:]:
+                    f.write('7%s\n' % line[line.index(' '):])
+            WVPASSEQ(sorted(git.idx_counts(packdir).values()), [7, 7])
+            # ...and from the idx again once it's touched or removed.
+            os.utime(idxs[0], (0, 0))
+            counts = git.idx_counts(packdir)
+            WVPASSEQ(counts[idxs[0]], expected[idxs[0]])
+            WVPASSEQ(counts[idxs[1]], 7)
+            os.unlink(idxs[1])
+            WVPASSEQ(git.idx_counts(packdir), {idxs[0]: expected[idxs[0]]})
+            WVPASSEQ(len(open(summary).read().splitlines()), 2)
+            # A corrupt summary is ignored and replaced.
+            open(summary, 'w').write(git.IDX_COUNTS_HEADER + 'junk\n')
+            WVPASSEQ(git.idx_counts(packdir), {idxs[0]: expected[idxs[0]]})
+
+
+@wvtest
+def test_exists_many():
+    with no_lingering_errors():
+        with test_tempdir('bup-tgit-') as tmpdir:
+            os.environ['BUP_MAIN_EXE'] = bup_exe
+            os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+            git.init_repo(bupdir)
+            packdir = git.repo('objects/pack')
+            hashes = []
+            for start in range(0, 1200, 200):
+                w = git.PackWriter()
+                for i in range(start, start + 200):
+                    hashes.append(w.new_blob(str(i)))
+                w.close()
+            shas = hashes[::7] + [os.urandom(20) for i in range(100)]
+            shas += hashes[:3]
+            random.shuffle(shas)
+            packed = ''.join(shas)
+            def check(ix):
+                found = ix.exists_many(packed)
+                WVPASSEQ(found, ix.exists_many(packed, want_source=True)[0])
+                sources = ix.exists_many(packed, want_source=True)[1]
+                WVPASS(all(bool(bitmap_isset(found, i)) == bool(ix.exists(sha))
+                           for i, sha in enumerate(shas)))
+                WVPASS(all(sources[i] == ix.exists(sha, want_source=True)
+                           for i, sha in enumerate(shas)))
+            names = glob.glob(packdir + '/*.idx') + glob.glob(packdir + '/*.midx')
+            WVPASSEQ(len(names), 7)
+            for name in names:
+                check(git.open_idx(name))
+            r = git.PackIdxList(packdir)
+            WVPASS(r.bloom)
+            check(r)
+            r.add(shas[0])
+            check(r)
+            WVPASSEQ(r.exists_many(''), '')
+
+
 @wvtest
 def test_long_index():
     with no_lingering_errors():
@@ -182,6 +347,81 @@ def test_long_index():
             WVPASSEQ(i.find_offset(obj3_bin), 0xff)
 
 
+def _write_random_idxs(w, dir, count, n, objs):
+    """Write count idx files with n random entries each (about half of
+    them with 64-bit offsets) to dir, record each entry's (idx name,
+    offset, crc) in objs, and return the idx paths."""
+    names = []
+    for k in range(count):
+        idx = list(list() for i in xrange(256))
+        for i in range(n):
+            sha = os.urandom(20)
+            crc = random.randrange(2**32)
+            ofs = random.choice((random.randrange(2**31),
+                                 random.randrange(2**31, 2**40)))
+            idx[ord(sha[0])].append((sha, crc, ofs))
+            objs[sha] = ('tmp%d.idx' % k, ofs, crc)
+        w.count = n
+        names.append(dir + '/tmp%d.idx' % k)
+        w._write_pack_idx_v2(names[-1], idx, os.urandom(20))
+    return names
+
+
+@wvtest
+def test_midx_offsets():
+    with no_lingering_errors():
+        with test_tempdir('bup-tgit-') as tmpdir:
+            os.environ['BUP_MAIN_EXE'] = bup_exe
+            os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+            git.init_repo(bupdir)
+            w = git.PackWriter()
+            objs = {}
+            names = _write_random_idxs(w, tmpdir, 3, 20, objs)
+            w.abort()
+            WVPASSEQ(midx.create(None, tmpdir + '/a.midx', names[:2]),
+                     (40, tmpdir + '/a.midx'))
+            WVPASSEQ(midx.create(None, tmpdir + '/b.midx',
+                                 [tmpdir + '/a.midx', names[2]]),
+                     (60, tmpdir + '/b.midx'))
+            for name, count in (('/a.midx', 40), ('/b.midx', 60)):
+                m = midx.PackMidx(tmpdir + name)
+                WVPASSEQ(len(m), count)
+                WVPASS(all(m.locate(sha) == objs[sha] for sha in objs
+                           if m.exists(sha)))
+                WVPASS(all(m.find_offset(sha) == objs[sha][1] for sha in objs
+                           if m.exists(sha)))
+                WVPASSEQ(m.locate(os.urandom(20)), None)
+                m.close()
+
+
+@wvtest
+def test_midx_jobs():
+    with no_lingering_errors():
+        with test_tempdir('bup-tgit-') as tmpdir:
+            os.environ['BUP_MAIN_EXE'] = bup_exe
+            os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+            git.init_repo(bupdir)
+            w = git.PackWriter()
+            objs = {}
+            names = _write_random_idxs(w, tmpdir, 4, 3000, objs)
+            w.abort()
+            midx.create(None, tmpdir + '/a.midx', names[:3])
+            inputs = [tmpdir + '/a.midx', names[3]]
+            for jobs in (1, 3, 64):
+                WVPASSEQ(midx.create(None, tmpdir + '/%d.midx' % jobs, inputs,
+                                     jobs=jobs),
+                         (12000, tmpdir + '/%d.midx' % jobs))
+            m = midx.PackMidx(tmpdir + '/1.midx')
+            WVPASS(m.bits > 1)
+            WVPASSEQ(len(m), 12000)
+            WVPASSEQ(list(str(sha) for sha in m), sorted(objs))
+            WVPASS(all(m.locate(sha) == objs[sha] for sha in objs))
+            m.close()
+            expected = open(tmpdir + '/1.midx').read()
+            WVPASS(open(tmpdir + '/3.midx').read() == expected)
+            WVPASS(open(tmpdir + '/64.midx').read() == expected)
+
+
 @wvtest
 def test_check_repo_or_die():
     with no_lingering_errors():
@@ -409,6 +649,157 @@ def test_list_refs():
             WVPASSEQ(frozenset(git.list_refs(limit_to_tags=True)), expected_tags)
 
 
+@wvtest
+def test_ref_updates():
+    with no_lingering_errors():
+        with test_tempdir('bup-tgit-') as tmpdir:
+            os.environ['BUP_MAIN_EXE'] = bup_exe
+            os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+            git.init_repo(bupdir)
+            def show_ref():
+                p = Popen(['git', '--git-dir', bupdir, 'show-ref'],
+                          stdout=PIPE)
+                out = p.communicate()[0]
+                return [(name, sha.decode('hex')) for sha, name
+                        in (l.split(' ') for l in out.splitlines())]
+            w = git.PackWriter()
+            h1, h2, h3 = (w.new_blob(str(i)) for i in range(3))
+            w.close()
+            git.update_ref('refs/heads/a/b', h1, None)
+            git.update_ref('refs/tags/t', h2, None)
+            WVPASSEQ(list(git.list_refs()),
+                     [('refs/heads/a/b', h1), ('refs/tags/t', h2)])
+            WVPASSEQ(list(git.list_refs()), show_ref())
+            WVPASSEQ(list(git.list_refs(['b'])), [('refs/heads/a/b', h1)])
+            WVPASSEQ(list(git.list_refs(['a'])), [])
+            WVPASSEQ(git.read_ref('a/b'), h1)
+            reflog = open(bupdir + '/logs/refs/heads/a/b').read().splitlines()
+            WVPASSEQ(len(reflog), 1)
+            WVPASS(reflog[0].startswith('0' * 40 + ' ' + h1.encode('hex')))
+            WVFAIL(os.path.exists(bupdir + '/logs/refs/tags/t'))
+
+            # Updates only happen from the expected value.
+            WVEXCEPT(git.GitError, git.update_ref, 'refs/heads/a/b', h2, h3)
+            WVEXCEPT(git.GitError, git.update_ref, 'refs/heads/a/b', h2, None)
+            WVPASSEQ(git.read_ref('a/b'), h1)
+            WVEXCEPT(git.GitError, git.update_ref, 'refs/heads/x..y', h2, None)
+            WVEXCEPT(git.GitError, git.update_ref, 'refs/heads/x.lock',
+                     h2, None)
+            # And not while git (or anyone else) holds the lock.
+            open(bupdir + '/refs/heads/a/b.lock', 'w').close()
+            WVEXCEPT(git.GitError, git.update_ref, 'refs/heads/a/b', h2, h1)
+            WVPASSEQ(list(git.list_refs(['b'])), [('refs/heads/a/b', h1)])
+            os.unlink(bupdir + '/refs/heads/a/b.lock')
+
+            # Packed refs are read, updated, and deleted.
+            exc('git', '--git-dir', bupdir, 'pack-refs', '--all')
+            WVFAIL(os.path.exists(bupdir + '/refs/heads/a/b'))
+            WVPASSEQ(list(git.list_refs()),
+                     [('refs/heads/a/b', h1), ('refs/tags/t', h2)])
+            git.update_ref('refs/heads/a/b', h2, h1)
+            WVPASSEQ(git.read_ref('a/b'), h2)
+            WVPASSEQ(list(git.list_refs()), show_ref())
+            WVEXCEPT(git.GitError, git.delete_ref, 'refs/tags/t',
+                     h1.encode('hex'))
+            git.delete_ref('refs/tags/t', h2.encode('hex'))
+            WVPASSEQ(list(git.list_refs()), [('refs/heads/a/b', h2)])
+            WVPASSEQ(list(git.list_refs()), show_ref())
+            git.delete_ref('refs/tags/t')
+            WVEXCEPT(git.GitError, git.delete_ref, 'refs/tags/t',
+                     h2.encode('hex'))
+            git.delete_ref('refs/heads/a/b')
+            WVPASSEQ(list(git.list_refs()), [])
+            WVPASSEQ(show_ref(), [])
+            WVFAIL(os.path.exists(bupdir + '/logs/refs/heads/a/b'))
+
+
+@wvtest
+def test_commit_graph():
+    with no_lingering_errors():
+        with test_tempdir('bup-tgit-') as tmpdir:
+            os.environ['BUP_MAIN_EXE'] = bup_exe
+            os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+            git.init_repo(bupdir)
+            w = git.PackWriter()
+            tree = w.new_tree([])
+            commits = []
+            parent = None
+            for i in range(3):
+                parent = w.new_commit(tree, parent, 'a <a@b>', 10 * i, 0,
+                                      'a <a@b>', 10 * i, 0, 'm')
+                commits.append(parent)
+            w.close()
+            c1, c2, c3 = commits
+            graph = git.commit_graph()
+            WVPASSEQ(len(graph), 3)
+            WVPASSEQ(graph.get(graph.find(c2)).parent_ix, graph.find(c1))
+            def git_rev_list(commit):
+                return list(git._git_rev_list(commit.encode('hex')))
+            WVPASSEQ(list(git.rev_list(c3.encode('hex'))),
+                     [(20, c3), (10, c2), (0, c1)])
+            WVPASSEQ(list(git.rev_list(c3.encode('hex'))), git_rev_list(c3))
+            WVPASSEQ(git.get_commit_dates([c2.encode('hex')]), [10])
+            WVPASSEQ(git.get_commit_summary(c3).tree, tree)
+
+            # Commits that bup didn't write are read and cached.
+            def commit_tree(*parents):
+                env = dict(os.environ, GIT_DIR=bupdir,
+                           GIT_AUTHOR_NAME='a', GIT_AUTHOR_EMAIL='a@b',
+                           GIT_COMMITTER_NAME='a', GIT_COMMITTER_EMAIL='a@b',
+                           GIT_AUTHOR_DATE='@%d +0000' % (30 + len(parents)))
+                argv = ['git', 'commit-tree', tree.encode('hex')]
+                for parent in parents:
+                    argv.extend(['-p', parent.encode('hex')])
+                p = Popen(argv, stdin=PIPE, stdout=PIPE, env=env)
+                return p.communicate('m')[0].strip().decode('hex')
+            c4 = commit_tree(c3)
+            WVPASSEQ(list(git.rev_list(c4.encode('hex'))), git_rev_list(c4))
+            graph = git.commit_graph()
+            WVPASSEQ(len(graph), 4)
+            WVPASSEQ(graph.get(graph.find(c4)).parent_ix, graph.find(c3))
+
+            # Merges are left to git.
+            c5 = commit_tree(c4, c1)
+            WVPASSEQ(list(git.rev_list(c5.encode('hex'))), git_rev_list(c5))
+            WVPASSEQ(len(git.commit_graph()), 5)
+
+            # A damaged cache is discarded and rebuilt.
+            with open(bupdir + '/bupcommits', 'ab') as f:
+                f.write('x')
+            WVPASSEQ(len(git.commit_graph()), 0)
+            WVFAIL(os.path.exists(bupdir + '/bupcommits'))
+            WVPASSEQ(list(git.rev_list(c4.encode('hex'))), git_rev_list(c4))
+            WVPASSEQ(len(git.commit_graph()), 4)
+
+            # A cache that can't be written (e.g. on a read-only mount)
+            # is just left alone.
+            graph_path = bupdir + '/bupcommits'
+            orig_open, orig_unlink = os.open, os.unlink
+            def ro_open(path, flags, *args):
+                if path == graph_path and flags & os.O_WRONLY:
+                    raise OSError(errno.EROFS, os.strerror(errno.EROFS), path)
+                return orig_open(path, flags, *args)
+            def ro_unlink(path):
+                if path == graph_path:
+                    raise OSError(errno.EROFS, os.strerror(errno.EROFS), path)
+                return orig_unlink(path)
+            try:
+                os.open, os.unlink = ro_open, ro_unlink
+                WVPASSEQ(list(git.rev_list(c5.encode('hex'))),
+                         git_rev_list(c5))
+                c6 = commit_tree(c4)
+                WVPASSEQ(list(git.rev_list(c6.encode('hex'))),
+                         git_rev_list(c6))
+                WVPASSEQ(len(git.commit_graph()), 4)
+                with open(graph_path, 'ab') as f:
+                    f.write('x')
+                WVPASSEQ(len(git.commit_graph()), 0)
+                WVPASSEQ(list(git.rev_list(c6.encode('hex'))),
+                         git_rev_list(c6))
+            finally:
+                os.open, os.unlink = orig_open, orig_unlink
+
+
 def test__git_date_str():
     with no_lingering_errors():
         WVPASSEQ('0 +0000', git._git_date_str(0, 0))
@@ -1,9 +1,10 @@
 from io import BytesIO
+import random
 
 from wvtest import *
 
 from bup import hashsplit, _helpers, helpers
-from buptest import no_lingering_errors
+from buptest import no_lingering_errors, test_tempdir
 
 
 def nr_regions(x, max_count=None):
@@ -82,6 +83,76 @@ def test_uncache_ours_upto():
             hashsplit._fadvise_pages_done = orig_pages_done
 
 
+@wvtest
+def test_readfile_iter_uncache_offset():
+    history = []
+    def mock_fadvise_pages_done(f, ofs, len):
+        history.append((f, ofs, len))
+
+    with no_lingering_errors():
+        with test_tempdir('bup-thashsplit-') as tmpdir:
+            page_size = helpers.sc_page_size
+            with open(tmpdir + '/f', 'wb') as f:
+                f.write('x' * 4 * page_size)
+            orig_fmincore = hashsplit._fmincore
+            orig_pages_done = hashsplit._fadvise_pages_done
+            try:
+                hashsplit._fmincore = lambda fd: bytearray(4)
+                hashsplit._fadvise_pages_done = mock_fadvise_pages_done
+                with open(tmpdir + '/f', 'rb') as f:
+                    f.seek(2 * page_size)
+                    data = ''.join(hashsplit.readfile_iter([f]))
+                    WVPASSEQ(len(data), 2 * page_size)
+                    WVPASSEQ([(f.fileno(), 0, 4)], history)
+            finally:
+                hashsplit._fmincore = orig_fmincore
+                hashsplit._fadvise_pages_done = orig_pages_done
+
+
+@wvtest
+def test_buf():
+    class NoReadinto:
+        def __init__(self, data):
+            self.f = BytesIO(data)
+        def read(self, size):
+            return self.f.read(size)
+
+    with no_lingering_errors():
+        for f in (BytesIO('abcdefghij'), NoReadinto('abcdefghij')):
+            buf = hashsplit.Buf()
+            WVPASSEQ(str(buf.fill(f, 4)), 'abcd')
+            WVPASSEQ(buf.used(), 4)
+            WVPASSEQ(str(buf.peek(10)), 'abcd')
+            WVPASSEQ(str(buf.get(3)), 'abc')
+            WVPASSEQ(str(buf.fill(f, 4)), 'efgh')
+            WVPASSEQ(str(buf.peek(buf.used())), 'defgh')
+            buf.eat(4)
+            slab = buf.data
+            # The unconsumed data is moved rather than the slab grown.
+            WVPASSEQ(str(buf.fill(f, 4)), 'ij')
+            WVPASS(buf.data is slab)
+            WVPASSEQ(str(buf.get(buf.used())), 'hij')
+            WVPASSEQ(str(buf.fill(f, 4)), '')
+            buf.put('klmnopqrstuvwxyz')
+            WVPASSEQ(str(buf.get(buf.used())), 'klmnopqrstuvwxyz')
+            buf.close()
+            WVPASS(buf.data is None)
+
+
+@wvtest
+def test_hashsplit_iter_blobs_kept():
+    with no_lingering_errors():
+        data = ''.join(chr(random.randrange(256)) for i in xrange(4 << 20))
+        for keep_boundaries in (False, True):
+            # The blobs stay valid after the next ones are read, even
+            # once the splitter's buffers are reused for another file.
+            blobs = list(hashsplit.hashsplit_iter([BytesIO(data)],
+                                                  keep_boundaries, None))
+            list(hashsplit.hashsplit_iter([BytesIO('x' * len(data))],
+                                          keep_boundaries, None))
+            WVPASS(''.join(str(b) for b, level in blobs) == data)
+
+
 @wvtest
 def test_rolling_sums():
     with no_lingering_errors():
@@ -133,3 +204,130 @@ def test_fanout_behaviour():
         hashsplit.BLOB_MAX = old_BLOB_MAX
         hashsplit.BLOB_READ_SIZE = old_BLOB_READ_SIZE
         hashsplit.fanout = old_fanout
+
+
+@wvtest
+def test_fastcdc():
+    with no_lingering_errors():
+        WVEXCEPT(ValueError, hashsplit.set_chunker, 'nonsense')
+        old_chunker = hashsplit.chunker
+        try:
+            hashsplit.set_chunker('fastcdc')
+            WVPASSEQ(hashsplit.chunker, 'fastcdc')
+            basebits = _helpers.blobbits()
+            rnd = random.Random(1)
+            data = ''.join(chr(rnd.randrange(256))
+                           for i in xrange(256 * 1024))
+            WVPASSEQ(_helpers.fastcdc_splitbuf(data[:2048]), (0, -1))
+            blobs = [(str(b), level) for b, level
+                     in hashsplit.hashsplit_iter([BytesIO(data)], True, None)]
+            WVPASSEQ(''.join(b for b, level in blobs), data)
+            sizes = [len(b) for b, level in blobs]
+            WVPASS(min(sizes[:-1]) > 2048)
+            WVPASS(max(sizes) <= hashsplit.BLOB_MAX)
+            for b, level in blobs[:-1]:
+                ofs, bits = _helpers.fastcdc_splitbuf(b)
+                if len(b) < hashsplit.BLOB_MAX:
+                    WVPASSEQ(ofs, len(b))
+                    WVPASS(bits >= basebits)
+            # Boundaries are content-defined, so they survive a prefix.
+            shifted = [str(b) for b, level
+                       in hashsplit.hashsplit_iter([BytesIO('x' * 100 + data)],
+                                                   True, None)]
+            WVPASS(len(set(b for b, level in blobs[1:])
+                       - set(shifted)) < 2)
+            hashsplit.set_chunker(None)
+            WVPASSEQ(hashsplit.chunker, hashsplit.DEFAULT_CHUNKER)
+        finally:
+            hashsplit.chunker = old_chunker
+
+
+@wvtest
+def test_mmap_splits():
+    with no_lingering_errors():
+        with test_tempdir('bup-thashsplit-') as tmpdir:
+            rnd = random.Random(2)
+            data = ''.join(chr(rnd.randrange(256)) for i in xrange(300000))
+            data += '\0' * 100000 + data[:50000]
+            name = tmpdir + '/data'
+            with open(name, 'wb') as f:
+                f.write(data)
+
+            def splits():
+                with open(name, 'rb') as f:
+                    return [(str(b), level) for b, level
+                            in hashsplit.hashsplit_iter([f], False, None)]
+
+            old = (hashsplit.chunker, hashsplit.mmap_min_size,
+                   hashsplit.MMAP_WINDOW, hashsplit.MMAP_RELEASE_SIZE)
+            try:
+                hashsplit.MMAP_WINDOW = 1
+                hashsplit.MMAP_RELEASE_SIZE = 10000
+                for name_ in sorted(hashsplit.CHUNKERS):
+                    hashsplit.set_chunker(name_)
+                    hashsplit.mmap_min_size = None
+                    expected = splits()
+                    hashsplit.mmap_min_size = 0
+                    mapped = splits()
+                    WVPASSEQ(''.join(b for b, level in mapped), data)
+                    WVPASSEQ(len(mapped), len(expected))
+                    WVPASS(mapped == expected)
+                    hashsplit.mmap_min_size = len(data) + 1
+                    WVPASS(splits() == expected)
+            finally:
+                (hashsplit.chunker, hashsplit.mmap_min_size,
+                 hashsplit.MMAP_WINDOW, hashsplit.MMAP_RELEASE_SIZE) = old
+
+
+@wvtest
+def test_strings_file():
+    with no_lingering_errors():
+        rnd = random.Random(3)
+        strings = [chr(65 + i % 26) * rnd.randrange(200) for i in xrange(5000)]
+        data = ''.join(strings)
+        f = hashsplit.StringsFile(strings)
+        WVPASSEQ(f.read(0), '')
+        WVPASSEQ(f.read(1000), data[:1000])
+        WVPASSEQ(f.read(1), data[1000:1001])
+        WVPASSEQ(f.read(len(data)), data[1001:])
+        WVPASSEQ(f.read(10), '')
+        split = lambda f: [str(b) for b, level
+                           in hashsplit.hashsplit_iter([f], False, None)]
+        WVPASS(split(hashsplit.StringsFile(strings)) == split(BytesIO(data)))
+
+
+@wvtest
+def test_readahead():
+    with no_lingering_errors():
+        with test_tempdir('bup-thashsplit-') as tmpdir:
+            names = [tmpdir + '/' + str(i) for i in xrange(10)]
+            for i, name in enumerate(names):
+                with open(name, 'wb') as f:
+                    f.write(str(i) * (i + 1))
+            items = names + [tmpdir + '/missing']
+            def want(name):
+                if name.endswith('missing') or int(name[-1]) % 3:
+                    return name, 4
+            ra = hashsplit.ReadAhead(items, want, 10, max_files=2)
+            seen = []
+            for name in ra:
+                seen.append(name)
+                WVPASS(len(ra._files) <= 2)
+                WVPASS(ra._bytes <= 10)
+                if name.endswith('missing'):
+                    WVEXCEPT(OSError, ra.open, name)
+                elif int(name[-1]) != 4:
+                    i = int(name[-1])
+                    f = ra.open(name)
+                    WVPASSEQ(f.read(), str(i) * (i + 1))
+                    f.close()
+            WVPASSEQ(seen, items)
+            WVPASSEQ(ra._files, {})
+            WVPASSEQ(ra._bytes, 0)
+
+            # Nothing is opened ahead without a budget.
+            ra = hashsplit.ReadAhead(names, lambda name: (name, 1), 0)
+            for name in ra:
+                WVPASSEQ(ra._files, {})
+                WVPASSEQ(ra.open(name).read()[:1], name[-1])
+            WVPASSEQ(list(hashsplit.ReadAhead([], want, 10)), [])
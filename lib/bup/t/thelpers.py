@@ -248,3 +248,28 @@ def test_valid_save_name():
         WVFAIL(valid('foo/bar.lock/baz'))
         WVFAIL(valid('.bar/baz'))
         WVFAIL(valid('foo/.bar/baz'))
+
+
+@wvtest
+def test_exclude_matcher():
+    with no_lingering_errors():
+        rxs = [re.compile(x) for x in (r'\.o$', r'^/tmp/', r'(a)\1',
+                                       r'(?i)CORE$', r'/(x|y)/$')]
+        m = helpers.ExcludeMatcher(['/foo/bar', '/baz', 'rel/x/'], rxs)
+        WVPASS(m)
+        WVFAIL(helpers.ExcludeMatcher())
+        for path in ('/foo/bar', '/foo/bar/', '/foo//bar', '/baz',
+                     'rel/x', '/src/main.o', '/tmp/', '/aa', '/core',
+                     '/a/x/'):
+            WVPASS(m.excluded(path))
+        for path in ('/foo', '/foo/', '/foo/bar/x', '/foo/barx', '/bazz',
+                     '/rel/x', '/src/main.c', '/x/tmp/', '/ab', '/a/x'):
+            WVFAIL(m.excluded(path))
+
+        # Traversals carry the node for each directory.
+        foo = m.node_for('/foo/')
+        WVPASS(foo)
+        WVPASS(m.excluded_at('/foo/bar/', m.child(foo, 'bar/')))
+        WVFAIL(m.excluded_at('/foo/baz', m.child(foo, 'baz')))
+        WVPASSEQ(m.child(m.node_for('/elsewhere/'), 'x'), None)
+        WVPASSEQ(m.node_for('/foo/bar/x/'), None)
@@ -0,0 +1,78 @@
+import cPickle, os
+
+from wvtest import *
+
+from bup import hlinkdb
+from buptest import no_lingering_errors, test_tempdir
+
+
+def saved(db):
+    db.prepare_save()
+    db.commit_save()
+
+
+@wvtest
+def test_hlinkdb():
+    with no_lingering_errors():
+        with test_tempdir('bup-thlinkdb-') as tmpdir:
+            name = tmpdir + '/hlink'
+            db = hlinkdb.HLinkDB(name)
+            db.add_path('/a/x', 1, 10)
+            db.add_path('/b/x', 1, 10)
+            db.add_path('/a/y', 1, 11)
+            db.add_path('/c/y', 1, 11)
+            db.add_path('/a/z', 2, 10)
+            WVPASSEQ(db.node_paths(1, 10), ['/a/x', '/b/x'])
+            saved(db)
+            WVPASS(os.path.exists(name))
+
+            db = hlinkdb.HLinkDB(name)
+            WVPASSEQ(db.node_paths(1, 10), ['/a/x', '/b/x'])
+            WVPASSEQ(db.node_paths(1, 11), ['/a/y', '/c/y'])
+            WVPASSEQ(db.node_paths(2, 10), ['/a/z'])
+            WVEXCEPT(KeyError, db.node_paths, 3, 10)
+
+            # Mix changes with the existing entries.
+            db.del_path('/a/x')
+            db.del_path('/nonexistent')
+            db.add_path('/0/x', 1, 10)
+            db.add_path('/c/y', 2, 10)
+            db.del_path('/a/z')
+            db.add_path('/d/w', 0, 1)
+            WVPASSEQ(db.node_paths(1, 10), ['/b/x', '/0/x'])
+            saved(db)
+
+            db = hlinkdb.HLinkDB(name)
+            WVPASSEQ(db.node_paths(0, 1), ['/d/w'])
+            WVPASSEQ(db.node_paths(1, 10), ['/b/x', '/0/x'])
+            WVPASSEQ(db.node_paths(1, 11), ['/a/y'])
+            WVPASSEQ(db.node_paths(2, 10), ['/c/y'])
+
+            # An unchanged database is left alone.
+            st = os.stat(name)
+            saved(hlinkdb.HLinkDB(name))
+            WVPASSEQ(os.stat(name).st_ino, st.st_ino)
+
+            # And an empty one is removed.
+            db = hlinkdb.HLinkDB(name)
+            for path in ('/d/w', '/b/x', '/0/x', '/a/y', '/c/y'):
+                db.del_path(path)
+            saved(db)
+            WVPASS(not os.path.exists(name))
+
+
+@wvtest
+def test_hlinkdb_legacy():
+    with no_lingering_errors():
+        with test_tempdir('bup-thlinkdb-') as tmpdir:
+            name = tmpdir + '/hlink'
+            with open(name, 'wb') as f:
+                cPickle.dump({'1:10': ['/a/x', '/b/x'], '2:3': ['/c']}, f, 2)
+            db = hlinkdb.HLinkDB(name)
+            WVPASSEQ(db.node_paths(1, 10), ['/a/x', '/b/x'])
+            saved(db)
+            with open(name, 'rb') as f:
+                WVPASSEQ(f.read(4), hlinkdb.HLINK_MAGIC)
+            db = hlinkdb.HLinkDB(name)
+            WVPASSEQ(db.node_paths(1, 10), ['/a/x', '/b/x'])
+            WVPASSEQ(db.node_paths(2, 3), ['/c'])
@@ -48,6 +48,62 @@ def index_writer():
                 os.chdir(orig_cwd)
 
 
+@wvtest
+def index_metastore_offsets():
+    with no_lingering_errors():
+        with test_tempdir('bup-tindex-') as tmpdir:
+            meta_path = tmpdir + '/index.meta'
+            m1 = metadata.from_path(lib_t_dir)
+            m2 = metadata.from_path(lib_t_dir + '/tindex.py')
+            ms = index.MetaStoreWriter(meta_path)
+            ofs1 = ms.store(m1)
+            ofs2 = ms.store(m2)
+            WVPASSNE(ofs1, ofs2)
+            WVPASSEQ(ms.store(m1), ofs1)
+            ms.close()
+            WVPASS(os.path.exists(meta_path + '.idx'))
+            meta_size = os.path.getsize(meta_path)
+
+            # Reopening should find the existing records via the index.
+            ms = index.MetaStoreWriter(meta_path)
+            WVPASSEQ(ms.store(m2), ofs2)
+            WVPASSEQ(ms.store(m1), ofs1)
+            ms.close()
+            WVPASSEQ(os.path.getsize(meta_path), meta_size)
+
+            # A missing (or stale) index is rebuilt from the store.
+            os.unlink(meta_path + '.idx')
+            ms = index.MetaStoreWriter(meta_path)
+            WVPASSEQ(ms.store(m2), ofs2)
+            ms.close()
+
+            # Records appended behind the index's back are picked up.
+            m3 = metadata.from_path(tmpdir)
+            m3.ctime = m3.mtime = m3.atime = 0
+            with open(meta_path, 'ab') as f:
+                f.write(m3.encode(include_path=False))
+            ms = index.MetaStoreWriter(meta_path)
+            WVPASSEQ(ms.store(m3), meta_size)
+            ms.close()
+            WVPASSEQ(os.path.getsize(meta_path),
+                     meta_size + len(m3.encode(include_path=False)))
+
+            # Growing the table keeps every entry.
+            ms = index.MetaStoreWriter(meta_path)
+            offsets = {}
+            for i in xrange(2 ** index.META_IX_BITS):
+                m3.uid = i
+                offsets[i] = ms.store(m3)
+            ms.close()
+            ms = index.MetaStoreWriter(meta_path)
+            found = {}
+            for i in offsets:
+                m3.uid = i
+                found[i] = ms.store(m3)
+            ms.close()
+            WVPASSEQ(found, offsets)
+
+
 def dump(m):
     for e in list(m):
         print '%s%s %s' % (e.is_valid() and ' ' or 'M',
@@ -180,3 +236,186 @@ def index_dirty():
                 w3.close()
             finally:
                 os.chdir(orig_cwd)
+
+
+@wvtest
+def index_select():
+    with no_lingering_errors():
+        with test_tempdir('bup-tindex-') as tmpdir:
+            ms = index.MetaStoreWriter(tmpdir + '/index.meta')
+            meta_ofs = ms.store(metadata.Metadata())
+            ds = xstat.stat(lib_t_dir)
+            fs = xstat.stat(lib_t_dir + '/tindex.py')
+            tmax = (time.time() - 1) * 10**9
+            w = index.Writer(tmpdir + '/index', ms, tmax)
+            for d in ('/b/', '/a/'):
+                for i in xrange(10):
+                    w.add('%s%d' % (d, 9 - i), fs, meta_ofs)
+                w.add(d, ds, meta_ofs)
+            r = w.new_reader()
+            fake_validate(r)
+            for e in r:
+                if e.name in ('/a/3', '/b/7', '/b/'):
+                    e.invalidate()
+                    e.repack()
+            old_block_max = index.BLOCK_MAX
+            try:
+                index.BLOCK_MAX = 3
+                invalid = index.select_flags(off=index.IX_HASHVALID)
+                for prefix in ('', '/', '/a', '/b/', '/b/7', '/c/'):
+                    WVPASSEQ([e.name for e in r.iter(prefix)],
+                             [e.name for e in r.iter(prefix, select=None)])
+                    WVPASSEQ([e.name for e in r.iter(prefix, select=invalid)],
+                             [e.name for e in r.iter(prefix)
+                              if not e.flags & index.IX_HASHVALID])
+                WVPASSEQ([e.name for e in r.iter('/b/', select=invalid)],
+                         ['/b/7', '/b/'])
+                WVPASSEQ([e.name for e in r.iter(select=invalid,
+                                                 wantrecurse=lambda e: False)],
+                         ['/b/', '/a/', '/'])
+            finally:
+                index.BLOCK_MAX = old_block_max
+            w.close()
+
+
+@wvtest
+def index_find():
+    with no_lingering_errors():
+        with test_tempdir('bup-tindex-') as tmpdir:
+            ms = index.MetaStoreWriter(tmpdir + '/index.meta')
+            meta_ofs = ms.store(metadata.Metadata())
+            ds = xstat.stat(lib_t_dir)
+            fs = xstat.stat(lib_t_dir + '/tindex.py')
+            tmax = (time.time() - 1) * 10**9
+            w = index.Writer(tmpdir + '/index', ms, tmax)
+            for name in ('/b/z', '/b/y/', '/b/', '/a/c/x', '/a/c/', '/a/c',
+                         '/a/b', '/a/a/y', '/a/a/', '/a/a.x/', '/a/'):
+                w.add(name, name.endswith('/') and ds or fs, meta_ofs)
+            r = w.new_reader()
+            all = [e.name for e in r]
+            WVPASSEQ(r.find('/').name, '/')
+            for name in all:
+                WVPASSEQ(r.find(name).name, name)
+            for name in ('', '/c', '/a', '/a/c/y', '/a/a.x', 'a/'):
+                WVPASSEQ(r.find(name), None)
+            for name in ('/a', '/a/', '/a/a', '/a/c', '/a/c/', '/a/c/x', '/b',
+                         '/b/y', '/c', '/c/', '/a/a.', '/a/a.x/'):
+                dname = name.endswith('/') and name or name + '/'
+                WVPASSEQ([e.name for e in r.iter(name)],
+                         [n for n in all if n == name or n.startswith(dname)])
+            WVPASSEQ(r.find('/a/a/y').parent.parent.name, '/a/')
+            WVPASSEQ([e.name for e in r.iter('/a/c/',
+                                             wantrecurse=lambda e: e.name != '/a/')],
+                     [])
+            WVPASSEQ([e.name for e in r.iter('/a/c/',
+                                             wantrecurse=lambda e: e.name != '/a/c/')],
+                     ['/a/c/'])
+            w.close()
+
+
+@wvtest
+def index_verified_gen():
+    with no_lingering_errors():
+        with test_tempdir('bup-tindex-') as tmpdir:
+            ms = index.MetaStoreWriter(tmpdir + '/index.meta')
+            meta_ofs = ms.store(metadata.Metadata())
+            ds = xstat.stat(lib_t_dir)
+            fs = xstat.stat(lib_t_dir + '/tindex.py')
+            tmax = (time.time() - 1) * 10**9
+            w = index.Writer(tmpdir + '/index', ms, tmax)
+            w.add('/a/x', fs, meta_ofs)
+            w.add('/a/', ds, meta_ofs)
+            w.close()
+            r = index.Reader(tmpdir + '/index')
+            fake_validate(r)
+            for e in r:
+                WVPASSEQ(e.verified_gen, 0)
+                WVFAIL(e.verified_in(0))
+                e.verified_gen = 42
+                e.repack()
+            r = index.Reader(tmpdir + '/index')
+            e = r.find('/a/x')
+            WVPASS(e.verified_in(42))
+            WVFAIL(e.verified_in(43))
+            e.invalidate()
+            WVFAIL(e.verified_in(42))
+            WVPASSEQ(e.verified_gen, 0)
+            e.repack()
+            WVPASSEQ(r.find('/a/x').verified_gen, 0)
+            # The parent was invalidated too.
+            WVFAIL(r.find('/a/').verified_in(42))
+            WVFAIL(r.find('/').verified_in(42))
+
+
+@wvtest
+def index_validate_clears_sha_missing():
+    with no_lingering_errors():
+        with test_tempdir('bup-tindex-') as tmpdir:
+            ms = index.MetaStoreWriter(tmpdir + '/index.meta')
+            meta_ofs = ms.store(metadata.Metadata())
+            fs = xstat.stat(lib_t_dir + '/tindex.py')
+            tmax = (time.time() - 1) * 10**9
+            w = index.Writer(tmpdir + '/index', ms, tmax)
+            w.add('/x', fs, meta_ofs)
+            w.close()
+            r = index.Reader(tmpdir + '/index')
+            e = r.find('/x')
+            e.validate(0100644, index.FAKE_SHA)
+            e.repack()
+            # E.g. save found the entry's objects missing.
+            e.set_sha_missing(True)
+            WVPASS(r.find('/x').flags & index.IX_SHAMISSING)
+            # Once it's saved again, they aren't.
+            e.validate(0100644, index.FAKE_SHA)
+            e.repack()
+            WVFAIL(r.find('/x').sha_missing())
+            WVFAIL(r.find('/x').flags & index.IX_SHAMISSING)
+
+
+@wvtest
+def index_pending_totals():
+    with no_lingering_errors():
+        with test_tempdir('bup-tindex-') as tmpdir:
+            ms = index.MetaStoreWriter(tmpdir + '/index.meta')
+            meta_ofs = ms.store(metadata.Metadata())
+            ds = xstat.stat(lib_t_dir)
+            fs = xstat.stat(lib_t_dir + '/tindex.py')
+            tmax = (time.time() - 1) * 10**9
+            w = index.Writer(tmpdir + '/index', ms, tmax)
+            for name in ('/a/c/y', '/a/c/x', '/a/c/', '/a/b', '/a/'):
+                w.add(name, name.endswith('/') and ds or fs, meta_ofs)
+            w.close()
+            r = index.Reader(tmpdir + '/index')
+            fsize, dsize = fs.st_size, ds.st_size
+            WVPASSEQ(r.find('/a/c/x').pending_totals(), (1, fsize))
+            WVPASSEQ(r.find('/a/c/').pending_totals(), (3, 2 * fsize + dsize))
+            WVPASSEQ(r.find('/').pending_totals(), (6, 3 * fsize + 2 * dsize))
+
+            # Updates in place are reflected in the directories above.
+            fake_validate(r)
+            WVPASSEQ(r.find('/').pending_totals(), (0, 0))
+            e = r.find('/a/c/x')
+            e.invalidate()
+            e.repack()
+            WVPASSEQ(r.find('/a/c/').pending_totals(), (2, fsize + dsize))
+            WVPASSEQ(r.find('/').pending_totals(), (4, fsize + 2 * dsize))
+            e.set_deleted()
+            e.repack()
+            WVPASSEQ(r.find('/').pending_totals(), (3, 2 * dsize))
+            r.close()
+
+            # Merging recomputes them.
+            w = index.Writer(tmpdir + '/new', ms, tmax)
+            w.add('/a/d', fs, meta_ofs)
+            wr = w.new_reader()
+            mi = index.Writer(tmpdir + '/index', ms, tmax)
+            r = index.Reader(tmpdir + '/index')
+            for e in index.merge(r, wr):
+                mi.add_ixentry(e)
+            r.close()
+            mi.close()
+            wr.close()
+            w.abort()
+            r = index.Reader(tmpdir + '/index')
+            WVPASSEQ(r.find('/a/').pending_totals(), (3, fsize + 2 * dsize))
+            WVPASSEQ(r.find('/').pending_totals(), (4, fsize + 2 * dsize))
@@ -0,0 +1,123 @@
+import fcntl, os, re, select, threading
+
+from wvtest import *
+
+from bup import journal
+from bup.helpers import ExcludeMatcher
+from buptest import no_lingering_errors, test_tempdir
+
+
+@wvtest
+def test_journal():
+    with no_lingering_errors():
+        with test_tempdir('bup-tjournal-') as tmpdir:
+            name = tmpdir + '/journal'
+            WVPASSEQ(journal.take(name), [])
+            journal.append(name, [(journal.RESET, '')])
+            journal.append(name, [(journal.PATH, '/x/y'),
+                                  (journal.TREE, '/x/z/')])
+            WVPASSEQ(journal.take(name), [(journal.RESET, ''),
+                                          (journal.PATH, '/x/y'),
+                                          (journal.TREE, '/x/z/')])
+            WVFAIL(os.path.exists(name))
+
+            # Until finish(), the pending records are returned again,
+            # along with anything new.
+            journal.append(name, [(journal.PATH, '/a')])
+            WVPASSEQ(journal.take(name), [(journal.RESET, ''),
+                                          (journal.PATH, '/x/y'),
+                                          (journal.TREE, '/x/z/'),
+                                          (journal.PATH, '/a')])
+            journal.finish(name, [(journal.PATH, '/a')])
+            WVPASSEQ(journal.take(name), [(journal.PATH, '/a')])
+            journal.finish(name)
+            WVPASSEQ(journal.take(name), [])
+            WVFAIL(os.path.exists(name + '.pending'))
+
+            WVPASSEQ(journal.covering(['/x/', '/y'], '/x/a'), '/x/')
+            WVPASSEQ(journal.covering(['/x/', '/y'], '/x'), '/x/')
+            WVPASSEQ(journal.covering(['/x/', '/y'], '/y'), '/y')
+            WVPASSEQ(journal.covering(['/x/', '/y'], '/xx'), None)
+            WVPASSEQ(journal.covering(['/x/', '/y'], '/y2'), None)
+            WVPASSEQ(journal.covering(['/x/', '/y'], '/y/a'), None)
+
+
+@wvtest
+def test_watched_roots():
+    with no_lingering_errors():
+        with test_tempdir('bup-tjournal-') as tmpdir:
+            name = tmpdir + '/watch'
+            WVPASSEQ(journal.watched_roots(name), None)
+            with open(name, 'wb') as f:
+                f.write('/x/\0/y/\0')
+            WVPASSEQ(journal.watched_roots(name), None)
+            with open(name, 'rb') as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                WVPASSEQ(journal.watched_roots(name), ['/x/', '/y/'])
+
+
+@wvtest
+def test_watcher_excludes():
+    if not journal._inotify_init:
+        return
+    with no_lingering_errors():
+        with test_tempdir('bup-tjournal-') as tmpdir:
+            src = tmpdir + '/src/'
+            os.makedirs(src + 'a/b')
+            os.makedirs(src + 'ex/c')
+            excludes = ExcludeMatcher([src + 'ex'], [re.compile(r'/skip/$')])
+            w = journal.Watcher(tmpdir + '/index', [src], excludes=excludes)
+            try:
+                w.start()
+                WVPASSEQ(sorted(path for path, dev in w.wds.itervalues()),
+                         [src, src + 'a/', src + 'a/b/'])
+                os.mkdir(src + 'skip')
+                open(src + 'ex/c/x', 'w').close()
+                open(src + 'a/x', 'w').close()
+                w.read_events()
+                WVPASSEQ(sorted(w.records),
+                         [(journal.PATH, src), (journal.PATH, src + 'a/'),
+                          (journal.PATH, src + 'a/x')])
+                WVPASSEQ(len(w.wds), 3)
+            finally:
+                w.close()
+
+
+@wvtest
+def test_watcher_sync():
+    if not journal._inotify_init:
+        return
+    with no_lingering_errors():
+        with test_tempdir('bup-tjournal-') as tmpdir:
+            src = tmpdir + '/src/'
+            os.makedirs(src)
+            index = tmpdir + '/index'
+            w = journal.Watcher(index, [src])
+            try:
+                w.start()
+                WVPASSEQ(journal.take(w.journal), [(journal.RESET, '')])
+                journal.finish(w.journal)
+                open(src + 'x', 'w').close()
+                done = []
+                def read_events():
+                    while not done:
+                        if select.select([w.fd], [], [], 0.01)[0]:
+                            w.read_events()
+                reader = threading.Thread(target=read_events)
+                reader.start()
+                try:
+                    WVPASS(journal.sync(index))
+                finally:
+                    done.append(True)
+                    reader.join()
+                WVPASSEQ(journal.take(w.journal),
+                         [(journal.PATH, src), (journal.PATH, src + 'x')])
+                WVPASSEQ(w.records, set())
+                WVPASSEQ([name for name in os.listdir(tmpdir)
+                          if '.sync.' in name], [])
+                # Without an answer, sync() gives up (and cleans up).
+                WVFAIL(journal.sync(index, timeout=0))
+                WVPASSEQ([name for name in os.listdir(tmpdir)
+                          if '.sync.' in name], [])
+            finally:
+                w.close()
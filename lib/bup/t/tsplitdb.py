@@ -0,0 +1,82 @@
+import os
+
+from wvtest import *
+
+from bup import git, splitdb
+from buptest import no_lingering_errors, test_tempdir
+
+
+def packed(blobs):
+    out = bytearray()
+    for blob in splitdb.pack_blobs(blobs, out):
+        pass
+    return out
+
+
+@wvtest
+def test_splitdb():
+    with no_lingering_errors():
+        with test_tempdir('bup-tsplitdb-') as tmpdir:
+            name = tmpdir + '/splits'
+            a = packed([('a' * 20, 10, 0), ('b' * 20, 5, 1)])
+            b = packed([('c' * 20, 7, 0)])
+            db = splitdb.SplitDB(name, 'rollsum', 16)
+            WVPASSEQ(db.get('/x'), None)
+            db.set('/x', 'X' * 20, a)
+            db.set('/y', 'Y' * 20, b)
+            db.commit()
+            db = splitdb.SplitDB(name, 'rollsum', 16)
+            oid, blobs = db.get('/x')
+            WVPASSEQ(oid, 'X' * 20)
+            WVPASSEQ(list(splitdb.blobs(blobs)),
+                     [('a' * 20, 10, 0), ('b' * 20, 5, 1)])
+            WVPASSEQ(db.get('/y')[0], 'Y' * 20)
+
+            db.remove('/x')
+            db.set('/w', 'W' * 20, b)
+            WVPASSEQ(db.get('/x'), None)
+            db.commit()
+            db = splitdb.SplitDB(name, 'rollsum', 16)
+            WVPASSEQ(db.get('/x'), None)
+            WVPASSEQ(db.get('/w')[0], 'W' * 20)
+            WVPASSEQ(db.get('/y')[0], 'Y' * 20)
+            db.commit(keep=lambda path: path != '/y')
+            db = splitdb.SplitDB(name, 'rollsum', 16)
+            WVPASSEQ(db.get('/y'), None)
+            WVPASSEQ(db.get('/w')[0], 'W' * 20)
+
+            # Records for another chunker or fanout don't apply.
+            WVPASSEQ(splitdb.SplitDB(name, 'fastcdc', 16).get('/w'), None)
+            db = splitdb.SplitDB(name, 'rollsum', 4)
+            WVPASSEQ(db.get('/w'), None)
+            db.commit()
+            WVPASS(not os.path.exists(name))
+
+
+@wvtest
+def test_grown_prefix():
+    with no_lingering_errors():
+        with test_tempdir('bup-tsplitdb-') as tmpdir:
+            data = ['%d' % i * 100 for i in xrange(40)]
+            blobs = packed((git.calc_hash('blob', d), len(d), 0)
+                           for d in data)
+            prefix_len = sum(len(d) for d in data[:-1])
+            everything = lambda sha: True
+            name = tmpdir + '/f'
+            with open(name, 'wb') as f:
+                f.write(''.join(data))
+            with open(name, 'rb') as f:
+                WVPASSEQ(splitdb.grown_prefix(f, blobs, everything), None)
+            with open(name, 'ab') as f:
+                f.write('more')
+            with open(name, 'rb') as f:
+                size, prefix = splitdb.grown_prefix(f, blobs, everything)
+                WVPASSEQ(size, prefix_len)
+                WVPASSEQ(f.tell(), prefix_len)
+                WVPASSEQ(str(prefix), str(blobs[:-splitdb.BLOBLEN]))
+                WVPASSEQ(splitdb.grown_prefix(f, blobs, lambda sha: False),
+                         None)
+            with open(name, 'r+b') as f:
+                f.write('x')
+            with open(name, 'rb') as f:
+                WVPASSEQ(splitdb.grown_prefix(f, blobs, everything), None)
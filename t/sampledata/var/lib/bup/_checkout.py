@@ -0,0 +1,3 @@
+COMMIT='0ba245ce04601d71faf1a91ea21eaa95aebff939'
+NAMES='(tag: 0ba245c)'
+DATE='2026-10-19 07:46:40 +0000'
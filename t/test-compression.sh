@@ -42,4 +42,18 @@ compression_9_size=$(WVPASS fs-size "$BUP_DIR") || exit $?
 WVPASS [ "$compression_9_size" -lt "$compression_0_size" ]
 
 
+WVSTART "skip incompressible"
+WVPASS force-delete "$BUP_DIR"
+WVPASS bup init
+WVPASS bup random --seed=1 1M > noise
+WVPASS bup split -n noise --skip-incompressible noise 2> split.log
+WVPASS grep -q "incompressible blobs (.* bytes) uncompressed" split.log
+WVPASS bup join noise > noise.out
+WVPASS cmp noise noise.out
+WVPASS git fsck --strict
+WVPASS bup split -n docs --skip-incompressible "$top/Documentation"/*.md \
+    2> split.log
+WVFAIL grep -q "incompressible blobs" split.log
+
+
 WVPASS rm -rf "$tmpdir"
@@ -0,0 +1,108 @@
+#!/usr/bin/env bash
+. ./wvtest-bup.sh || exit $?
+. t/lib.sh || exit $?
+
+set -o pipefail
+
+top="$(WVPASS pwd)" || exit $?
+
+if ! PYTHONPATH="$top/lib" bup-python \
+     -c 'from bup import _helpers; _helpers.inotify_init' 2> /dev/null; then
+    WVSTART 'inotify unavailable; skipping test'
+    exit 0
+fi
+
+tmpdir="$(WVPASS wvmktempdir)" || exit $?
+export BUP_DIR="$tmpdir/bup"
+
+bup() { "$top/bup" "$@"; }
+
+wait-for-watcher()
+{
+    local i
+    for i in $(seq 50); do
+        test -s "$BUP_DIR/bupindex.watch" && return 0
+        sleep 0.2
+    done
+    return 1
+}
+
+WVPASS cd "$tmpdir"
+WVPASS bup init
+WVPASS mkdir -p src/a src/b src/c
+WVPASS touch src/a/1 src/a/2 src/b/1 src/c/1
+# Make sure the index doesn't consider the timestamps racy.
+WVPASS sleep 2
+WVPASS bup index --fake-valid src
+
+WVSTART "index --watch"
+WVFAIL bup index --watch -u src
+"$top/bup" index --watch src &
+watcher=$!
+trap "kill $watcher 2> /dev/null" EXIT
+WVPASS wait-for-watcher
+WVFAIL bup index --watch src
+
+WVSTART "index --from-journal (after watcher start)"
+WVPASS echo 1 >> src/a/1
+WVPASS bup index -u --from-journal src 2> from-journal.log
+WVPASS grep -q 'walking the whole tree' from-journal.log
+WVPASSEQ "$(bup index -m src)" "src/a/1
+src/a/
+src/"
+
+WVSTART "index --from-journal"
+WVPASS bup index --fake-valid src
+WVPASS echo 2 >> src/a/2
+WVPASS rm src/a/1
+WVPASS mkdir -p src/d/e
+WVPASS touch src/d/e/1 src/d/x
+WVPASS mv src/b src/B
+WVPASS rm -r src/c
+WVPASS touch src/excluded
+WVPASS bup index -u --from-journal --exclude src/excluded src \
+    2> from-journal.log
+WVFAIL grep -q 'walking the whole tree' from-journal.log
+journal_status="$(WVPASS bup index -s src)" || exit $?
+WVPASS bup index -u --exclude src/excluded src
+WVPASSEQ "$journal_status" "$(bup index -s src)"
+WVPASSEQ "$(bup index -m src)" "src/d/x
+src/d/e/1
+src/d/e/
+src/d/
+src/a/2
+src/a/
+src/B/1
+src/B/
+src/"
+
+WVSTART "index --from-journal (other paths)"
+WVPASS rm src/excluded
+WVPASS bup index --fake-valid src
+WVPASS touch src/a/3 src/B/2
+WVPASS bup index -u --from-journal src/a 2> from-journal.log
+WVFAIL grep -q 'walking the whole tree' from-journal.log
+WVPASSEQ "$(bup index -m src)" "src/a/3
+src/a/
+src/"
+WVPASS bup index -u --from-journal src/B
+WVPASSEQ "$(bup index -m src)" "src/a/3
+src/a/
+src/B/2
+src/B/
+src/"
+
+WVSTART "index --from-journal (no watcher)"
+WVPASS kill $watcher
+wait $watcher
+WVPASS touch src/a/4
+WVPASS bup index -u --from-journal src 2> from-journal.log
+WVPASS grep -q 'no watcher running' from-journal.log
+WVPASSEQ "$(bup index -m src)" "src/a/4
+src/a/3
+src/a/
+src/B/2
+src/B/
+src/"
+
+WVPASS rm -rf "$tmpdir"
@@ -121,6 +121,8 @@ f
 a
 ./"
 WVPASS bup save -r ":$BUP_DIR" -n r-test $D
+# save keeps the index's totals of what there's left to save up to date.
+WVPASS bup index --check -p $D > /dev/null
 WVFAIL bup save -r ":$BUP_DIR/fake/path" -n r-test $D
 WVFAIL bup save -r ":$BUP_DIR" -n r-test $D/fake/path
 
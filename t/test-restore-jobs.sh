@@ -0,0 +1,60 @@
+#!/usr/bin/env bash
+. ./wvtest-bup.sh || exit $?
+
+set -o pipefail
+
+top="$(WVPASS pwd)" || exit $?
+tmpdir="$(WVPASS wvmktempdir)" || exit $?
+export BUP_DIR="$tmpdir/bup"
+
+bup() { "$top/bup" "$@"; }
+
+# Print the metadata of everything below $1 that a restore sets.
+tree-meta()
+{
+    (WVPASS cd "$1" &&
+        WVPASS find . -mindepth 1 -print0 | LC_ALL=C WVPASS sort -z \
+            | WVPASS xargs -0 "$top/bup" xstat --exclude-fields ctime,atime) \
+        2> /dev/null
+}
+
+WVPASS cd "$tmpdir"
+WVPASS bup init
+WVPASS mkdir src
+for d in a a/b a/b/c d; do
+    WVPASS mkdir src/$d
+    for i in $(seq 1 20); do
+        WVPASS bup random --seed=$i $((i * 100)) > src/$d/f$i
+    done
+done
+WVPASS bup random --seed=99 3M > src/d/large
+WVPASS ln src/a/f1 src/d/link
+WVPASS touch -d 2001-01-01 src/a/b/c src/a/b src/a src/d src/a/f2
+WVPASS bup index src
+WVPASS bup save -n src src
+WVPASS bup tick
+
+
+WVSTART 'restore --jobs'
+WVPASS bup restore -C serial "src/latest$tmpdir/src/"
+WVPASS bup restore --jobs 4 -C parallel "src/latest$tmpdir/src/"
+WVPASS diff -r src parallel
+WVPASSEQ "$(tree-meta parallel)" "$(tree-meta serial)"
+WVPASSEQ "$(tree-meta parallel)" "$(tree-meta src)"
+WVPASSEQ "$(stat -c %i parallel/a/f1)" "$(stat -c %i parallel/d/link)"
+
+
+WVSTART 'restore --jobs (single file)'
+WVPASS bup restore --jobs 2 -C single "src/latest$tmpdir/src/a/f2"
+WVPASS cmp src/a/f2 single/f2
+WVPASSEQ "$(tree-meta single)" \
+    "$(tree-meta src/a | sed -n '/^path: .\/f2$/,/^$/p')"
+
+
+WVSTART 'restore --jobs (invalid)'
+WVFAIL bup restore --jobs x -C invalid "src/latest$tmpdir/src/" 2> err.log
+WVPASS grep -F 'invalid --jobs value' err.log
+WVFAIL grep -F Traceback err.log
+WVFAIL bup restore --jobs 0 -C invalid "src/latest$tmpdir/src/"
+
+WVPASS rm -rf "$tmpdir"
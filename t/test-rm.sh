@@ -154,10 +154,12 @@ verify-changes-caused-by-rewriting-save()
     new_idx="$(echo "$new_paths" | WVPASS grep -E '^\./objects/pack/pack-.*\.idx$' | cut -b 3-)" || exit $?
     new_pack="$(echo "$new_paths" | WVPASS grep -E '^\./objects/pack/pack-.*\.pack$' | cut -b 3-)" || exit $?
     wv_matches_rx "$(compare-trees "$after/" "$before/")" \
-">fcst\.\.\.[.]*[ ]+logs/refs/heads/src
+">fcst\.\.\.[.]*[ ]+bupcommits
+>fcst\.\.\.[.]*[ ]+logs/refs/heads/src
 \.d\.\.t\.\.\.[.]*[ ]+objects/
 \.d\.\.t\.\.\.[.]*[ ]+objects/pack/
 >fcst\.\.\.[.]*[ ]+objects/pack/bup\.bloom
+>fcst\.\.\.[.]*[ ]+objects/pack/bup\.idxcounts
 >f\+\+\+\+\+\+\+[+]*[ ]+$new_idx
 >f\+\+\+\+\+\+\+[+]*[ ]+$new_pack
 \.d\.\.t\.\.\.[.]*[ ]+refs/heads/
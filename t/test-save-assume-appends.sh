@@ -0,0 +1,58 @@
+#!/usr/bin/env bash
+. ./wvtest-bup.sh || exit $?
+. t/lib.sh || exit $?
+
+set -o pipefail
+
+top="$(WVPASS pwd)" || exit $?
+tmpdir="$(WVPASS wvmktempdir)" || exit $?
+export BUP_DIR="$tmpdir/bup"
+
+bup() { "$top/bup" "$@"; }
+
+# The object id of $1 in the latest save of "src".
+saved_id() { bup ls -s "src/latest$tmpdir/src/$1" | cut -d' ' -f1; }
+
+WVPASS cd "$tmpdir"
+WVPASS bup init
+WVPASS mkdir src
+WVPASS bup random --seed=1 3M > src/log
+WVPASS bup index src
+WVPASS bup save --assume-appends -n src src
+WVPASS test -e "$BUP_DIR/bupindex.splits"
+
+
+WVSTART 'appended file'
+WVPASS bup random --seed=2 100k >> src/log
+WVPASS bup index src
+WVPASS bup -D save --assume-appends -n src src 2> save.log
+WVPASS grep -q "src/log grew; splitting from" save.log
+appended_id="$(saved_id log)" || exit $?
+WVPASS bup restore -C restore "src/latest$tmpdir/src/log"
+WVPASS cmp src/log restore/log
+WVPASS rm -r restore
+# A full split gives the same result.
+WVPASS bup index --fake-invalid src/log
+WVPASS bup save -n src src
+WVPASSEQ "$(saved_id log)" "$appended_id"
+
+
+WVSTART 'changed and appended file'
+WVPASS bup save --assume-appends -n src src
+WVPASS printf x | WVPASS dd of=src/log bs=1 seek=0 conv=notrunc
+WVPASS bup random --seed=3 100k >> src/log
+WVPASS bup index src
+WVPASS bup -D save --assume-appends -n src src 2> save.log
+WVFAIL grep -q "src/log grew; splitting from" save.log
+WVPASS bup restore -C restore "src/latest$tmpdir/src/log"
+WVPASS cmp src/log restore/log
+WVPASS rm -r restore
+
+
+WVSTART 'dropped records'
+WVPASS rm src/log
+WVPASS bup index src
+WVPASS bup save --assume-appends -n src src
+WVFAIL test -e "$BUP_DIR/bupindex.splits"
+
+WVPASS rm -rf "$tmpdir"
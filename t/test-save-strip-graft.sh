@@ -158,4 +158,29 @@ WVFAIL bup save --strip -n foo src/x src/y 2> tmp-err.log
 WVPASS grep -F "error: ignoring duplicate path '1' in '/'" tmp-err.log
 
 
+WVSTART "save collision (metadata)"
+WVPASS force-delete "$BUP_DIR" src restore
+WVPASS bup init
+WVPASS mkdir -p src/x src/y
+WVPASS echo x-f > src/x/f
+WVPASS echo x-g > src/x/g
+WVPASS echo y-f > src/y/f
+WVPASS echo y-h > src/y/h
+WVPASS chmod 600 src/x/f
+WVPASS chmod 640 src/x/g
+WVPASS chmod 604 src/y/f
+WVPASS chmod 644 src/y/h
+WVPASS bup index -u src
+WVFAIL bup save --strip -n foo src/x src/y 2> tmp-err.log
+WVPASS grep -F "error: ignoring duplicate path 'f' in '/'" tmp-err.log
+WVPASS bup restore -C restore /foo/latest/
+# The .bupm must still line up with the tree, i.e. each restored file
+# has the mode of the source file whose content it has.
+for f in f g h; do
+    src="$(WVPASS grep -lx "$(WVPASS cat restore/$f)" src/x/* src/y/*)" \
+        || exit $?
+    WVPASSEQ "$(stat -c %a restore/$f)" "$(stat -c %a "$src")"
+done
+
+
 WVPASS rm -rf "$tmpdir"
@@ -0,0 +1,56 @@
+#!/usr/bin/env bash
+. ./wvtest-bup.sh || exit $?
+. t/lib.sh || exit $?
+
+set -o pipefail
+
+top="$(WVPASS pwd)" || exit $?
+tmpdir="$(WVPASS wvmktempdir)" || exit $?
+export BUP_DIR="$tmpdir/bup"
+export GIT_DIR="$tmpdir/bup"
+
+bup() { "$top/bup" "$@"; }
+
+WVPASS cd "$tmpdir"
+WVPASS bup init
+gen="$(WVPASS git config bup.generation)" || exit $?
+WVPASS test "$gen"
+WVPASS mkdir src
+WVPASS bup random --seed=1 1M > src/data
+WVPASS date > src/date
+WVPASS bup index src
+WVPASS bup save --trust-generation -n src src
+# Objects are only trusted once they've been seen in a finished pack.
+WVPASS bup save --trust-generation -n src src
+
+
+WVSTART 'trusted entries are not rechecked'
+# Remove the objects behind bup's back, which isn't noticed as long as
+# the generation stays the same, so only the trees and metadata for
+# the (unindexed) parent directories are written again.
+WVPASS rm -r "$BUP_DIR"/objects/pack/*
+WVPASS bup save --trust-generation -t src
+WVPASS test "$(cat "$BUP_DIR"/objects/pack/*.pack | wc -c)" -lt 100000
+
+
+WVSTART 'untrusted entries are rechecked'
+WVPASS rm -r "$BUP_DIR"/objects/pack/*
+WVPASS bup save -t src
+WVPASS test "$(cat "$BUP_DIR"/objects/pack/*.pack | wc -c)" -gt 1000000
+WVPASS rm -r "$BUP_DIR"/objects/pack/*
+WVPASS git config bup.generation 0123456789abcdef
+WVPASS bup save --trust-generation -n new src
+WVPASS git update-ref -d refs/heads/src
+WVPASS git reflog expire --expire=all --all
+WVPASS git fsck --strict
+WVPASS bup restore -C restore "new/latest$tmpdir/src/"
+WVPASS cmp src/data restore/data
+WVPASS cmp src/date restore/date
+
+
+WVSTART 'gc changes the generation'
+gen="$(WVPASS git config bup.generation)" || exit $?
+WVPASS bup gc --unsafe
+WVPASS test "$gen" != "$(git config bup.generation)"
+
+WVPASS rm -rf "$tmpdir"
@@ -33,6 +33,8 @@ WVPASSEQ "$(cat tag[ab].tmp | bup split -b --git-ids)" \
          "$(cat tagab.tmp)"
 WVPASS bup split --bench -b <"$top/t/testfile1" >tags1.tmp
 WVPASS bup split -vvvv -b "$top/t/testfile2" >tags2.tmp
+WVPASSEQ "$(bup split --mmap=0 -b "$top/t/testfile2")" "$(cat tags2.tmp)"
+WVPASSEQ "$(bup split --mmap=0 -b <"$top/t/testfile2")" "$(cat tags2.tmp)"
 WVPASS echo -n "" | WVPASS bup split -n split_empty_string.tmp
 WVPASS bup margin
 WVPASS bup midx -f
@@ -84,4 +86,22 @@ WVPASS diff -u "$top/t/testfile2" out2t.tmp
 WVPASS diff -u "$top/t/testfile2" out2c.tmp
 WVPASSEQ "$(bup join split_empty_string.tmp)" ""
 
+WVSTART "fastcdc chunker"
+WVFAIL bup -d "$tmpdir/bup-fastcdc" init --chunker=nonsense
+WVPASS bup -d "$tmpdir/bup-fastcdc" init --chunker=fastcdc
+WVPASSEQ "$(git --git-dir="$tmpdir/bup-fastcdc" config bup.split.chunker)" \
+    fastcdc
+WVPASS bup -d "$tmpdir/bup-fastcdc" split -b "$top/t/testfile2" \
+    >tags2-fastcdc.tmp
+WVFAIL diff -u tags2.tmp tags2-fastcdc.tmp
+# The remote repository's chunker applies.
+WVPASS bup split -r ":$tmpdir/bup-fastcdc" -b "$top/t/testfile2" \
+    >tags2r-fastcdc.tmp
+WVPASS diff -u tags2-fastcdc.tmp tags2r-fastcdc.tmp
+WVPASS bup -d "$tmpdir/bup-fastcdc" join <tags2-fastcdc.tmp \
+    >out2-fastcdc.tmp
+WVPASS diff -u "$top/t/testfile2" out2-fastcdc.tmp
+WVPASS git --git-dir="$tmpdir/bup-fastcdc" config bup.split.chunker nonsense
+WVFAIL bup -d "$tmpdir/bup-fastcdc" split -b "$top/t/testfile2"
+
 WVPASS rm -rf "$tmpdir"